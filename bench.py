@@ -0,0 +1,296 @@
+# bench.py
+# Нагрузочный прогон бота без сети: синтетические апдейты идут через dp.feed_update,
+# запросы к Bot API перехватывает сессия-заглушка.
+# Запуск: python bench.py [число пользователей ...]
+# Переменные: BENCH_UPDATES (апдейтов на прогон), BENCH_CONCURRENCY (одновременных апдейтов),
+#             BENCH_ALLOC_UPDATES (апдейтов в замере памяти)
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench-token-not-used-for-requests")
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BOT_DIR)
+
+SIZES = [int(arg) for arg in sys.argv[1:]] or [1_000, 100_000, 1_000_000]
+UPDATES = int(os.getenv("BENCH_UPDATES", "20000"))
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "8"))
+ALLOC_UPDATES = int(os.getenv("BENCH_ALLOC_UPDATES", "2000"))
+
+# Доли сценариев в нагрузке; mini и roulette - команда и нажатие кнопки, т.е. два апдейта
+SCENARIOS = {
+    "bet": 20,
+    "bank": 10,
+    "mini": 15,
+    "roulette": 15,
+    "menu": 40,
+}
+MENU_TEXTS = ["Баланс", "Профиль", "Игры", "Банк", "Рудник", "Статистика", "Топ", "Назад в меню"]
+
+
+def make_stub_session(main):
+    from aiogram.methods import EditMessageText, SendMessage
+    from aiogram.types import Message
+
+    class StubSession(main.CachedMarkupSession):
+        """Собирает запрос как настоящая сессия, но вместо отправки запоминает его"""
+
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+            self.markups = {}  # chat_id -> последняя клавиатура в этом чате
+            self.message_id = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            self.build_form_data(bot, method)  # сериализация - часть стоимости отправки
+            self.calls[type(method).__name__] += 1
+            if not isinstance(method, (SendMessage, EditMessageText)):
+                return True
+            if method.reply_markup is not None:
+                self.markups[method.chat_id] = method.reply_markup
+            self.message_id += 1
+            return Message.model_validate(
+                {
+                    "message_id": getattr(method, "message_id", None) or self.message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": method.chat_id, "type": "private"},
+                    "text": method.text,
+                },
+                context={"bot": bot},
+            )
+
+        async def close(self):
+            pass
+
+    return StubSession()
+
+
+class LoadGenerator:
+    """Синтетические апдейты от случайных пользователей из заполненной базы"""
+
+    def __init__(self, main, session, user_ids: list, seed: int):
+        from aiogram.types import Update
+
+        self.main = main
+        self.session = session
+        self.user_ids = user_ids
+        self.rnd = random.Random(seed)
+        self.update_cls = Update
+        self.update_id = 0
+        self.names = list(SCENARIOS)
+        self.weights = list(SCENARIOS.values())
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"}
+
+    def message(self, user_id: int, text: str):
+        self.update_id += 1
+        message = {
+            "message_id": self.update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self.update_cls.model_validate(
+            {"update_id": self.update_id, "message": message}, context={"bot": self.main.bot}
+        )
+
+    def callback(self, user_id: int, data: str):
+        self.update_id += 1
+        return self.update_cls.model_validate(
+            {
+                "update_id": self.update_id,
+                "callback_query": {
+                    "id": str(self.update_id),
+                    "chat_instance": "bench",
+                    "from": self._user(user_id),
+                    "data": data,
+                    "message": {
+                        "message_id": self.update_id,
+                        "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"},
+                        "text": "bench",
+                    },
+                },
+            },
+            context={"bot": self.main.bot},
+        )
+
+    def mini_button(self, user_id: int) -> str:
+        # Нажимаем случайную закрытую клетку на поле, которое бот только что прислал
+        markup = self.session.markups.get(user_id)
+        buttons = [
+            button.callback_data
+            for row in getattr(markup, "inline_keyboard", ())
+            for button in row
+            if button.callback_data and button.callback_data.startswith("mini_open_")
+        ]
+        return self.rnd.choice(buttons) if buttons else "mini_open_none_1"
+
+    def scenario(self) -> tuple:
+        """Имя сценария и список шагов: апдейт или функция, строящая его по ответу бота"""
+        name = self.rnd.choices(self.names, self.weights)[0]
+        user_id = self.rnd.choice(self.user_ids)
+        amount = self.rnd.randint(1, 100)
+        if name == "bet":
+            return name, [self.message(user_id, f"/bet {amount}")]
+        if name == "bank":
+            text = self.rnd.choice(["/bank", f"/bank {amount}", f"/bank w {amount}"])
+            return name, [self.message(user_id, text)]
+        if name == "mini":
+            return name, [
+                self.message(user_id, f"/mini {amount}"),
+                lambda: self.callback(user_id, self.mini_button(user_id)),
+            ]
+        if name == "roulette":
+            return name, [
+                self.message(user_id, f"/roulette {amount}"),
+                self.callback(user_id, f"roulette_num_{self.rnd.randint(0, 36)}"),
+            ]
+        return name, [self.message(user_id, self.rnd.choice(MENU_TEXTS))]
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+async def drive(main, generator: LoadGenerator, count: int, concurrency: int) -> dict:
+    """Скармливает count апдейтов; сценарии одного воркера идут по очереди"""
+    latencies = []
+    per_scenario = {name: [] for name in SCENARIOS}
+    remaining = [count]
+
+    async def worker():
+        while remaining[0] > 0:
+            name, steps = generator.scenario()
+            for step in steps:
+                update = step() if callable(step) else step
+                started = time.perf_counter()
+                await main.dp.feed_update(main.bot, update)
+                elapsed = time.perf_counter() - started
+                latencies.append(elapsed)
+                per_scenario[name].append(elapsed)
+                remaining[0] -= 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    for values in per_scenario.values():
+        values.sort()
+    return {"wall": wall, "latencies": latencies, "per_scenario": per_scenario}
+
+
+async def measure_allocations(main, generator: LoadGenerator, count: int) -> tuple:
+    """Средний пик памяти внутри апдейта и сколько памяти апдейт оставляет после себя"""
+    tracemalloc.start()
+    peaks = 0
+    done = 0
+    retained_start = tracemalloc.get_traced_memory()[0]
+    while done < count:
+        _, steps = generator.scenario()
+        for step in steps:
+            update = step() if callable(step) else step
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            await main.dp.feed_update(main.bot, update)
+            peaks += tracemalloc.get_traced_memory()[1] - before
+            done += 1
+    retained = tracemalloc.get_traced_memory()[0] - retained_start
+    tracemalloc.stop()
+    return peaks / done, retained / done
+
+
+async def run(main, session, count: int):
+    from bench_snapshot import seed
+
+    seed(main, count)
+    user_ids = list(main.users)
+
+    # Начальный снимок пишем заранее, иначе первая запись всей базы попадёт в замер
+    main._snapshot_cache = {section: {} for section in main.USER_SECTIONS}
+    main.dirty_all = True
+    started = time.perf_counter()
+    main.flush_data()
+    initial_save = time.perf_counter() - started
+
+    main.leaderboard.rebuild()
+    main.build_keyboards()
+    # Лимит команд на пользователя отключаем: на тысячах апдейтов в секунду
+    # маленькая база почти целиком упиралась бы в отказ, а меряем мы обработчики
+    main.rate_limiter.hit = lambda user_id, command, seconds: True
+
+    tasks = [
+        asyncio.create_task(main.persistence_worker()),
+        asyncio.create_task(main.rate_limit_sweeper()),
+        asyncio.create_task(main.mini_session_reaper()),
+        asyncio.create_task(main.fsm_sweeper()),
+    ]
+    saves_before = main._flush_covered
+    session.calls.clear()
+    try:
+        result = await drive(main, LoadGenerator(main, session, user_ids, count), UPDATES, CONCURRENCY)
+        peak, retained = await measure_allocations(main, LoadGenerator(main, session, user_ids, count + 1), ALLOC_UPDATES)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    started = time.perf_counter()
+    main.flush_data()
+    final_save = time.perf_counter() - started
+
+    latencies = result["latencies"]
+    print(f"\n=== {count:,} пользователей, {len(latencies):,} апдейтов, concurrency {CONCURRENCY} ===")
+    print(f"апдейтов/сек: {len(latencies) / result['wall']:,.0f}")
+    print(f"задержка p50: {percentile(latencies, 0.5) * 1000:.2f} мс, "
+          f"p99: {percentile(latencies, 0.99) * 1000:.2f} мс, "
+          f"max: {latencies[-1] * 1000:.2f} мс")
+    print(f"память на апдейт: пик {peak / 1024:.1f} КиБ, остаётся {retained:,.0f} Б")
+    print(f"снимок: начальный {initial_save:.2f} с, итоговый {final_save:.2f} с, "
+          f"записей во время прогона: {main._flush_covered - saves_before}")
+    print(f"{'сценарий':>10} {'апдейтов':>9} {'p50, мс':>8} {'p99, мс':>8}")
+    for name, values in result["per_scenario"].items():
+        print(f"{name:>10} {len(values):>9} {percentile(values, 0.5) * 1000:>8.2f} {percentile(values, 0.99) * 1000:>8.2f}")
+    print("запросы к API: " + ", ".join(f"{method} {calls}" for method, calls in session.calls.most_common()))
+
+
+def main_bench():
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.chdir(workdir)  # bot.log, журнал и снимки создаются во временной папке
+    import logging
+    import main
+
+    # Логи бота идут в bot.log как обычно, в консоль выводим только результаты
+    main.setup_logging(main.LOG_FILE)
+    main.log_listener.handlers = tuple(
+        handler for handler in main.log_listener.handlers if type(handler) is not logging.StreamHandler
+    )
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+    # Очередь отправки не подключаем: она намеренно растягивает ответы до лимитов Telegram
+    session = make_stub_session(main)
+    main.bot.session = session
+    main.load_text_plugins()
+
+    # Один цикл событий на все прогоны: очереди и блокировки бота создаются при импорте
+    async def run_all():
+        for count in SIZES:
+            await run(main, session, count)
+
+    asyncio.run(run_all())
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,83 @@
+# bench_snapshot.py
+# Сравнение JSON и бинарного снимка: время записи, загрузки и размер файла.
+# Запуск: python bench_snapshot.py [число пользователей ...]
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench-token-not-used-for-requests")
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BOT_DIR)
+
+SIZES = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+
+
+def seed(main, count: int):
+    rnd = random.Random(count)
+    main.users.clear()
+    main.daily_used.clear()
+    now = datetime.now()
+    for user_id in range(1_000_000_000, 1_000_000_000 + count):
+        user = main.UserState()
+        user.balance = rnd.randint(0, 10 ** 9)
+        user.bank = rnd.randint(0, 10 ** 7)
+        user.accelerators = rnd.randint(0, 500)
+        user.profile.level = rnd.randint(1, 50)
+        user.profile.xp = rnd.randint(0, 5000)
+        if rnd.random() < 0.3:
+            user.mine.auto_collect = True
+            user.mine.last_accrual = time.time()
+        if rnd.random() < 0.05:
+            user.donations = [{"stars": 50, "coins": 500_000, "date": now.isoformat()}]
+        main.users[user_id] = user
+        if rnd.random() < 0.5:
+            main.daily_used[user_id] = now - timedelta(hours=rnd.randint(0, 24))
+    main.users[1_000_000_000].balance = main.INFINITE_BALANCE
+    main.promo_codes = {
+        f"CODE{i}": {"type": "m", "amount": 1000, "max_activations": 10_000,
+                     "used_by": set(range(1_000_000_000, 1_000_000_000 + min(count, 10_000)))}
+        for i in range(5)
+    }
+
+
+def run(main, data_file: str, count: int) -> tuple:
+    main.DATA_FILE = data_file
+    main.SNAPSHOT_GENERATIONS = 0
+    main._snapshot_cache = {section: {} for section in main.USER_SECTIONS}
+    main.dirty_all = True
+
+    started = time.perf_counter()
+    main.flush_data()
+    save_time = time.perf_counter() - started
+
+    main.users.clear()
+    main.daily_used.clear()
+    started = time.perf_counter()
+    main.load_data()
+    load_time = time.perf_counter() - started
+
+    assert len(main.users) == count, len(main.users)
+    return save_time, load_time, os.path.getsize(data_file)
+
+
+def main_bench():
+    workdir = tempfile.mkdtemp(prefix="snapshot-bench-")
+    os.chdir(workdir)  # bot.log и снимки создаются во временной папке
+    import main
+    main.logger.disabled = True
+
+    print(f"{'users':>9} {'format':>7} {'save, s':>9} {'load, s':>9} {'size, MB':>9}")
+    for count in SIZES:
+        for data_file in ("bench.json", "bench.bin"):
+            seed(main, count)
+            save_time, load_time, size = run(main, data_file, count)
+            fmt = os.path.splitext(data_file)[1][1:]
+            print(f"{count:>9} {fmt:>7} {save_time:>9.2f} {load_time:>9.2f} {size / 2 ** 20:>9.1f}")
+            os.remove(data_file)
+
+
+if __name__ == "__main__":
+    main_bench()
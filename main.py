@@ -1,42 +1,139 @@
 # bot.py
 import asyncio
+import atexit
+import bisect
+import csv
+import hashlib
+import heapq
+import html
+import importlib
 import json
 import os
 import logging
+import multiprocessing
+import queue
 import random
+import sqlite3
 import string
+import struct
+import sys
+import tempfile
+import threading
 import time
+import uuid
+import weakref
+import zlib
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import Dict, Any, Set, List, Tuple, Optional
-from functools import wraps
+from typing import Dict, Any, Tuple, Optional
+from functools import partial, wraps
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, CommandObject
 from aiogram.types import (
     Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile,
-    PreCheckoutQuery, LabeledPrice, SuccessfulPayment
+    PreCheckoutQuery, LabeledPrice, SuccessfulPayment, Update
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import (
+    DataNotDictLikeError, TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+    TelegramServerError
+)
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import EditMessageText, GetUpdates
 from aiogram.utils.formatting import Text, Bold, Italic, Code
+from aiohttp import FormData, web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения
 load_dotenv()
 
 # ---------------- НАСТРОЙКИ ЛОГИРОВАНИЯ ----------------
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # размер bot.log до ротации
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))  # сколько старых файлов лога хранить
+LOG_SAMPLE_INTERVAL = float(os.getenv("LOG_SAMPLE_INTERVAL", "60"))  # сек между повторами частых строк
+LOG_SAMPLED_LOGGERS = ("aiogram.event",)  # логгеры, чьи INFO-строки тоже прореживаются
+
+
+class LogSampler(logging.Filter):
+    """Пропускает частую INFO-строку не чаще раза в interval секунд.
+
+    Частая строка - с extra={"sample": ключ} или из LOG_SAMPLED_LOGGERS (ключ - шаблон
+    сообщения). К пропущенной строке дописывается, сколько похожих было отброшено.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__()
+        self.interval = interval
+        self.last = {}  # ключ -> время последней пропущенной строки
+        self.dropped = Counter()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        key = getattr(record, "sample", None)
+        if key is None:
+            if record.name not in LOG_SAMPLED_LOGGERS:
+                return True
+            key = record.msg
+        now = time.monotonic()
+        if now - self.last.get(key, -self.interval) < self.interval:
+            self.dropped[key] += 1
+            return False
+        self.last[key] = now
+        dropped = self.dropped.pop(key, 0)
+        if dropped:
+            record.msg = f"{record.getMessage()} (ещё {dropped} таких за {self.interval:g} с)"
+            record.args = None
+        return True
+
+
+log_listener = None
+
+
+def setup_logging(log_file: str):
+    """Логи пишет отдельный поток: обработчики только кладут запись в очередь"""
+    global log_listener
+    stop_logging()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler = RotatingFileHandler(
+        log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8', delay=True
+    )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))  # оформляют обработчики в потоке
+    queue_handler.addFilter(LogSampler(LOG_SAMPLE_INTERVAL))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler], force=True)
+    log_listener = QueueListener(log_queue, file_handler, stream_handler)
+    log_listener.start()
+
+
+def stop_logging():
+    # Дописываем всё, что осталось в очереди
+    global log_listener
+    if log_listener:
+        log_listener.stop()
+        log_listener = None
+
+
+# setup_logging() вызывают точки входа: импорт модуля (дочерний процесс шарда, тесты)
+# не должен открывать bot.log
+atexit.register(stop_logging)
 logger = logging.getLogger(__name__)
 
 # ---------------- НАСТРОЙКИ ----------------
@@ -53,18 +150,70 @@ DAILY_ACCELERATORS_DELUXE = 100
 START_ACCELERATORS = 10
 DAILY_HOURS = 12
 
+# ---------------- НАСТРОЙКИ ЗАПУСКА ----------------
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling или webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))
+# /metrics слушает отдельный порт, по умолчанию только localhost; шард N - METRICS_PORT + 1 + N
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # 0 - не поднимать
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # если задан, нужен заголовок Authorization: Bearer <токен>
+
+# ---------------- НАСТРОЙКИ ШАРДИРОВАНИЯ ----------------
+SHARD_COUNT = int(os.getenv("SHARDS", "1"))  # процессов-воркеров, 1 - всё в одном процессе
+SHARD_INDEX = 0  # шард текущего процесса, задаётся в shard_main()
+SHARD_TRANSFER_TIMEOUT = 10  # сек ожидания подтверждения перевода другим шардом
+
+# ---------------- НАСТРОЙКИ ОТПРАВКИ ----------------
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))  # сообщений в секунду на весь бот
+SEND_CHAT_RATE = 1.0  # сообщений в секунду в личный чат
+SEND_GROUP_RATE = 20 / 60  # сообщений в секунду в группу
+SEND_CHAT_BURST = 3  # сколько сообщений подряд можно отправить в чат без паузы
+SEND_MAX_RETRIES = 3
+SEND_SHAPED_METHODS = ("Send", "Copy", "Forward", "Edit")  # префиксы методов, которые ждут лимитов отправки
+# Повтор после сетевой ошибки или 5xx безопасен только для правок: запрос мог дойти,
+# и повторный sendMessage продублировал бы сообщение. 429 повторяется для всех методов
+SEND_RETRY_METHODS = ("Edit",)
+SEND_BUCKET_SWEEP_INTERVAL = 60  # сек между чистками корзин чатов
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # сообщений рассылки в секунду, остаток SEND_GLOBAL_RATE - ответам
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "5"))  # запросов рассылки одновременно
+BROADCAST_FILE = os.getenv("BROADCAST_FILE", "broadcast.json")  # прогресс рассылки для продолжения после перезапуска
+BROADCAST_CHECKPOINT_INTERVAL = 5  # сек между записями прогресса
+BROADCAST_BATCH = 5000  # id, выбираемых из users за один проход курсора
+BROADCAST_COMPLETED_MAX = 1000  # обработанных id выше отметки, дальше ждём зависший запрос
+
 # ---------------- НАСТРОЙКИ ДОНАТА ----------------
 STAR_TO_COINS = 10000
 ELITE_PRICE = 50
 DELUXE_PRICE = 99
 
 # ---------------- ФАЙЛ ДЛЯ ХРАНЕНИЯ ДАННЫХ ----------------
-DATA_FILE = "bot_data.json"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # json или sqlite
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT", "json")  # json или binary (только для STORAGE_BACKEND=json)
+DATA_FILE = "bot_data.bin" if STORAGE_BACKEND == "json" and SNAPSHOT_FORMAT == "binary" else "bot_data.json"
+SAVE_DELAY = float(os.getenv("SAVE_DELAY", "2"))  # окно склейки изменений, сек
+DB_FILE = os.getenv("DB_FILE", "bot_data.db")
+SNAPSHOT_GENERATIONS = int(os.getenv("SNAPSHOT_GENERATIONS", "3"))  # сколько прошлых снимков хранить
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "bot_data.journal")
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "0") == "1"  # fsync после каждой записи журнала
+JOURNAL_COMPACT_INTERVAL = int(os.getenv("JOURNAL_COMPACT_INTERVAL", "600"))  # сек между сжатиями журнала
+JOURNAL_MAX_BYTES = int(os.getenv("JOURNAL_MAX_BYTES", str(64 * 1024 * 1024)))  # размер, после которого сжимаем раньше
+USERNAME_CACHE_SIZE = int(os.getenv("USERNAME_CACHE_SIZE", "100000"))
+USERNAME_TTL = 7 * 24 * 3600  # сек, сколько верим найденному username
+USERNAME_MISS_TTL = 600  # сек, сколько помним, что username не найден
+USERNAME_VERIFY_AGE = 60  # сек; перед переводом более старая запись кэша перепроверяется через get_chat
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "3600"))  # сек бездействия до удаления FSM-состояния
+LEADERBOARD_REFRESH_INTERVAL = int(os.getenv("LEADERBOARD_REFRESH_INTERVAL", "5"))  # сек между обновлениями топа
+LEADERBOARD_REFRESH_BATCH = 2000  # игроков за один шаг обновления, между шагами цикл событий свободен
 
 # ---------------- НАСТРОЙКИ РУЛЕТКИ ----------------
 ROULETTE_MULTIPLIER = 36
 
 # ---------------- НАСТРОЙКИ РУДНИКА ----------------
+MINE_AUTO_RATE = 3  # единиц ресурса в секунду при включённом авто-сборе
 MINE_LEVELS = {
     0: {"name": "Золотая шахта", "resource": "Золото", "price_per_unit": 2, "upgrade_cost": 1000000},
     1: {"name": "Рубиновая шахта", "resource": "Рубин", "price_per_unit": 10, "upgrade_cost": 5000000},
@@ -84,27 +233,118 @@ MINI_COLS = 5
 MINI_CELLS = MINI_ROWS * MINI_COLS
 MINI_BOMBS = 5
 MINI_MULTIPLIER = 1.3
+MINI_SESSION_TTL = int(os.getenv("MINI_SESSION_TTL", "900"))  # сек бездействия до завершения игры
+MINI_EXPIRE_POLICY = os.getenv("MINI_EXPIRE_POLICY", "cashout")  # cashout - выплатить, forfeit - ставка сгорает
 
 # ---------------- ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ----------------
-user_balances = {}
+users = {}  # user_id -> UserState
 daily_used = {}
 ranks = {}
-user_accelerators = {}
-mine_data = {}
-business_data = {}
-user_bank = {}
 promo_codes = {}
-user_profiles = {}
-mini_games = {}
-user_donations = {}
-user_premium = {}
-user_last_command = {}
 roulette_games = {}
 pending_invoices = {}
 user_mini_settings = {}
+pending_transfers = {}  # transfer_id -> перевод на другой шард, ждущий подтверждения
+applied_transfers = {}  # transfer_id -> время зачисления перевода с другого шарда
+lazy_sections = {}  # раздел бинарного снимка -> ещё не разобранный JSON (см. load_lazy_section)
+blocked_users = set()  # заблокировали бота, рассылка их пропускает
+applied_bulks = set()  # sha256 файлов массовой выдачи, которые уже применены
 
 INFINITE_BALANCE = "INFINITE"
 
+
+# ---------------- ДАННЫЕ ПОЛЬЗОВАТЕЛЯ ----------------
+class Record:
+    """Компактная запись со __slots__, в файле хранится как обычный dict"""
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def values(self) -> list:
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_values(cls, values: list):
+        record = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, values):
+            setattr(record, name, value)
+        return record
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        record = cls()
+        for name in cls.__slots__:
+            if name in data:
+                setattr(record, name, data[name])
+        return record
+
+
+class MineState(Record):
+    __slots__ = ("level", "resources", "auto_collect", "last_accrual")
+
+    def __init__(self):
+        self.level = 0
+        self.resources = 0
+        self.auto_collect = False
+        self.last_accrual = None
+
+
+class BusinessState(Record):
+    __slots__ = ("type", "profit", "active", "last_collect")
+
+    def __init__(self):
+        self.type = None
+        self.profit = 0
+        self.active = False
+        self.last_collect = None
+
+
+class ProfileState(Record):
+    __slots__ = ("level", "xp", "next_level_xp")
+
+    def __init__(self):
+        self.level = 1
+        self.xp = 0
+        self.next_level_xp = 100
+
+
+class PremiumState(Record):
+    __slots__ = ("type", "expires", "purchased_at")
+
+    def __init__(self):
+        self.type = None
+        self.expires = None
+        self.purchased_at = None
+
+
+class UserState:
+    """Все данные игрока в одном объекте: один поиск в users на запрос"""
+    __slots__ = ("balance", "accelerators", "bank", "mine", "business", "profile", "_donations", "premium")
+
+    def __init__(self):
+        self.balance = START_BALANCE
+        self.accelerators = START_ACCELERATORS
+        self.bank = 0
+        self.mine = MineState()
+        self.business = BusinessState()
+        self.profile = ProfileState()
+        self._donations = None  # история донатов создаётся при первой покупке
+        self.premium = PremiumState()
+
+    @property
+    def donations(self):
+        # Из бинарного снимка история донатов читается только при первом обращении
+        if "user_donations" in lazy_sections:
+            load_lazy_section("user_donations")
+        return self._donations
+
+    @donations.setter
+    def donations(self, value):
+        if "user_donations" in lazy_sections:
+            load_lazy_section("user_donations")
+        self._donations = value
+
 # ---------------- FSM СОСТОЯНИЯ ----------------
 class RouletteStates(StatesGroup):
     waiting_for_number = State()
@@ -116,54 +356,1301 @@ class BankStates(StatesGroup):
     waiting_for_amount = State()
     waiting_for_withdraw = State()
 
+# ---------------- МЕТРИКИ ----------------
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # сек
+METRIC_FAMILIES = {
+    # семейство -> (имя метрики Prometheus, имя метки)
+    "update": ("coingame_update_seconds", "type"),
+    "handler": ("coingame_handler_seconds", "handler"),
+    "route": ("coingame_text_route_seconds", "route"),
+    "save": ("coingame_save_seconds", "stage"),
+    "api": ("coingame_api_request_seconds", "method"),
+}
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами LATENCY_BUCKETS; observe() только увеличивает счётчики"""
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # последняя корзина - больше всех границ
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Верхняя граница корзины, в которую попал q-й по порядку замер
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Задержки апдейтов, обработчиков, маршрутов текста, сохранений и запросов к Bot API"""
+
+    def __init__(self):
+        self.families = {family: {} for family in METRIC_FAMILIES}  # семейство -> имя -> Histogram
+        self.api_errors = Counter()
+
+    def observe(self, family: str, name: str, seconds: float):
+        histogram = self.families[family].get(name)
+        if histogram is None:
+            histogram = self.families[family][name] = Histogram()
+        histogram.observe(seconds)
+
+    def summary(self, family: str, limit: int = 10) -> list:
+        """(имя, вызовов, p50, p99, всего секунд) - сначала те, на которые ушло больше всего времени"""
+        rows = [
+            (name, h.count, h.quantile(0.5), h.quantile(0.99), h.total)
+            for name, h in self.families[family].items()
+        ]
+        rows.sort(key=lambda row: row[4], reverse=True)
+        return rows[:limit]
+
+    def prometheus(self) -> str:
+        lines = []
+        for family, (metric, label) in METRIC_FAMILIES.items():
+            lines.append(f"# TYPE {metric} histogram")
+            for name, h in sorted(self.families[family].items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, h.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{label}="{name}",le="+Inf"}} {h.count}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {h.total:.6f}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {h.count}')
+        lines.append("# TYPE coingame_api_errors_total counter")
+        for method, count in sorted(self.api_errors.items()):
+            lines.append(f'coingame_api_errors_total{{method="{method}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class ApiMetrics(BaseRequestMiddleware):
+    """Считает запросы к Bot API и время ожидания ответа, включая очередь отправки"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if isinstance(method, GetUpdates):
+            # Long polling висит до timeout секунд и только размывал бы гистограмму
+            return await make_request(bot, method)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            metrics.api_errors[type(method).__name__] += 1
+            raise
+        finally:
+            metrics.observe("api", type(method).__name__, time.perf_counter() - started)
+
+
 # ---------------- ИНИЦИАЛИЗАЦИЯ БОТА ----------------
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# id закэшированной клавиатуры -> её JSON (None, пока клавиатура не отправлялась)
+keyboard_json = {}
+
+
+class CachedMarkupSession(AiohttpSession):
+    """Отправляет клавиатуры из реестра уже сериализованным JSON"""
+
+    def build_form_data(self, bot: Bot, method):
+        markup = getattr(method, "reply_markup", None)
+        if markup is None or id(markup) not in keyboard_json:
+            return super().build_form_data(bot, method)
+
+        encoded = keyboard_json[id(markup)]
+        if encoded is None:
+            encoded = keyboard_json[id(markup)] = self.prepare_value(markup, bot=bot, files={})
+
+        form = FormData(quote_fields=False)
+        files = {}
+        for key, value in method.model_dump(warnings=False, exclude={"reply_markup"}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if not value:
+                continue
+            form.add_field(key, value)
+        form.add_field("reply_markup", encoded)
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
+
+class PersistentStorage(BaseStorage):
+    """FSM-хранилище, которое пишется на диск вместе с данными бота.
+
+    Записи без активности дольше ttl секунд забирает pop_expired() (см. fsm_sweeper).
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.records = {}  # ключ -> {"user_id", "state", "data", "touched"}
+        self.deadlines = []  # куча (время истечения, ключ)
+
+    @staticmethod
+    def make_key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    def _update(self, key: StorageKey, **fields):
+        storage_key = self.make_key(key)
+        record = self.records.get(storage_key)
+        if record is None:
+            record = self.records[storage_key] = {"user_id": key.user_id, "state": None, "data": {}}
+        record.update(fields)
+        if record["state"] is None and not record["data"]:
+            # state.clear() - запись больше не нужна
+            del self.records[storage_key]
+            record = None
+        else:
+            record["touched"] = time.time()
+            heapq.heappush(self.deadlines, (record["touched"] + self.ttl, storage_key))
+        journal.append(key.user_id, "fsm", [storage_key, record])
+        # В снимок попадает вместе с остальными изменениями
+        mark_meta_dirty("fsm_states")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._update(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self.records.get(self.make_key(key))
+        return record["state"] if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        self._update(key, data=data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self.records.get(self.make_key(key))
+        return record["data"].copy() if record else {}
+
+    async def close(self) -> None:
+        pass
+
+    def pop_expired(self) -> list:
+        now = time.time()
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, storage_key = heapq.heappop(self.deadlines)
+            record = self.records.get(storage_key)
+            # В куче остаются устаревшие сроки от прошлых обращений - их пропускаем
+            if record is not None and record["touched"] + self.ttl == deadline:
+                del self.records[storage_key]
+                expired.append(record)
+                journal.append(record["user_id"], "fsm", [storage_key, None])
+        if len(self.deadlines) > 2 * len(self.records) + 64:
+            self.deadlines = [(r["touched"] + self.ttl, k) for k, r in self.records.items()]
+            heapq.heapify(self.deadlines)
+        if expired:
+            mark_meta_dirty("fsm_states")
+        return expired
+
+    def restore(self, records: dict):
+        self.records = records
+        self.deadlines = [(r["touched"] + self.ttl, k) for k, r in records.items()]
+        heapq.heapify(self.deadlines)
+
+    def apply(self, storage_key: str, record: Optional[dict]):
+        # Запись журнала "fsm": новое состояние ключа или None, если его удалили
+        if record is None:
+            self.records.pop(storage_key, None)
+        else:
+            self.records[storage_key] = record
+            heapq.heappush(self.deadlines, (record["touched"] + self.ttl, storage_key))
+
+
+class TokenBucket:
+    """Корзина токенов в виде GCRA: хранит только время, когда освободится следующий слот"""
+    __slots__ = ("interval", "tolerance", "tat")
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.tat = 0.0
+
+    def reserve(self, now: float) -> float:
+        """Занимает слот и возвращает, сколько ждать до отправки"""
+        self.tat = max(self.tat, now)
+        delay = max(0.0, self.tat - self.tolerance - now)
+        self.tat += self.interval
+        return delay
+
+    def pause(self, now: float, seconds: float):
+        # После 429 от Telegram ближайшие слоты сдвигаются на retry_after
+        self.tat = max(self.tat, now + seconds + self.tolerance)
+
+
+class SendQueue(BaseRequestMiddleware):
+    """Очередь исходящих запросов к Bot API.
+
+    Отправка и правка сообщений ждут своего слота в корзине чата и в общей корзине бота.
+    Несколько edit_text одного сообщения, ждущих отправки, склеиваются в последний.
+    На 429 и сетевых ошибках запрос повторяется с паузой.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, burst=int(SEND_GLOBAL_RATE))
+        self.chat_buckets = {}  # chat_id -> TokenBucket
+        self.next_sweep = 0.0
+        self.edits = {}  # (chat_id, message_id) -> (Future последнего edit_text в очереди, время отправки)
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = SEND_GROUP_RATE if is_group else SEND_CHAT_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, burst=SEND_CHAT_BURST)
+        return bucket
+
+    def _send_at(self, chat_id) -> float:
+        now = time.monotonic()
+        if now >= self.next_sweep:
+            self.sweep(now)
+        return now + max(self._chat_bucket(chat_id).reserve(now), self.global_bucket.reserve(now))
+
+    def sweep(self, now: float):
+        # Корзина, чьё время уже прошло, ничем не отличается от новой - её можно забыть
+        for chat_id in [c for c, bucket in self.chat_buckets.items() if bucket.tat <= now]:
+            del self.chat_buckets[chat_id]
+        self.next_sweep = now + SEND_BUCKET_SWEEP_INTERVAL
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(SEND_SHAPED_METHODS):
+            # getUpdates, answerCallbackQuery, getChat и прочее, что не пишет в чат, идут мимо очереди
+            return await make_request(bot, method)
+
+        started = time.monotonic()
+        edit_key = None
+        future = None
+        send_at = None
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            edit_key = (chat_id, method.message_id)
+            future = asyncio.get_running_loop().create_future()
+            previous = self.edits.get(edit_key)
+            if previous is not None and not previous[0].done():
+                # Более старую правку отправлять незачем: новая занимает её слот,
+                # а старая получит результат новой
+                previous[0].set_result(future)
+                send_at = previous[1]
+
+        if send_at is None:
+            send_at = self._send_at(chat_id)
+        if edit_key is not None:
+            self.edits[edit_key] = (future, send_at)
+
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        try:
+            delay = send_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            waited = time.monotonic() - started
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+            if future is not None and future.done():
+                self.coalesced += 1
+                newer = future.result()
+                while isinstance(newer, asyncio.Future):
+                    newer = await newer
+                return newer
+            if edit_key is not None:
+                # Уже отправляемую правку не склеиваем: следующая займёт свой слот
+                del self.edits[edit_key]
+                edit_key = None
+
+            result = await self._send(make_request, bot, method, chat_id)
+            if future is not None and not future.done():
+                future.set_result(result)
+            return result
+        except BaseException as e:
+            if future is not None and not future.done():
+                future.set_exception(e)
+                future.exception()  # никто может не ждать - не пишем "exception was never retrieved"
+            raise
+        finally:
+            self.depth -= 1
+            if edit_key is not None and self.edits.get(edit_key, (None,))[0] is future:
+                del self.edits[edit_key]
+            latency = time.monotonic() - started
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    async def _send(self, make_request, bot: Bot, method, chat_id):
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            try:
+                result = await make_request(bot, method)
+                self.sent += 1
+                return result
+            except TelegramRetryAfter as e:
+                if attempt == SEND_MAX_RETRIES:
+                    raise
+                self.retries += 1
+                logger.warning(f"⏳ Telegram просит подождать {e.retry_after} с (чат {chat_id})")
+                self._chat_bucket(chat_id).pause(time.monotonic(), e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError):
+                if attempt == SEND_MAX_RETRIES or not type(method).__name__.startswith(SEND_RETRY_METHODS):
+                    raise
+                self.retries += 1
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "chat_buckets": len(self.chat_buckets),
+            "wait_ms_max": round(self.wait_max * 1000, 1),
+            "wait_ms_total": round(self.wait_total * 1000, 1),
+            "latency_ms_max": round(self.latency_max * 1000, 1),
+            "latency_ms_total": round(self.latency_total * 1000, 1),
+        }
+
+
+bot = Bot(token=BOT_TOKEN, session=CachedMarkupSession())
+send_queue = SendQueue()
+bot.session.middleware(ApiMetrics())  # первой, чтобы в замер попало и ожидание в очереди
+bot.session.middleware(send_queue)
+storage = PersistentStorage(ttl=FSM_STATE_TTL)
 dp = Dispatcher(storage=storage)
 
-# ---------------- ФУНКЦИИ ДЛЯ РАБОТЫ С ФАЙЛАМИ ----------------
-def save_data():
+
+@dp.update.outer_middleware()
+async def update_metrics_middleware(handler, event: Update, data: dict):
+    started = time.perf_counter()
     try:
-        data = {
-            "user_balances": {str(k): v for k, v in user_balances.items()},
-            "daily_used": {str(k): v.isoformat() if v else None for k, v in daily_used.items()},
-            "ranks": {str(k): v for k, v in ranks.items()},
-            "user_accelerators": {str(k): v for k, v in user_accelerators.items()},
-            "mine_data": {str(k): v for k, v in mine_data.items()},
-            "business_data": {str(k): v for k, v in business_data.items()},
-            "user_bank": {str(k): v for k, v in user_bank.items()},
-            "promo_codes": {k: {**v, "used_by": list(v["used_by"]) if isinstance(v["used_by"], set) else v["used_by"]}
-                            for k, v in promo_codes.items()},
-            "user_profiles": {str(k): v for k, v in user_profiles.items()},
-            "user_donations": {str(k): v for k, v in user_donations.items()},
-            "user_premium": {str(k): v for k, v in user_premium.items()},
-            "user_mini_settings": {str(k): v for k, v in user_mini_settings.items()}
-        }
+        return await handler(event, data)
+    finally:
+        metrics.observe("update", event.event_type, time.perf_counter() - started)
+
+
+async def handler_metrics_middleware(handler, event, data: dict):
+    # Внутренний middleware вызывается уже для найденного обработчика
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        metrics.observe("handler", data["handler"].callback.__name__, time.perf_counter() - started)
+
+
+for observer in (dp.message, dp.callback_query, dp.pre_checkout_query):
+    observer.middleware(handler_metrics_middleware)
+
+# ---------------- ФУНКЦИИ ДЛЯ РАБОТЫ С ФАЙЛАМИ ----------------
+# Разделы файла данных, которые хранят записи по user_id
+USER_SECTIONS = (
+    "user_balances", "daily_used", "ranks", "user_accelerators", "mine_data",
+    "business_data", "user_bank", "user_profiles", "user_donations",
+    "user_premium", "user_mini_settings"
+)
+
+# Изменённые пользователи ждут фоновой записи в persistence_worker()
+dirty_users = set()
+dirty_all = True  # первая запись строит кэш снимка целиком
+dirty_meta = set()  # служебные разделы снимка (META_SECTIONS), изменившиеся с прошлой записи
+save_requested = asyncio.Event()
+
+# Разделы снимка, которые собираются из UserState: раздел -> (чтение, запись)
+STATE_SECTIONS = {
+    "user_balances": (lambda u: u.balance, lambda u, v: setattr(u, "balance", v)),
+    "user_accelerators": (lambda u: u.accelerators, lambda u, v: setattr(u, "accelerators", v)),
+    "user_bank": (lambda u: u.bank, lambda u, v: setattr(u, "bank", v)),
+    "mine_data": (lambda u: u.mine.to_dict(), lambda u, v: setattr(u, "mine", MineState.from_dict(v))),
+    "business_data": (lambda u: u.business.to_dict(), lambda u, v: setattr(u, "business", BusinessState.from_dict(v))),
+    "user_profiles": (lambda u: u.profile.to_dict(), lambda u, v: setattr(u, "profile", ProfileState.from_dict(v))),
+    "user_donations": (lambda u: u.donations, lambda u, v: setattr(u, "donations", v)),
+    "user_premium": (lambda u: u.premium.to_dict(), lambda u, v: setattr(u, "premium", PremiumState.from_dict(v))),
+}
+
+# Уже сериализованные фрагменты снимка: раздел -> {user_id: '"id": json'}
+_snapshot_cache = {section: {} for section in USER_SECTIONS}
+_snapshot_version = 0  # номер последнего подготовленного снимка
+_written_version = 0  # номер снимка, который сейчас лежит на диске
+_snapshot_file_lock = threading.Lock()
+
+# Служебные разделы снимка: раздел -> сериализация. Пересобираются, только
+# если раздел отмечен mark_meta_dirty(); последний JSON каждого лежит в _meta_cache
+META_SECTIONS = {
+    "shard_transfers": lambda: json.dumps({"pending": pending_transfers, "applied": applied_transfers}),
+    "fsm_states": lambda: json.dumps(storage.records, ensure_ascii=False, default=str),
+    "usernames": lambda: json.dumps(username_cache.entries, ensure_ascii=False),
+    "blocked_users": lambda: json.dumps(list(blocked_users)),
+    "applied_bulks": lambda: json.dumps(list(applied_bulks)),
+}
+_meta_cache = {}  # раздел -> JSON, попавший в последнюю запись
+
+
+def mark_dirty(user_id: int):
+    dirty_users.add(user_id)
+    leaderboard.touch(user_id)
+    journal.touch(user_id)
+    save_requested.set()
+
+
+def mark_meta_dirty(section: str):
+    dirty_meta.add(section)
+    save_requested.set()
+
+
+def save_data(*user_ids):
+    """Ставит изменения в очередь на запись. Без аргументов - перезаписать всё"""
+    global dirty_all
+    if user_ids:
+        dirty_users.update(user_ids)
+        leaderboard.stale.update(user_ids)
+        for user_id in user_ids:
+            journal.touch(user_id)
+    else:
+        dirty_all = True
+    save_requested.set()
+    return True
+
+
+def _encode_record(section: str, value) -> str:
+    if section == "daily_used":
+        value = value.isoformat() if value else None
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _encode_promo(promo: dict) -> str:
+    used_by = promo["used_by"]
+    promo = {**promo, "used_by": list(used_by) if isinstance(used_by, set) else used_by}
+    return json.dumps(promo, ensure_ascii=False, default=str)
+
+
+# ---------------- ХРАНИЛИЩЕ SQLITE ----------------
+class SQLiteStore:
+    """Построчное хранилище: одна таблица на раздел, ключ - user_id (или код промокода)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()  # запись идёт из пула потоков asyncio.to_thread
+
+    def connect(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for section in USER_SECTIONS:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {section} (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+            )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS promo_codes (code TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            return not any(
+                self.conn.execute(f"SELECT 1 FROM {section} LIMIT 1").fetchone()
+                for section in USER_SECTIONS + ("promo_codes",)
+            )
+
+    def load(self) -> dict:
+        # Возвращает данные в том же виде, что и JSON-снимок
+        data = {}
+        with self.lock:
+            for section in USER_SECTIONS:
+                rows = self.conn.execute(f"SELECT user_id, data FROM {section}")
+                data[section] = {str(user_id): json.loads(value) for user_id, value in rows}
+            rows = self.conn.execute("SELECT code, data FROM promo_codes")
+            data["promo_codes"] = {code: json.loads(value) for code, value in rows}
+            for key, value in self.conn.execute("SELECT key, data FROM meta"):
+                data[key] = json.loads(value)
+        return data
+
+    def write(self, upserts: dict, deletes: dict, promos: list = None, meta: list = ()):
+        """Пишет пачку изменений одной транзакцией"""
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute("BEGIN")
+            try:
+                for section, rows in upserts.items():
+                    if rows:
+                        cur.executemany(f"INSERT OR REPLACE INTO {section} (user_id, data) VALUES (?, ?)", rows)
+                for section, keys in deletes.items():
+                    if keys:
+                        cur.executemany(f"DELETE FROM {section} WHERE user_id = ?", [(k,) for k in keys])
+                if promos is not None:
+                    cur.execute("DELETE FROM promo_codes")
+                    cur.executemany("INSERT INTO promo_codes (code, data) VALUES (?, ?)", promos)
+                if meta:
+                    cur.executemany("INSERT OR REPLACE INTO meta (key, data) VALUES (?, ?)", meta)
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+sqlite_store = SQLiteStore(DB_FILE) if STORAGE_BACKEND == "sqlite" else None
+
+
+# ---------------- ЖУРНАЛ ИЗМЕНЕНИЙ ----------------
+class Journal:
+    """Журнал изменений в формате JSONL: [seq, user_id, поле, новое значение].
+
+    Основная запись - "state": всё состояние пользователя целиком (см. touch()),
+    поэтому начисление не может восстановиться без изменения, сделанного вместе с ним.
+    Значения абсолютные, поэтому повторное применение записи ничего не ломает.
+    Снимок хранит journal_seq - после загрузки применяются только записи новее.
+
+    Пока compact() переписывает файл в пуле потоков, новые записи идут в path.next,
+    после сжатия они дописываются в основной файл.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.seq = 0
+        self.pending = {}  # user_id -> None: чьё состояние записать при ближайшем sync()
+        self.scheduled = False
+        self.compacting = False
+        self.bytes = 0  # примерный размер файла, чтобы не делать stat на каждой проверке
+
+    @property
+    def next_path(self) -> str:
+        # Шард меняет path после создания журнала
+        return self.path + ".next"
+
+    def open(self):
+        if os.path.exists(self.next_path):
+            # Бот упал во время сжатия: переносим записи, сделанные за это время
+            self._merge_next()
+            os.fsync(self.file.fileno())
+            os.remove(self.next_path)
+        else:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.bytes = os.path.getsize(self.path)
+
+    def _write(self, entry: list):
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        self.file.write(line)
+        self.bytes += len(line)
+
+    def append(self, user_id: int, field: str, value):
+        if self.file is None:
+            return
+        self.seq += 1
+        self._write([self.seq, user_id, field, value])
+        self._schedule()
+
+    def touch(self, user_id: int):
+        """Состояние пользователя попадёт в журнал, когда обработчик дойдёт до await.
+
+        Все изменения одной операции до await пишутся одной записью.
+        """
+        if self.file is None:
+            return
+        self.pending[user_id] = None
+        self._schedule()
+
+    def _schedule(self):
+        if self.scheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # вне цикла событий (запуск, остановка) запишет sync() или close()
+        self.scheduled = True
+        loop.call_soon(self.sync)
+
+    def sync(self):
+        self.scheduled = False
+        if self.file is None:
+            return
+        for user_id in self.pending:
+            self.seq += 1
+            self._write([self.seq, user_id, "state", _journal_state(user_id)])
+        self.pending.clear()
+        self.file.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(self.file.fileno())
+
+    def size(self) -> int:
+        return self.bytes
+
+    async def sync_to_disk(self):
+        """sync() и fsync в пуле потоков, даже без JOURNAL_FSYNC"""
+        if self.file is None:
+            return
+        self.sync()
+        await asyncio.to_thread(os.fsync, self.file.fileno())
+
+    def read(self, after_seq: int = 0):
+        """Записи основного файла, затем path.next.
+
+        Если бот упал, когда path.next уже частично дописан в основной файл,
+        повторы отбрасываются по seq.
+        """
+        for path in (self.path, self.next_path):
+            for entry in self._read_file(path, after_seq):
+                after_seq = entry[0]
+                yield entry
+
+    @staticmethod
+    def _read_file(path: str, after_seq: int):
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Недописанная при падении строка в конце файла
+                    logger.warning(f"⚠️ Пропущена повреждённая запись журнала: {line[:80]!r}")
+                    continue
+                if entry[0] > after_seq:
+                    yield entry
+
+    def _rewrite(self, saved_seq: int) -> tuple:
+        """Оставляет в основном файле только записи новее снимка. Выполняется в пуле потоков"""
+        tail = [json.dumps(entry, ensure_ascii=False) + "\n" for entry in self._read_file(self.path, saved_seq)]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        return len(tail), sum(len(line) for line in tail)
+
+    def _merge_next(self):
+        """Дописывает path.next в конец основного файла и открывает его для записи"""
+        with open(self.next_path, 'r', encoding='utf-8') as f:
+            extra = f.read()
+        torn = False
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+        self.file = open(self.path, 'a', encoding='utf-8')
+        if torn:
+            # Оборванная при падении строка не должна склеиться с первой записью
+            self.file.write("\n")
+        self.file.write(extra)
+        self.file.flush()
+        return len(extra)
+
+    async def compact(self, saved_seq: int):
+        """Убирает записи, которые уже попали в снимок.
+
+        Файл переписывается в пуле потоков, новые записи тем временем идут в path.next.
+        """
+        if self.file is None or self.compacting:
+            return
+        self.compacting = True
+        self.sync()
+        self.file.close()
+        self.file = open(self.next_path, 'w', encoding='utf-8')
+        kept, kept_bytes = 0, self.bytes
+        try:
+            kept, kept_bytes = await asyncio.to_thread(self._rewrite, saved_seq)
+        except OSError as e:
+            logger.error(f"❌ Не удалось сжать журнал: {e}")
+        finally:
+            self.sync()
+            self.file.close()
+            self.bytes = kept_bytes + self._merge_next()
+            self.compacting = False
+        # Пока идёт fsync, новые записи уже попадают в основной файл после перенесённых
+        await asyncio.to_thread(os.fsync, self.file.fileno())
+        os.remove(self.next_path)
+        logger.info(f"🗜 Журнал сжат до seq {saved_seq}, осталось записей: {kept}")
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+
+journal = Journal(JOURNAL_FILE)
+
+
+# Разделы снимка вне UserState, которые входят в запись "state"
+USER_DICT_SECTIONS = ("daily_used", "ranks", "user_mini_settings")
+# Записи журнала, меняющие служебные разделы снимка: поле -> раздел
+JOURNAL_META_FIELDS = {
+    "fsm": "fsm_states", "transfers": "shard_transfers", "blocked": "blocked_users", "bulk": "applied_bulks",
+}
 
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2, default=str)
 
-        logger.info("✅ Данные успешно сохранены")
+def journal_transfers():
+    # Переводов между шардами немного, поэтому пишем оба словаря целиком
+    journal.append(None, "transfers", {"pending": pending_transfers, "applied": applied_transfers})
+    mark_meta_dirty("shard_transfers")
+
+
+def _journal_state(user_id: int) -> dict:
+    """Всё состояние пользователя для записи журнала "state" """
+    state = {}
+    user = users.get(user_id)
+    if user is not None:
+        for section, (get_value, _) in STATE_SECTIONS.items():
+            if section == "user_donations" and section in lazy_sections:
+                continue  # история донатов ещё не разбиралась, значит и не менялась
+            state[section] = get_value(user)
+    for section in USER_DICT_SECTIONS:
+        value = globals()[section].get(user_id)
+        state[section] = value.isoformat() if section == "daily_used" and value else value
+    return state
+
+
+def _apply_journal_state(user_id: int, state: dict):
+    if "user_balances" in state:
+        user = ensure_user(user_id)
+        for section, (_, set_value) in STATE_SECTIONS.items():
+            if section in state:
+                set_value(user, state[section])
+    for section in USER_DICT_SECTIONS:
+        store = globals()[section]
+        value = state.get(section)
+        if value is None:
+            store.pop(user_id, None)
+        else:
+            store[user_id] = datetime.fromisoformat(value) if section == "daily_used" else value
+
+
+def replay_journal():
+    """Применяет к загруженному снимку записи журнала, сделанные после него"""
+    replayed = 0
+    for seq, user_id, field, value in journal.read(journal.seq):
+        if field == "state":
+            _apply_journal_state(user_id, value)
+        elif field == "promo":
+            load_lazy_section("promo_codes")
+            promo = promo_codes.get(value)
+            if promo is not None:
+                promo["used_by"] = set(promo["used_by"])
+                promo["used_by"].add(user_id)
+        elif field == "fsm":
+            storage.apply(*value)
+        elif field == "transfers":
+            pending_transfers.clear()
+            pending_transfers.update(value["pending"])
+            applied_transfers.clear()
+            applied_transfers.update(value["applied"])
+        elif field == "blocked":
+            if value:
+                blocked_users.add(user_id)
+            else:
+                blocked_users.discard(user_id)
+        elif field == "bulk":
+            # Массовая выдача целиком: состояния всех получателей и переводы на другие шарды
+            for state_user_id, state in value["states"].items():
+                _apply_journal_state(int(state_user_id), state)
+                mark_dirty(int(state_user_id))
+            pending_transfers.clear()
+            pending_transfers.update(value["transfers"]["pending"])
+            applied_transfers.clear()
+            applied_transfers.update(value["transfers"]["applied"])
+            dirty_meta.add("shard_transfers")
+            applied_bulks.add(value["id"])
+        else:
+            # Записи отдельных полей из журналов прошлых версий
+            setattr(ensure_user(user_id), field, value)
+        if field in JOURNAL_META_FIELDS:
+            dirty_meta.add(JOURNAL_META_FIELDS[field])
+        elif field != "promo":
+            mark_dirty(user_id)
+        journal.seq = seq
+        replayed += 1
+    if replayed:
+        logger.info(f"♻️ Восстановлено из журнала записей: {replayed}")
+    journal.open()
+
+
+def import_json_to_sqlite(json_path: str = DATA_FILE) -> bool:
+    """Разовый перенос данных из JSON-файла в SQLite; шард берёт только своих пользователей и промокоды"""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    upserts = {
+        section: [
+            (int(k), json.dumps(v, ensure_ascii=False, default=str))
+            for k, v in data.get(section, {}).items() if is_local_user(int(k))
+        ]
+        for section in USER_SECTIONS
+    }
+    promos = [
+        (code, _encode_promo(promo))
+        for code, promo in data.get("promo_codes", {}).items() if promo_shard(code) == SHARD_INDEX
+    ]
+    sqlite_store.write(upserts, {}, promos)
+    logger.info(f"📦 Импортировано из {json_path}: {len(upserts['user_balances'])} пользователей")
+    return True
+
+
+# ---------------- ЗАПИСЬ СНИМКА ----------------
+def _take_changes():
+    """Забирает очередь изменений и сериализует их на потоке event loop"""
+    global dirty_all
+    full = dirty_all
+    if full:
+        user_ids = set(users)
+        user_ids.update(daily_used, ranks, user_mini_settings)
+    else:
+        user_ids = set(dirty_users)
+    dirty_all = False
+    dirty_users.difference_update(user_ids)
+
+    # Служебные разделы сериализуем, только если они менялись; в снимок идут все из _meta_cache
+    names = [name for name in META_SECTIONS if full or name in dirty_meta or name not in _meta_cache]
+    dirty_meta.difference_update(names)
+    meta = [(name, META_SECTIONS[name]()) for name in names]
+    meta.append(("journal_seq", str(journal.seq)))
+    _meta_cache.update(meta)
+    if DATA_FILE.endswith(".bin"):
+        # Бинарный снимок собирается целиком в _prepare_binary_snapshot()
+        return full, user_ids, None, None, None, meta
+
+    upserts = {section: [] for section in USER_SECTIONS}
+    deletes = {section: [] for section in USER_SECTIONS}
+    for section in USER_SECTIONS:
+        if section in STATE_SECTIONS:
+            get_value = STATE_SECTIONS[section][0]
+            for user_id in user_ids:
+                user = users.get(user_id)
+                value = get_value(user) if user is not None else None
+                if value is not None:
+                    upserts[section].append((user_id, _encode_record(section, value)))
+                else:
+                    deletes[section].append(user_id)
+        else:
+            store = globals()[section]
+            for user_id in user_ids:
+                if user_id in store:
+                    upserts[section].append((user_id, _encode_record(section, store[user_id])))
+                else:
+                    deletes[section].append(user_id)
+    promos = [(code, _encode_promo(promo)) for code, promo in promo_codes.items()]
+    return full, user_ids, upserts, deletes, promos, meta
+
+
+def _prepare_json_snapshot(full: bool, upserts: dict, deletes: dict, promos: list, meta: list) -> tuple:
+    """Обновляет кэш фрагментов и возвращает копию снимка, которую можно писать из другого потока"""
+    global _snapshot_version
+    for section in USER_SECTIONS:
+        cache = _snapshot_cache[section]
+        if full:
+            cache.clear()
+        for user_id, value in upserts[section]:
+            cache[user_id] = f'"{user_id}": {value}'
+        for user_id in deletes[section]:
+            cache.pop(user_id, None)
+
+    _snapshot_version += 1
+    sections = [(section, list(_snapshot_cache[section].values())) for section in USER_SECTIONS]
+    return _snapshot_version, sections, promos, meta
+
+
+def _snapshot_paths() -> list:
+    # Текущий снимок и предыдущие поколения: bot_data.json, bot_data.json.1, ...
+    return [DATA_FILE] + [f"{DATA_FILE}.{i}" for i in range(1, SNAPSHOT_GENERATIONS + 1)]
+
+
+def _write_json_snapshot(version: int, sections: list, promos: list, meta: list):
+    """Пишет снимок во временный файл и атомарно подменяет им основной"""
+    parts = [f'"{section}": {{{", ".join(values)}}}' for section, values in sections]
+    promo_body = ", ".join(f'{json.dumps(code, ensure_ascii=False)}: {value}' for code, value in promos)
+    parts.append(f'"promo_codes": {{{promo_body}}}')
+    parts.extend(f'"{key}": {value}' for key, value in meta)
+    _replace_snapshot_file(version, ("{" + ", ".join(parts) + "}").encode("utf-8"))
+
+
+def _replace_snapshot_file(version: int, payload: bytes):
+    global _written_version
+    with _snapshot_file_lock:
+        if version <= _written_version:
+            return  # уже записан более свежий снимок
+        tmp_path = DATA_FILE + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Сдвигаем поколения: .1 -> .2 -> ... , текущий файл становится .1
+        paths = _snapshot_paths()
+        for older, newer in zip(reversed(paths[1:]), reversed(paths[:-1])):
+            if os.path.exists(newer):
+                os.replace(newer, older)
+        os.replace(tmp_path, DATA_FILE)
+        _written_version = version
+
+
+def _prepare_write(full: bool, upserts: dict, deletes: dict, promos: list, meta: list):
+    # Всё, что трогает состояние бота, выполняется здесь; возвращённую функцию можно звать из потока
+    if sqlite_store:
+        return partial(sqlite_store.write, upserts, deletes, promos, meta)
+    meta = list(_meta_cache.items())  # снимок переписывается целиком, нужны все разделы
+    if DATA_FILE.endswith(".bin"):
+        return partial(_write_binary_snapshot, *_prepare_binary_snapshot(meta))
+    return partial(_write_json_snapshot, *_prepare_json_snapshot(full, upserts, deletes, promos, meta))
+
+
+def _requeue(full: bool, user_ids: set, meta: list):
+    # Вернём записи в очередь, чтобы не потерять их при следующей попытке
+    global dirty_all
+    dirty_all = dirty_all or full
+    dirty_users.update(user_ids)
+    dirty_meta.update(name for name, _ in meta if name in META_SECTIONS)
+
+
+def flush_data():
+    """Записывает изменённые записи синхронно (остановка бота, межшардовые переводы)"""
+    started = time.perf_counter()
+    full, user_ids, *changes = _take_changes()
+    try:
+        write = _prepare_write(full, *changes)
+        prepared = time.perf_counter()
+        write()
+        metrics.observe("save", "prepare", prepared - started)
+        metrics.observe("save", "write", time.perf_counter() - prepared)
+        logger.info("✅ Данные успешно сохранены", extra={"sample": "save"})
         return True
     except Exception as e:
+        _requeue(full, user_ids, changes[-1])
         logger.error(f"❌ Ошибка сохранения данных: {e}")
         return False
 
 
-def load_data():
-    global user_balances, daily_used, ranks, user_accelerators, mine_data
-    global business_data, user_bank, promo_codes, user_profiles
-    global user_donations, user_premium, user_mini_settings
+# Одновременно пишется только один снимок. Кто пришёл во время записи, ждёт её
+# окончания, и следующая запись забирает изменения всех ожидавших разом.
+save_lock = asyncio.Lock()
+_flush_requested = 0
+_flush_covered = 0
+_flush_result = True
+
+
+async def flush_data_async(snapshot: bool = False):
+    """То же, что flush_data(), но файл или транзакция SQLite пишутся в пуле потоков.
+
+    JSON- и бинарный снимок переписываются целиком, поэтому без snapshot=True
+    они не пишутся: изменения уже лежат в журнале, его достаточно сбросить на диск.
+    Снимок пишут journal_compactor() и остановка бота.
+    """
+    global _flush_requested, _flush_covered, _flush_result
+    _flush_requested += 1
+    ticket = _flush_requested
+    async with save_lock:
+        if _flush_covered >= ticket and not snapshot:
+            return _flush_result  # наши изменения уже забрала запись, начатая после нас
+        _flush_covered = _flush_requested
+        if not (sqlite_store or snapshot):
+            try:
+                await journal.sync_to_disk()
+                _flush_result = True
+            except OSError as e:
+                logger.error(f"❌ Ошибка записи журнала: {e}")
+                _flush_result = False
+            return _flush_result
+        started = time.perf_counter()
+        full, user_ids, *changes = _take_changes()
+        try:
+            write = _prepare_write(full, *changes)
+            prepared = time.perf_counter()
+            metrics.observe("save", "prepare", prepared - started)  # эта часть держит цикл событий
+            await asyncio.to_thread(write)
+            metrics.observe("save", "write", time.perf_counter() - prepared)
+            logger.info("✅ Данные успешно сохранены", extra={"sample": "save"})
+            _flush_result = True
+        except Exception as e:
+            _requeue(full, user_ids, changes[-1])
+            logger.error(f"❌ Ошибка сохранения данных: {e}")
+            _flush_result = False
+        return _flush_result
+
+
+def _snapshot_candidates() -> list:
+    # Бинарный формат при первом запуске подхватывает прежний JSON-снимок
+    paths = _snapshot_paths()
+    if DATA_FILE.endswith(".bin"):
+        paths.append(os.path.splitext(DATA_FILE)[0] + ".json")
+    return paths
+
+
+def _read_snapshot() -> dict:
+    """Читает снимок; если он повреждён - берёт предыдущее поколение"""
+    for path in _snapshot_candidates():
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path, 'rb') as f:
+                blob = f.read()
+            if blob.startswith(BINARY_MAGIC):
+                data = {"binary": _parse_binary_snapshot(blob)}
+            else:
+                data = json.loads(blob)
+        except (ValueError, struct.error) as e:
+            logger.error(f"❌ Снимок {path} повреждён: {e}")
+            continue
+        if path != DATA_FILE:
+            logger.warning(f"⚠️ Данные загружены из {path}")
+        return data
+    raise ValueError("нет ни одного целого снимка")
+
+
+# ---------------- БИНАРНЫЙ СНИМОК ----------------
+# Заголовок, таблица разделов (имя, тип, длина) и сами разделы подряд.
+# Тип "q"/"d" - колонка array в порядке колонки ids, "j" - JSON.
+# Баланс, банк, ускорители и профиль лежат колонками int64; значения, которые туда
+# не помещаются (бесконечный баланс, дробные), хранятся в разделе overflow.
+# Остальные записи - JSON-списки значений, null для записи по умолчанию.
+BINARY_MAGIC = b"CGSNAP1\n"
+BINARY_MISSING = -2 ** 63
+BINARY_INT_COLUMNS = ("balance", "bank", "accelerators", "level", "xp", "next_level_xp")
+BINARY_RECORDS = {"mine": MineState, "business": BusinessState, "premium": PremiumState}
+BINARY_LAZY = ("user_donations", "promo_codes")
+
+
+def _int_column(values: list, overflow: dict) -> array:
+    try:
+        return array("q", values)
+    except (TypeError, OverflowError):
+        column = array("q")
+        for index, value in enumerate(values):
+            if type(value) is int and BINARY_MISSING < value < 2 ** 63:
+                column.append(value)
+            else:
+                column.append(BINARY_MISSING)
+                overflow[index] = value
+        return column
+
+
+def _prepare_binary_snapshot(meta: list) -> tuple:
+    """На потоке event loop только фиксирует, что писать: список игроков и копии словарей.
+
+    Колонки из них собирает _write_binary_snapshot() уже в потоке записи. Игрок,
+    изменившийся во время сборки, может попасть в снимок частично обновлённым -
+    это не страшно: его запись "state" новее journal_seq и при восстановлении
+    из журнала перепишет его целиком.
+    """
+    global _snapshot_version
+    players = list(users.items())
+    tables = {"daily_used": dict(daily_used), "ranks": dict(ranks), "user_mini_settings": dict(user_mini_settings)}
+    encoded = {"meta": "{" + ", ".join(f'"{key}": {value}' for key, value in meta) + "}"}
+    # Неразобранные ленивые разделы переписываются как есть
+    for name in BINARY_LAZY:
+        if name in lazy_sections:
+            encoded[name] = lazy_sections[name]
+    if "promo_codes" not in encoded:
+        # used_by меняется на цикле событий, поэтому промокоды кодируем здесь; их немного
+        encoded["promo_codes"] = "{" + ", ".join(
+            f'{json.dumps(code, ensure_ascii=False)}: {_encode_promo(promo)}' for code, promo in promo_codes.items()
+        ) + "}"
+
+    _snapshot_version += 1
+    return _snapshot_version, players, tables, encoded
+
+
+def _binary_columns(players: list, tables: dict, encoded: dict) -> tuple:
+    """Раскладывает игроков по колонкам; выполняется в потоке записи"""
+    users_only = [user for _, user in players]
+    columns = {"ids": array("q", [user_id for user_id, _ in players])}
+    overflow = {}
+    for name in BINARY_INT_COLUMNS:
+        overflow[name] = {}
+        owners = users_only if name in ("balance", "bank", "accelerators") else [user.profile for user in users_only]
+        columns[name] = _int_column([getattr(owner, name) for owner in owners], overflow[name])
+    daily = tables["daily_used"]
+    columns["daily_ids"] = array("q", daily)
+    columns["daily_at"] = array("d", [at.timestamp() if at else float("nan") for at in daily.values()])
+
+    records = {}
+    for name, record_class in BINARY_RECORDS.items():
+        default = record_class().values()
+        values = records[name] = []
+        for user in users_only:
+            record = getattr(user, name).values()
+            values.append(None if record == default else record)
+
+    encoded = dict(encoded)
+    encoded["overflow"] = json.dumps(overflow, default=str)
+    encoded["ranks"] = json.dumps(tables["ranks"], ensure_ascii=False)
+    encoded["user_mini_settings"] = json.dumps(tables["user_mini_settings"], ensure_ascii=False)
+    if "user_donations" not in encoded:
+        encoded["user_donations"] = json.dumps(
+            {user_id: user._donations for user_id, user in players if user._donations is not None},
+            ensure_ascii=False, default=str
+        )
+    return columns, records, encoded
+
+
+def _write_binary_snapshot(version: int, players: list, tables: dict, encoded: dict):
+    columns, records, encoded = _binary_columns(players, tables, encoded)
+    sections = [(name, column.typecode, column.tobytes()) for name, column in columns.items()]
+    sections += [(name, "j", json.dumps(values, default=str).encode("utf-8")) for name, values in records.items()]
+    sections += [
+        (name, "j", value if isinstance(value, bytes) else value.encode("utf-8"))
+        for name, value in encoded.items()
+    ]
 
-    if not os.path.exists(DATA_FILE):
+    chunks = [BINARY_MAGIC, struct.pack("<I", len(sections))]
+    for name, typecode, payload in sections:
+        name_bytes = name.encode("utf-8")
+        chunks.append(struct.pack("<H", len(name_bytes)) + name_bytes + struct.pack("<cQ", typecode.encode(), len(payload)))
+    chunks.extend(payload for _, _, payload in sections)
+    _replace_snapshot_file(version, b"".join(chunks))
+
+
+def _parse_binary_snapshot(blob: bytes) -> dict:
+    """Разбирает таблицу разделов; колонки сразу читаются в array, JSON - пока байтами"""
+    view = memoryview(blob)
+    pos = len(BINARY_MAGIC)
+    (count,) = struct.unpack_from("<I", blob, pos)
+    pos += 4
+    table = []
+    for _ in range(count):
+        (name_len,) = struct.unpack_from("<H", blob, pos)
+        pos += 2
+        name = bytes(view[pos:pos + name_len]).decode("utf-8")
+        pos += name_len
+        typecode, length = struct.unpack_from("<cQ", blob, pos)
+        pos += 9
+        table.append((name, typecode.decode(), length))
+
+    sections = {}
+    for name, typecode, length in table:
+        chunk = view[pos:pos + length]
+        pos += length
+        if len(chunk) != length:
+            raise ValueError(f"раздел {name} обрезан")
+        if typecode == "j":
+            sections[name] = bytes(chunk)
+        else:
+            column = array(typecode)
+            column.frombytes(chunk)
+            if sys.byteorder != "little":
+                column.byteswap()
+            sections[name] = column
+    return sections
+
+
+def _apply_binary_snapshot(sections: dict) -> dict:
+    """Заполняет users и daily_used из колонок; возвращает остальные разделы в виде JSON-снимка"""
+    overflow = json.loads(sections["overflow"])
+    columns = []
+    for name in BINARY_INT_COLUMNS:
+        column = sections[name]
+        fixes = overflow.get(name)
+        if fixes:
+            column = column.tolist()
+            for index, value in fixes.items():
+                column[int(index)] = value
+        columns.append(column)
+    records = [
+        [record_class() if values is None else record_class.from_values(values) for values in json.loads(sections[name])]
+        for name, record_class in BINARY_RECORDS.items()
+    ]
+
+    rows = zip(sections["ids"], *columns, *records)
+    for user_id, balance, bank, accelerators, level, xp, next_level_xp, mine, business, premium in rows:
+        user = UserState.__new__(UserState)
+        user.balance = balance
+        user.bank = bank
+        user.accelerators = accelerators
+        user.profile = profile = ProfileState()
+        profile.level = level
+        profile.xp = xp
+        profile.next_level_xp = next_level_xp
+        user.mine = mine
+        user.business = business
+        user.premium = premium
+        user._donations = None
+        users[user_id] = user
+
+    for user_id, at in zip(sections["daily_ids"], sections["daily_at"]):
+        daily_used[user_id] = datetime.fromtimestamp(at) if at == at else None
+
+    for name in BINARY_LAZY:
+        lazy_sections[name] = sections[name]
+
+    data = json.loads(sections["meta"])
+    data["ranks"] = json.loads(sections["ranks"])
+    data["user_mini_settings"] = json.loads(sections["user_mini_settings"])
+    return data
+
+
+def load_lazy_section(name: str):
+    """Разбирает раздел бинарного снимка, отложенный при загрузке"""
+    global promo_codes
+    raw = lazy_sections.pop(name, None)
+    if raw is None:
+        return
+    value = json.loads(raw)
+    if name == "user_donations":
+        for k, v in value.items():
+            user = users.get(int(k))
+            if user is not None:
+                user._donations = v
+    elif name == "promo_codes":
+        promo_codes = _decode_promo_codes(value)
+
+
+def _decode_promo_codes(promo_codes_data: dict) -> dict:
+    promos = {}
+    for code, promo in promo_codes_data.items():
+        promo_copy = promo.copy()
+        if isinstance(promo_copy.get("used_by"), list):
+            promo_copy["used_by"] = set(promo_copy["used_by"])
+        promos[code] = promo_copy
+    return promos
+
+
+def load_data():
+    global ranks, promo_codes, user_mini_settings
+    global dirty_all
+
+    if sqlite_store:
+        sqlite_store.connect()
+        if sqlite_store.is_empty() and os.path.exists(DATA_FILE):
+            import_json_to_sqlite(DATA_FILE)
+    elif not any(os.path.exists(path) for path in _snapshot_candidates()):
         logger.info("📁 Файл данных не найден, создаем новый")
         return False
 
     try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        user_balances = {int(k): v for k, v in data.get("user_balances", {}).items()}
+        if sqlite_store:
+            data = sqlite_store.load()
+        else:
+            data = _read_snapshot()
+
+        users.clear()
+        lazy_sections.clear()
+        if "binary" in data:
+            data = _apply_binary_snapshot(data["binary"])
+        for section, (_, set_value) in STATE_SECTIONS.items():
+            for k, v in data.get(section, {}).items():
+                user_id = int(k)
+                user = users.get(user_id)
+                if user is None:
+                    user = users[user_id] = UserState()
+                set_value(user, v)
 
         daily_used_data = data.get("daily_used", {})
         for k, v in daily_used_data.items():
@@ -174,24 +1661,26 @@ def load_data():
                     daily_used[int(k)] = None
 
         ranks = {int(k): v for k, v in data.get("ranks", {}).items()}
-        user_accelerators = {int(k): v for k, v in data.get("user_accelerators", {}).items()}
-        mine_data = {int(k): v for k, v in data.get("mine_data", {}).items()}
-        business_data = {int(k): v for k, v in data.get("business_data", {}).items()}
-        user_bank = {int(k): v for k, v in data.get("user_bank", {}).items()}
-
-        promo_codes_data = data.get("promo_codes", {})
-        promo_codes = {}
-        for code, promo in promo_codes_data.items():
-            promo_copy = promo.copy()
-            if isinstance(promo_copy.get("used_by"), list):
-                promo_copy["used_by"] = set(promo_copy["used_by"])
-            promo_codes[code] = promo_copy
-
-        user_profiles = {int(k): v for k, v in data.get("user_profiles", {}).items()}
-        user_donations = {int(k): v for k, v in data.get("user_donations", {}).items()}
-        user_premium = {int(k): v for k, v in data.get("user_premium", {}).items()}
+
+        promo_codes = _decode_promo_codes(data.get("promo_codes", {}))
+
         user_mini_settings = {int(k): v for k, v in data.get("user_mini_settings", {}).items()}
 
+        transfers = data.get("shard_transfers", {})
+        pending_transfers.update(transfers.get("pending", {}))
+        applied_transfers.update(transfers.get("applied", {}))
+
+        # Незавершённые FSM-сценарии (например, рулетка со списанной ставкой) переживают перезапуск
+        storage.restore(data.get("fsm_states", {}))
+        journal.seq = int(data.get("journal_seq", 0))
+        username_cache.restore(data.get("usernames", {}))
+        blocked_users.update(data.get("blocked_users", []))
+        applied_bulks.update(data.get("applied_bulks", []))
+
+        if sqlite_store:
+            # База уже содержит все строки, полная перезапись не нужна
+            dirty_all = False
+
         logger.info("✅ Данные успешно загружены")
         return True
     except Exception as e:
@@ -200,13 +1689,130 @@ def load_data():
 
 
 # ---------------- АВТОСОХРАНЕНИЕ ----------------
+async def persistence_worker():
+    # Склеиваем изменения за SAVE_DELAY секунд в одну запись
+    while True:
+        await save_requested.wait()
+        await asyncio.sleep(SAVE_DELAY)
+        save_requested.clear()
+        await flush_data_async()
+
+
 async def auto_save():
     while True:
         await asyncio.sleep(300)  # 5 минут
-        save_data()
+        await flush_data_async()
+
+
+async def fsm_sweeper():
+    # Удаляем заброшенные FSM-состояния; ставку рулетки, списанную заранее, возвращаем
+    while True:
+        await asyncio.sleep(60)
+        try:
+            sweep_fsm_states()
+        except Exception as e:
+            logger.error(f"❌ Ошибка очистки FSM-состояний: {e}")
+
+
+def sweep_fsm_states():
+    for record in storage.pop_expired():
+        user_id = record.get("user_id")
+        try:
+            bet = record["data"].get("bet", 0)
+            if record["state"] == RouletteStates.waiting_for_number.state and bet > 0:
+                # Возврат ставки, а не выигрыш: без опыта и наград за уровень
+                grant_balance(user_id, bet)
+                logger.info(f"⌛ Рулетка {user_id} брошена, ставка {bet:,} возвращена")
+        except Exception as e:
+            logger.error(f"❌ Ошибка возврата ставки {user_id}: {e}")
+
+
+async def journal_compactor():
+    # Записываем снимок и выкидываем из журнала всё, что в него вошло: раз в
+    # JOURNAL_COMPACT_INTERVAL или раньше, если журнал дорос до JOURNAL_MAX_BYTES
+    last = time.monotonic()
+    while True:
+        await asyncio.sleep(5)
+        if time.monotonic() - last < JOURNAL_COMPACT_INTERVAL and journal.size() < JOURNAL_MAX_BYTES:
+            continue
+        last = time.monotonic()
+        saved_seq = journal.seq
+        if await flush_data_async(snapshot=True):
+            await journal.compact(saved_seq)
 
 
 # ---------------- ДЕКОРАТОР ДЛЯ RATE LIMITING ----------------
+class RateLimiter:
+    """Время последнего вызова (user_id, команда) с удалением по истечении окна.
+
+    Ключи раскладываются по слотам колеса таймеров по времени истечения,
+    поэтому sweep() просматривает только истёкшие слоты, а не всех пользователей.
+    """
+
+    def __init__(self, slot_seconds: float = 1.0, slots: int = 64):
+        self.slot_seconds = slot_seconds
+        self.wheel = [[] for _ in range(slots)]
+        self.last_call = {}  # (user_id, команда) -> время вызова
+        self.expires = {}  # (user_id, команда) -> время истечения окна
+        self.swept_tick = int(time.monotonic() / slot_seconds)
+        self.allowed = Counter()
+        self.throttled = Counter()
+
+    def hit(self, user_id: int, command: str, seconds: float) -> bool:
+        now = time.monotonic()
+        key = (user_id, command)
+        last_call = self.last_call.get(key)
+        if last_call is not None and now - last_call < seconds:
+            self.throttled[command] += 1
+            return False
+
+        expires = now + seconds
+        self.last_call[key] = now
+        self.expires[key] = expires
+        self._schedule(key, expires)
+        self.allowed[command] += 1
+        return True
+
+    def _schedule(self, key, expires: float):
+        tick = max(int(expires / self.slot_seconds) + 1, self.swept_tick + 1)
+        self.wheel[tick % len(self.wheel)].append((key, expires))
+
+    def sweep(self):
+        now = time.monotonic()
+        now_tick = int(now / self.slot_seconds)
+        # За один проход колесо делает не больше одного оборота
+        first_tick = max(self.swept_tick + 1, now_tick - len(self.wheel) + 1)
+        for tick in range(first_tick, now_tick + 1):
+            slot = self.wheel[tick % len(self.wheel)]
+            if not slot:
+                continue
+            self.wheel[tick % len(self.wheel)] = []
+            for key, expires in slot:
+                if self.expires.get(key) != expires:
+                    continue  # окно было продлено, запись устарела
+                if expires > now:
+                    self._schedule(key, expires)  # окно длиннее оборота колеса
+                    continue
+                del self.expires[key]
+                del self.last_call[key]
+        self.swept_tick = now_tick
+
+    def stats(self) -> dict:
+        return {
+            command: {"allowed": self.allowed[command], "throttled": self.throttled[command]}
+            for command in self.allowed.keys() | self.throttled.keys()
+        }
+
+
+rate_limiter = RateLimiter()
+
+
+async def rate_limit_sweeper():
+    while True:
+        await asyncio.sleep(rate_limiter.slot_seconds)
+        rate_limiter.sweep()
+
+
 def rate_limit(seconds: int = 1):
     def decorator(func):
         @wraps(func)
@@ -214,53 +1820,368 @@ def rate_limit(seconds: int = 1):
             if not message or not message.from_user:
                 return await func(message, *args, **kwargs)
 
-            user_id = message.from_user.id
-            now = time.time()
-            command = func.__name__
+            if not rate_limiter.hit(message.from_user.id, func.__name__, seconds):
+                return None
+            return await func(message, *args, **kwargs)
 
-            if user_id not in user_last_command:
-                user_last_command[user_id] = {}
+        return wrapper
 
-            if command in user_last_command[user_id]:
-                last_call = user_last_command[user_id][command]
-                if now - last_call < seconds:
-                    return None
+    return decorator
 
-            user_last_command[user_id][command] = now
-            return await func(message, *args, **kwargs)
+
+# ---------------- БЛОКИРОВКИ ПОЛЬЗОВАТЕЛЕЙ ----------------
+class UserLocks:
+    """asyncio.Lock на каждого пользователя для проверки баланса и списания, разделённых await.
+
+    Блокировка создаётся при первом запросе и живёт, пока её держат или ждут
+    (WeakValueDictionary). Несколько пользователей блокируются по возрастанию
+    user_id, поэтому встречные переводы не могут заблокировать друг друга.
+    """
+
+    def __init__(self):
+        self.locks = weakref.WeakValueDictionary()
+        self.acquired = Counter()  # операция -> захватов
+        self.contended = Counter()  # операция -> захватов с ожиданием
+        self.wait_total = Counter()  # операция -> суммарное ожидание, сек
+        self.wait_max = {}  # операция -> самое долгое ожидание, сек
+
+    def get(self, user_id: int) -> asyncio.Lock:
+        lock = self.locks.get(user_id)
+        if lock is None:
+            lock = self.locks[user_id] = asyncio.Lock()
+        return lock
+
+    @asynccontextmanager
+    async def hold(self, *user_ids: int, name: str = "other"):
+        locks = [self.get(user_id) for user_id in sorted(set(user_ids))]
+        held = []
+        try:
+            for lock in locks:
+                if lock.locked():
+                    self.contended[name] += 1
+                    started = time.monotonic()
+                    await lock.acquire()
+                    waited = time.monotonic() - started
+                    self.wait_total[name] += waited
+                    self.wait_max[name] = max(self.wait_max.get(name, 0), waited)
+                else:
+                    await lock.acquire()
+                held.append(lock)
+            self.acquired[name] += 1
+            yield
+        finally:
+            for lock in reversed(held):
+                lock.release()
+
+    def stats(self) -> dict:
+        return {
+            "live_locks": len(self.locks),
+            "operations": {
+                name: {
+                    "acquired": self.acquired[name],
+                    "contended": self.contended[name],
+                    "wait_ms_total": round(self.wait_total[name] * 1000, 1),
+                    "wait_ms_max": round(self.wait_max.get(name, 0) * 1000, 1),
+                }
+                for name in self.acquired
+            },
+        }
+
+
+user_locks = UserLocks()
+
+
+def user_locked(name: str):
+    """Обработчик выполняется под блокировкой отправителя события"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(event, *args, **kwargs):
+            async with user_locks.hold(event.from_user.id, name=name):
+                return await func(event, *args, **kwargs)
 
         return wrapper
 
     return decorator
 
 
+# ---------------- ПОИСК ПО USERNAME ----------------
+class UsernameCache:
+    """username -> user_id с вытеснением по LRU и сроку жизни.
+
+    None вместо user_id - username, который get_chat не нашёл (негативный кэш).
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # username -> [user_id, истекает]
+        self.names = {}  # user_id -> username, для подписей в топе
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(username: str) -> str:
+        return username.lstrip("@").lower()
+
+    def remember(self, username: str, user_id: Optional[int]):
+        key = self.normalize(username)
+        entry = self.entries.get(key)
+        expires = time.time() + (USERNAME_TTL if user_id is not None else USERNAME_MISS_TTL)
+        if entry is not None and entry[0] == user_id:
+            entry[1] = expires
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = [user_id, expires]
+        self.entries.move_to_end(key)
+        if user_id is not None:
+            self.names[user_id] = key
+        while len(self.entries) > self.capacity:
+            old_key, (old_id, _) = self.entries.popitem(last=False)
+            if self.names.get(old_id) == old_key:
+                del self.names[old_id]
+        mark_meta_dirty("usernames")
+
+    def lookup(self, username: str, max_age: Optional[int] = None):
+        """Возвращает (найдено ли в кэше, user_id или None).
+
+        max_age - сколько секунд назад username должен был подтвердиться у этого
+        user_id; более старая запись считается промахом (имя могли передать другому).
+        """
+        key = self.normalize(username)
+        entry = self.entries.get(key)
+        now = time.time()
+        if entry is None or entry[1] < now:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return False, None
+        if max_age is not None and entry[0] is not None and entry[1] - USERNAME_TTL < now - max_age:
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[0]
+
+    def restore(self, entries: dict):
+        now = time.time()
+        self.entries = OrderedDict(
+            (key, entry) for key, entry in sorted(entries.items(), key=lambda item: item[1][1]) if entry[1] > now
+        )
+        self.names = {user_id: key for key, (user_id, _) in self.entries.items() if user_id is not None}
+
+
+username_cache = UsernameCache(USERNAME_CACHE_SIZE)
+
+
+@dp.update.outer_middleware()
+async def username_middleware(handler, event: Update, data: dict):
+    # Запоминаем username каждого, кто пишет боту, - /p @user обойдётся без запроса к API
+    user = data.get("event_from_user")
+    if user is not None and user.username:
+        username_cache.remember(user.username, user.id)
+    # Кто снова пишет боту, тот его разблокировал
+    if user is not None and user.id in blocked_users:
+        blocked_users.discard(user.id)
+        journal.append(user.id, "blocked", False)
+        mark_meta_dirty("blocked_users")
+    return await handler(event, data)
+
+
+async def resolve_username(username: str, max_age: Optional[int] = None) -> int:
+    cached, user_id = username_cache.lookup(username, max_age)
+    if not cached:
+        try:
+            chat = await bot.get_chat(username)
+            user_id = chat.id
+        except TelegramBadRequest:
+            user_id = None
+        username_cache.remember(username, user_id)
+    if user_id is None:
+        raise LookupError(f"Пользователь {username} не найден")
+    return user_id
+
+
+# ---------------- ТАБЛИЦА ЛИДЕРОВ ----------------
+class SortedIndex:
+    """Игроки по убыванию очков. Ключи лежат в отсортированных кусках до 2 * LOAD
+    элементов, maxes - последний ключ каждого куска: вставка и удаление двигают
+    только один кусок, а не весь список, как bisect.insort"""
+
+    LOAD = 512
+
+    def __init__(self):
+        self.lists = []  # куски (очки со знаком минус, user_id) по возрастанию
+        self.maxes = []  # последний ключ каждого куска
+        self.scores = {}  # user_id -> очки
+
+    @staticmethod
+    def make_key(user_id: int, score: tuple) -> tuple:
+        return tuple(-part for part in score), user_id
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def update(self, user_id: int, score: tuple):
+        old = self.scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            self.remove(user_id)
+        self.scores[user_id] = score
+        self._insert(self.make_key(user_id, score))
+
+    def _insert(self, key: tuple):
+        if not self.lists:
+            self.lists.append([key])
+            self.maxes.append(key)
+            return
+        pos = bisect.bisect_left(self.maxes, key)
+        if pos == len(self.maxes):
+            pos -= 1
+            self.lists[pos].append(key)
+            self.maxes[pos] = key
+        else:
+            bisect.insort(self.lists[pos], key)
+        chunk = self.lists[pos]
+        if len(chunk) > 2 * self.LOAD:
+            # Переполненный кусок делим пополам
+            self.lists.insert(pos + 1, chunk[self.LOAD:])
+            del chunk[self.LOAD:]
+            self.maxes.insert(pos, chunk[-1])
+
+    def remove(self, user_id: int):
+        score = self.scores.pop(user_id, None)
+        if score is None:
+            return
+        key = self.make_key(user_id, score)
+        pos = bisect.bisect_left(self.maxes, key)
+        chunk = self.lists[pos]
+        del chunk[bisect.bisect_left(chunk, key)]
+        if chunk:
+            self.maxes[pos] = chunk[-1]
+        else:
+            del self.lists[pos]
+            del self.maxes[pos]
+
+    def rank(self, user_id: int) -> Optional[int]:
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+        key = self.make_key(user_id, score)
+        pos = bisect.bisect_left(self.maxes, key)
+        before = sum(len(chunk) for chunk in self.lists[:pos])
+        return before + bisect.bisect_left(self.lists[pos], key) + 1
+
+    def top(self, count: int) -> list:
+        result = []
+        for chunk in self.lists:
+            for _, user_id in chunk[:count - len(result)]:
+                result.append((user_id, self.scores[user_id]))
+            if len(result) >= count:
+                break
+        return result
+
+    def rebuild(self, scores: dict):
+        self.scores = scores
+        keys = sorted(self.make_key(user_id, score) for user_id, score in scores.items())
+        self.lists = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self.maxes = [chunk[-1] for chunk in self.lists]
+
+
+# Рейтинг -> (заголовок, очки игрока). Очки - кортеж, первое число показывается в топе
+def mine_score(user: UserState) -> tuple:
+    # Авто-сбор начисляется лениво (accrue_mine), поэтому накопленное досчитываем здесь,
+    # не меняя рудник: иначе обновление рейтинга само отмечало бы игрока изменённым
+    mine = user.mine
+    resources = mine.resources
+    if mine.auto_collect and mine.last_accrual:
+        resources += MINE_AUTO_RATE * max(int(time.time() - mine.last_accrual), 0)
+    level = min(max(mine.level, 0), max(MINE_LEVELS))
+    return resources * MINE_LEVELS[level]["price_per_unit"], mine.level
+
+
+LEADERBOARDS = {
+    "money": ("💰 Самые богатые", lambda u: (u.balance + u.bank,)),
+    "level": ("⭐ Самые опытные", lambda u: (u.profile.level, u.profile.xp)),
+    "mine": ("⛏️ Самые ценные рудники", mine_score),
+}
+
+
+class Leaderboard:
+    """Рейтинги игроков. mark_dirty() отмечает игрока, индексы догоняет leaderboard_refresher()
+    небольшими шагами; /top видит их с задержкой до LEADERBOARD_REFRESH_INTERVAL"""
+
+    def __init__(self):
+        self.indexes = {name: SortedIndex() for name in LEADERBOARDS}
+        self.stale = set()
+
+    def touch(self, user_id: int):
+        self.stale.add(user_id)
+
+    @staticmethod
+    def ranked(user_id: int, user: Optional[UserState]) -> bool:
+        # Бесконечный баланс и админы в рейтинг не попадают
+        if user is None or not isinstance(user.balance, (int, float)):
+            return False
+        return not is_admin(user_id) and ranks.get(user_id) != "Admin"
+
+    def refresh_user(self, user_id: int):
+        self.stale.discard(user_id)
+        user = users.get(user_id)
+        ranked = self.ranked(user_id, user)
+        for name, index in self.indexes.items():
+            if ranked:
+                index.update(user_id, LEADERBOARDS[name][1](user))
+            else:
+                index.remove(user_id)
+
+    def refresh(self, limit: Optional[int] = None) -> int:
+        """Обновляет до limit отмеченных игроков (все, если limit не задан)"""
+        count = len(self.stale) if limit is None else min(limit, len(self.stale))
+        for _ in range(count):
+            self.refresh_user(self.stale.pop())
+        return count
+
+    def rebuild(self):
+        ranked = [(user_id, user) for user_id, user in users.items() if self.ranked(user_id, user)]
+        for name, index in self.indexes.items():
+            score = LEADERBOARDS[name][1]
+            index.rebuild({user_id: score(user) for user_id, user in ranked})
+        self.stale.clear()
+
+    def top(self, name: str, count: int = 10) -> list:
+        return self.indexes[name].top(count)
+
+    def rank(self, name: str, user_id: int) -> Optional[int]:
+        # Своё место игрок видит с учётом последних изменений
+        if user_id in self.stale:
+            self.refresh_user(user_id)
+        return self.indexes[name].rank(user_id)
+
+
+async def leaderboard_refresher():
+    while True:
+        await asyncio.sleep(LEADERBOARD_REFRESH_INTERVAL)
+        while leaderboard.refresh(LEADERBOARD_REFRESH_BATCH):
+            await asyncio.sleep(0)
+
+
+leaderboard = Leaderboard()
+
+
 # ---------------- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ----------------
-def ensure_user(user_id: int):
-    if user_id not in user_balances:
-        user_balances[user_id] = START_BALANCE
-    if user_id not in user_accelerators:
-        user_accelerators[user_id] = START_ACCELERATORS
-    if user_id not in mine_data:
-        mine_data[user_id] = {"level": 0, "resources": 0, "auto_collect": False}
-    if user_id not in business_data:
-        business_data[user_id] = {"type": None, "profit": 0, "active": False, "last_collect": None}
-    if user_id not in user_bank:
-        user_bank[user_id] = 0
-    if user_id not in user_profiles:
-        user_profiles[user_id] = {"level": 1, "xp": 0, "next_level_xp": 100}
-    if user_id not in user_donations:
-        user_donations[user_id] = {"total_stars": 0, "total_coins": 0, "transactions": []}
-    if user_id not in user_premium:
-        user_premium[user_id] = {"type": None, "expires": None, "purchased_at": None}
+def ensure_user(user_id: int) -> UserState:
+    user = users.get(user_id)
+    if user is None:
+        user = users[user_id] = UserState()
+        mark_dirty(user_id)
+    return user
 
 
 def get_premium_status(user_id: int) -> str:
-    ensure_user(user_id)
-    premium = user_premium[user_id]
+    premium = ensure_user(user_id).premium
 
-    if premium["type"] == "deluxe":
+    if premium.type == "deluxe":
         return "Делюкс"
-    elif premium["type"] == "elite":
+    elif premium.type == "elite":
         return "Элит"
     else:
         return "Обычный"
@@ -277,11 +2198,13 @@ def get_daily_bonus(user_id: int) -> tuple:
 
 
 def get_balance(user_id: int):
-    return user_balances.get(user_id, START_BALANCE)
+    user = users.get(user_id)
+    return user.balance if user is not None else START_BALANCE
 
 
 def has_infinite_balance(user_id: int) -> bool:
-    return user_balances.get(user_id) == INFINITE_BALANCE
+    user = users.get(user_id)
+    return user is not None and user.balance == INFINITE_BALANCE
 
 
 def format_balance(user_id: int) -> str:
@@ -294,7 +2217,8 @@ def format_balance(user_id: int) -> str:
 
 
 def format_bank_balance(user_id: int) -> str:
-    balance = user_bank.get(user_id, 0)
+    user = users.get(user_id)
+    balance = user.bank if user is not None else 0
     return f"{balance:,}"
 
 
@@ -308,31 +2232,52 @@ def can_spend(user_id: int, amount: int) -> bool:
 
 
 def spend_balance(user_id: int, amount: int):
-    if has_infinite_balance(user_id):
-        return
-    if user_id in user_balances and isinstance(user_balances[user_id], (int, float)):
-        user_balances[user_id] -= amount
+    user = users.get(user_id)
+    if user is not None and isinstance(user.balance, (int, float)):
+        user.balance -= amount
+        mark_dirty(user_id)
 
 
 def add_balance(user_id: int, amount: int):
     if has_infinite_balance(user_id):
         return
-    if user_id not in user_balances:
-        user_balances[user_id] = START_BALANCE + amount
+    mark_dirty(user_id)
+    user = users.get(user_id)
+    if user is None:
+        user = ensure_user(user_id)
+        user.balance = START_BALANCE + amount
     else:
-        if isinstance(user_balances[user_id], (int, float)):
-            user_balances[user_id] += amount
+        if isinstance(user.balance, (int, float)):
+            user.balance += amount
         else:
-            user_balances[user_id] = START_BALANCE + amount
+            user.balance = START_BALANCE + amount
         add_xp(user_id, amount // 100)
 
 
+def grant_balance(user_id: int, amount: int):
+    """Зачисление без опыта и наград за уровень (массовая выдача, возврат ставок)"""
+    user = ensure_user(user_id)
+    if isinstance(user.balance, (int, float)):
+        user.balance += amount
+        mark_dirty(user_id)
+
+
 def set_infinite_balance(user_id: int):
-    user_balances[user_id] = INFINITE_BALANCE
+    require_local_user(user_id)
+    ensure_user(user_id).balance = INFINITE_BALANCE
+    mark_dirty(user_id)
 
 
 def remove_infinite_balance(user_id: int):
-    user_balances[user_id] = START_BALANCE
+    require_local_user(user_id)
+    ensure_user(user_id).balance = START_BALANCE
+    mark_dirty(user_id)
+
+
+def require_local_user(user_id: int):
+    # Запись в чужого пользователя пропала бы: при запуске шард оставляет только своих
+    if not is_local_user(user_id):
+        raise ValueError(f"пользователь {user_id} обслуживается шардом {shard_of(user_id)}")
 
 
 def is_admin(user_id: int) -> bool:
@@ -350,7 +2295,8 @@ def has_rank(user_id: int, required_rank: str = None) -> bool:
     elif required_rank == "moderator":
         return user_rank in ["moderator", "Admin"]
     elif required_rank in ["elite", "deluxe"]:
-        return user_premium.get(user_id, {}).get("type") == required_rank
+        user = users.get(user_id)
+        return user is not None and user.premium.type == required_rank
     return False
 
 
@@ -366,42 +2312,89 @@ def get_user_status(user_id: int) -> str:
 
 
 def can_work(user_id: int) -> bool:
-    return user_accelerators.get(user_id, 0) > 0 or has_infinite_balance(user_id)
+    user = users.get(user_id)
+    return (user is not None and user.accelerators > 0) or has_infinite_balance(user_id)
 
 
 def use_accelerator(user_id: int, amount: int = 1):
     if has_infinite_balance(user_id):
         return
-    if user_accelerators.get(user_id, 0) >= amount:
-        user_accelerators[user_id] = user_accelerators.get(user_id, 0) - amount
+    user = users.get(user_id)
+    if user is not None and user.accelerators >= amount:
+        user.accelerators -= amount
+        mark_dirty(user_id)
 
 
 def add_accelerator(user_id: int, amount: int):
-    user_accelerators[user_id] = user_accelerators.get(user_id, 0) + amount
+    user = ensure_user(user_id)
+    user.accelerators += amount
+    mark_dirty(user_id)
 
 
 def add_xp(user_id: int, xp_amount: int):
-    if user_id not in user_profiles:
-        user_profiles[user_id] = {"level": 1, "xp": 0, "next_level_xp": 100}
+    profile = ensure_user(user_id).profile
     if xp_amount <= 0:
         return
-    user_profiles[user_id]["xp"] += xp_amount
-
-    while user_profiles[user_id]["xp"] >= user_profiles[user_id]["next_level_xp"]:
-        user_profiles[user_id]["level"] += 1
-        user_profiles[user_id]["xp"] -= user_profiles[user_id]["next_level_xp"]
-        user_profiles[user_id]["next_level_xp"] = user_profiles[user_id]["next_level_xp"] * 2
-        reward = user_profiles[user_id]["level"] * 1000
+    profile.xp += xp_amount
+    mark_dirty(user_id)
+
+    while profile.xp >= profile.next_level_xp:
+        profile.level += 1
+        profile.xp -= profile.next_level_xp
+        profile.next_level_xp = profile.next_level_xp * 2
+        reward = profile.level * 1000
         add_balance(user_id, reward)
-        add_accelerator(user_id, user_profiles[user_id]["level"] * 5)
+        add_accelerator(user_id, profile.level * 5)
+
+
+def accrue_mine(user_id: int) -> MineState:
+    """Начисляет ресурсы авто-сбора за время с последнего обращения"""
+    mine = ensure_user(user_id).mine
+    now = time.time()
+    last = mine.last_accrual
+    if mine.auto_collect and last:
+        seconds = int(now - last)
+        if seconds > 0:
+            mine.resources += MINE_AUTO_RATE * seconds
+            mine.last_accrual = last + seconds
+            mark_dirty(user_id)
+    else:
+        mine.last_accrual = now
+    return mine
+
+
+def accrue_business(user_id: int) -> BusinessState:
+    """Начисляет прибыль бизнеса за полные периоды с последнего начисления"""
+    business = ensure_user(user_id).business
+    if not (business.type and business.active):
+        return business
+
+    biz_info = BUSINESS_TYPES[business.type]
+    now = datetime.now()
+    last = business.last_collect
+    if isinstance(last, str):
+        # После загрузки из файла дата хранится строкой
+        try:
+            last = datetime.fromisoformat(last)
+        except ValueError:
+            last = None
+
+    if last:
+        cycles = int((now - last).total_seconds() // biz_info["profit_period"])
+        if cycles > 0:
+            business.profit += biz_info["base_profit"] * cycles
+            last += timedelta(seconds=cycles * biz_info["profit_period"])
+            mark_dirty(user_id)
+        business.last_collect = last
+    else:
+        business.last_collect = now
+    return business
 
 
 def get_mine_info(user_id: int) -> str:
-    if user_id not in mine_data:
-        ensure_user(user_id)
-    mine = mine_data.get(user_id, {"level": 0, "resources": 0, "auto_collect": False})
+    mine = accrue_mine(user_id)
 
-    level = mine["level"]
+    level = mine.level
     if level > 2:
         level = 2
 
@@ -409,10 +2402,10 @@ def get_mine_info(user_id: int) -> str:
 
     info = f"⛏️ {level_info['name']}\n"
     info += f"Ресурс: {level_info['resource']}\n"
-    info += f"Количество: {mine['resources']:,}\n"
+    info += f"Количество: {mine.resources:,}\n"
     info += f"Стоимость: {level_info['price_per_unit']} монет за 1 ед.\n"
-    info += f"Общая стоимость: {mine['resources'] * level_info['price_per_unit']:,} монет\n"
-    info += f"Авто-сбор: {'✅ Вкл' if mine['auto_collect'] else '❌ Выкл'}\n"
+    info += f"Общая стоимость: {mine.resources * level_info['price_per_unit']:,} монет\n"
+    info += f"Авто-сбор: {'✅ Вкл' if mine.auto_collect else '❌ Выкл'}\n"
 
     if level < 2:
         next_level = MINE_LEVELS[level + 1]
@@ -425,6 +2418,24 @@ def get_mine_info(user_id: int) -> str:
 
 
 # ---------------- КЛАВИАТУРЫ ----------------
+# Разметка не меняется, поэтому каждая клавиатура строится один раз на набор параметров
+_keyboards = {}  # (имя, параметры) -> разметка
+
+
+def cached_keyboard(factory):
+    @wraps(factory)
+    def wrapper(*params):
+        key = (factory.__name__, params)
+        markup = _keyboards.get(key)
+        if markup is None:
+            markup = _keyboards[key] = factory(*params)
+            keyboard_json[id(markup)] = None
+        return markup
+
+    return wrapper
+
+
+@cached_keyboard
 def main_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.row(
@@ -444,11 +2455,13 @@ def main_keyboard():
     )
     builder.row(
         KeyboardButton(text="Админ"),
+        KeyboardButton(text="Топ"),
         KeyboardButton(text="Помощь")
     )
     return builder.as_markup(resize_keyboard=True)
 
 
+@cached_keyboard
 def profile_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.row(
@@ -459,6 +2472,7 @@ def profile_keyboard():
     return builder.as_markup(resize_keyboard=True)
 
 
+@cached_keyboard
 def jobs_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.row(
@@ -470,6 +2484,7 @@ def jobs_keyboard():
     return builder.as_markup(resize_keyboard=True)
 
 
+@cached_keyboard
 def games_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.row(
@@ -481,6 +2496,7 @@ def games_keyboard():
     return builder.as_markup(resize_keyboard=True)
 
 
+@cached_keyboard
 def mine_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.row(
@@ -494,6 +2510,7 @@ def mine_keyboard():
     return builder.as_markup(resize_keyboard=True)
 
 
+@cached_keyboard
 def business_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.row(
@@ -507,6 +2524,7 @@ def business_keyboard():
     return builder.as_markup(resize_keyboard=True)
 
 
+@cached_keyboard
 def bank_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.row(
@@ -518,6 +2536,7 @@ def bank_keyboard():
     return builder.as_markup(resize_keyboard=True)
 
 
+@cached_keyboard
 def donate_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.row(KeyboardButton(text="Купить Элит (50 ⭐)"))
@@ -527,6 +2546,7 @@ def donate_keyboard():
     return builder.as_markup(resize_keyboard=True)
 
 
+@cached_keyboard
 def roulette_keyboard():
     builder = InlineKeyboardBuilder()
     row = []
@@ -541,59 +2561,216 @@ def roulette_keyboard():
     return builder.as_markup()
 
 
-# ---------------- МИНИ-ИГРА: САПЁР ----------------
-def generate_mini_board(mines_count: int = MINI_BOMBS) -> Set[int]:
-    bombs = set()
-    while len(bombs) < mines_count:
-        bombs.add(random.randint(1, MINI_CELLS))
-    return bombs
+@cached_keyboard
+def simple_roulette_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        InlineKeyboardButton(text="🔴 Красный", callback_data="simple_red"),
+        InlineKeyboardButton(text="⚫ Черный", callback_data="simple_black")
+    )
+    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="simple_cancel"))
+    return builder.as_markup()
 
 
-def index_to_coords(idx: int) -> Tuple[int, int]:
-    i = idx - 1
-    return divmod(i, MINI_COLS)
+@cached_keyboard
+def top_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        InlineKeyboardButton(text="💰 Монеты", callback_data="top_money"),
+        InlineKeyboardButton(text="⭐ Уровень", callback_data="top_level"),
+        InlineKeyboardButton(text="⛏️ Рудник", callback_data="top_mine")
+    )
+    return builder.as_markup()
 
 
-def coords_to_index(r: int, c: int) -> int:
-    return r * MINI_COLS + c + 1
+def build_keyboards():
+    for factory in (main_keyboard, profile_keyboard, jobs_keyboard, games_keyboard, mine_keyboard,
+                    business_keyboard, bank_keyboard, donate_keyboard, roulette_keyboard,
+                    simple_roulette_keyboard, top_keyboard):
+        factory()
 
 
-def neighbors_indices(idx: int) -> List[int]:
-    r, c = index_to_coords(idx)
-    res = []
-    for dr in (-1, 0, 1):
-        for dc in (-1, 0, 1):
-            if dr == 0 and dc == 0:
-                continue
-            nr, nc = r + dr, c + dc
-            if 0 <= nr < MINI_ROWS and 0 <= nc < MINI_COLS:
-                res.append(coords_to_index(nr, nc))
-    return res
+# ---------------- МИНИ-ИГРА: САПЁР ----------------
+class MiniSessions:
+    """Активные игры сапёра. Брошенные игры истекают через ttl секунд бездействия"""
+
+    def __init__(self, ttl: int, policy: str):
+        self.ttl = ttl
+        self.policy = policy
+        self.games = {}  # game_id -> состояние игры
+        self.deadlines = []  # куча (срок, game_id); устаревшие записи пропускаются при разборе
+        self.expired_total = 0
+
+    def __contains__(self, game_id: str) -> bool:
+        return game_id in self.games
+
+    def __getitem__(self, game_id: str) -> dict:
+        return self.games[game_id]
+
+    def __delitem__(self, game_id: str):
+        del self.games[game_id]
+
+    def __len__(self) -> int:
+        return len(self.games)
+
+    def add(self, game_id: str, state: dict):
+        self.games[game_id] = state
+        self.touch(game_id)
+
+    def touch(self, game_id: str):
+        state = self.games[game_id]
+        state["deadline"] = time.monotonic() + self.ttl
+        heapq.heappush(self.deadlines, (state["deadline"], game_id))
+        if len(self.deadlines) > 2 * len(self.games) + 64:
+            # Каждый ход добавляет запись в кучу - периодически выбрасываем устаревшие
+            self.deadlines = [(state["deadline"], gid) for gid, state in self.games.items()]
+            heapq.heapify(self.deadlines)
+
+    def pop_expired(self) -> list:
+        now = time.monotonic()
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, game_id = heapq.heappop(self.deadlines)
+            state = self.games.get(game_id)
+            if state is not None and state["deadline"] == deadline:
+                del self.games[game_id]
+                expired.append(state)
+        self.expired_total += len(expired)
+        return expired
+
+    def stats(self) -> dict:
+        memory = sys.getsizeof(self.games) + sys.getsizeof(self.deadlines)
+        for state in self.games.values():
+            memory += sys.getsizeof(state) + sys.getsizeof(state["bombs"]) + sys.getsizeof(state["opened"])
+            memory += state["keyboard"].memory()
+        return {
+            "active": len(self.games),
+            "heap": len(self.deadlines),
+            "expired_total": self.expired_total,
+            "memory_bytes": memory,
+        }
 
 
-def create_mini_keyboard(opened: Set[int], bombs: Set[int], game_id: str = None) -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
+mini_games = MiniSessions(MINI_SESSION_TTL, MINI_EXPIRE_POLICY)
 
-    for row in range(MINI_ROWS):
-        row_buttons = []
-        for col in range(MINI_COLS):
-            idx = coords_to_index(row, col)
-            cell_id = f"{game_id}_{idx}" if game_id else str(idx)
 
-            if idx in opened:
-                if idx in bombs:
-                    row_buttons.append(InlineKeyboardButton(text="💣", callback_data=f"mini_bomb_{cell_id}"))
-                else:
-                    row_buttons.append(InlineKeyboardButton(text="⬜", callback_data=f"mini_empty_{cell_id}"))
+def mini_payout(state: dict) -> int:
+    win_amount = int(state['bet'] * state['multiplier'])
+    if not state['infinite_user']:
+        add_balance(state['user_id'], win_amount)
+        add_xp(state['user_id'], win_amount // 50)
+    return win_amount
+
+
+async def reap_mini_sessions():
+    # Сначала рассчитываем все истёкшие игры, потом уже правим сообщения:
+    # сетевая ошибка на одной правке не должна оставить остальных без выплаты
+    finished = []
+    for state in mini_games.pop_expired():
+        user_id = state['user_id']
+        try:
+            if mini_games.policy == "cashout":
+                win_amount = mini_payout(state)
+                text = f"⌛ Игра завершена по бездействию.\nВыигрыш {win_amount:,} монет зачислен."
             else:
-                row_buttons.append(InlineKeyboardButton(text="❌", callback_data=f"mini_open_{cell_id}"))
+                text = f"⌛ Игра завершена по бездействию.\nСтавка {state['bet']:,} монет сгорела."
+            save_data(user_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка завершения игры сапёра {user_id}: {e}")
+            continue
+        if state.get("message_id"):
+            finished.append((state, text))
+
+    for state, text in finished:
+        try:
+            await bot.edit_message_text(text, chat_id=state["chat_id"], message_id=state["message_id"])
+        except TelegramBadRequest:
+            pass
+        except Exception as e:
+            logger.error(f"❌ Не удалось обновить истёкшую игру сапёра {state['user_id']}: {e}")
+
 
-        builder.row(*row_buttons)
+async def mini_session_reaper():
+    while True:
+        await asyncio.sleep(30)
+        await reap_mini_sessions()
 
-    if game_id:
-        builder.row(InlineKeyboardButton(text="💰 Забрать выигрыш", callback_data=f"mini_cashout_{game_id}"))
 
-    return builder.as_markup()
+# Поле хранится двумя битовыми масками: бит (idx - 1) отвечает за клетку idx
+def cell_bit(idx: int) -> int:
+    return 1 << (idx - 1)
+
+
+def generate_mini_board(mines_count: int = MINI_BOMBS) -> int:
+    bombs = 0
+    for idx in random.sample(range(1, MINI_CELLS + 1), min(mines_count, MINI_CELLS)):
+        bombs |= cell_bit(idx)
+    return bombs
+
+
+def index_to_coords(idx: int) -> Tuple[int, int]:
+    i = idx - 1
+    return divmod(i, MINI_COLS)
+
+
+def coords_to_index(r: int, c: int) -> int:
+    return r * MINI_COLS + c + 1
+
+
+class MiniKeyboard:
+    """Клавиатура одной игры. Кнопки клеток кэшируются, между ходами заменяются только изменившиеся клетки"""
+    __slots__ = ("game_id", "buttons", "rows", "opened")
+
+    CLOSED, EMPTY, BOMB = 0, 1, 2
+
+    def __init__(self, game_id: str):
+        self.game_id = game_id
+        self.buttons = {}  # (idx, вариант) -> кнопка
+        self.rows = [
+            [self._button(coords_to_index(row, col), self.CLOSED) for col in range(MINI_COLS)]
+            for row in range(MINI_ROWS)
+        ]
+        self.rows.append([InlineKeyboardButton(text="💰 Забрать выигрыш", callback_data=f"mini_cashout_{game_id}")])
+        self.opened = 0
+
+    def _button(self, idx: int, variant: int) -> InlineKeyboardButton:
+        button = self.buttons.get((idx, variant))
+        if button is None:
+            cell_id = f"{self.game_id}_{idx}"
+            if variant == self.BOMB:
+                button = InlineKeyboardButton(text="💣", callback_data=f"mini_bomb_{cell_id}")
+            elif variant == self.EMPTY:
+                button = InlineKeyboardButton(text="⬜", callback_data=f"mini_empty_{cell_id}")
+            else:
+                button = InlineKeyboardButton(text="❌", callback_data=f"mini_open_{cell_id}")
+            self.buttons[(idx, variant)] = button
+        return button
+
+    def render(self, opened: int, bombs: int) -> InlineKeyboardMarkup:
+        changed = opened ^ self.opened
+        while changed:
+            bit = changed & -changed
+            idx = bit.bit_length()
+            if not opened & bit:
+                variant = self.CLOSED
+            elif bombs & bit:
+                variant = self.BOMB
+            else:
+                variant = self.EMPTY
+            row, col = index_to_coords(idx)
+            self.rows[row][col] = self._button(idx, variant)
+            changed ^= bit
+        self.opened = opened
+        return InlineKeyboardMarkup(inline_keyboard=[list(row) for row in self.rows])
+
+    def memory(self) -> int:
+        """Примерный объём кэша кнопок и строк клавиатуры в байтах"""
+        memory = sys.getsizeof(self.buttons) + sys.getsizeof(self.rows)
+        memory += sum(sys.getsizeof(row) for row in self.rows)
+        for button in list(self.buttons.values()) + self.rows[-1]:
+            memory += sys.getsizeof(button) + sys.getsizeof(button.__dict__)
+            memory += sys.getsizeof(button.text) + sys.getsizeof(button.callback_data)
+        return memory
 
 
 # ---------------- КОМАНДА /ID ----------------
@@ -679,6 +2856,11 @@ async def cmd_chance(message: Message, command: CommandObject):
         await message.answer("❌ Число должно быть от 0 до 100!")
         return
 
+    if not is_local_user(target_id):
+        # Настройки хранятся у шарда игрока, чужой шард выбросил бы их при перезапуске
+        await message.answer(f"❌ Игрок {target_id} обслуживается другим шардом, /chance для него недоступен")
+        return
+
     if chance == 0:
         mines = 8
         level = "ОЧЕНЬ СЛОЖНО 🔥"
@@ -703,6 +2885,7 @@ async def cmd_chance(message: Message, command: CommandObject):
         "mines": mines
     }
 
+    save_data(target_id)
     await message.answer(
         f"✅ <b>НАСТРОЙКИ МИНИ-ИГРЫ ДЛЯ {target_name}</b>\n\n"
         f"• Сложность: {level}\n"
@@ -713,8 +2896,6 @@ async def cmd_chance(message: Message, command: CommandObject):
         parse_mode="HTML"
     )
 
-    save_data()
-
 
 # ---------------- МИНИ-ИГРА: КОМАНДА /MINI ----------------
 @dp.message(Command("mini"))
@@ -757,7 +2938,7 @@ async def cmd_mini(message: Message, command: CommandObject):
 
     game_id = f"{user_id}_{datetime.now().timestamp()}"
     bombs = generate_mini_board(mines_count)
-    opened = set()
+    opened = 0
 
     state = {
         "user_id": user_id,
@@ -769,15 +2950,16 @@ async def cmd_mini(message: Message, command: CommandObject):
         "multiplier": 1.0,
         "lost": False,
         "infinite_user": infinite_user,
-        "game_id": game_id
+        "game_id": game_id,
+        "keyboard": MiniKeyboard(game_id)
     }
 
-    mini_games[game_id] = state
+    mini_games.add(game_id, state)
 
-    keyboard = create_mini_keyboard(opened, bombs, game_id)
+    keyboard = state["keyboard"].render(opened, bombs)
 
     try:
-        await message.answer(
+        sent = await message.answer(
             f"💣 <b>Мини-игра: Сапёр</b>\n"
             f"Игрок: {user.first_name}\n"
             f"Ставка: {bet:,} монет\n"
@@ -788,8 +2970,12 @@ async def cmd_mini(message: Message, command: CommandObject):
             reply_markup=keyboard,
             parse_mode="HTML"
         )
+        state["chat_id"] = sent.chat.id
+        state["message_id"] = sent.message_id
     except Exception as e:
         logger.error(f"Ошибка при создании мини-игры: {e}")
+        if game_id in mini_games:
+            del mini_games[game_id]
         if not infinite_user:
             add_balance(user_id, bet)
         await message.answer("❌ Ошибка создания игры. Попробуйте позже.")
@@ -797,6 +2983,8 @@ async def cmd_mini(message: Message, command: CommandObject):
 
 @dp.callback_query(F.data.startswith("mini_"))
 async def mini_callback_handler(callback: CallbackQuery):
+    # Без блокировки игрока: ход целиком меняет состояние до первого await, а правки
+    # сообщения от быстрых нажатий должны успеть склеиться в очереди отправки
     await callback.answer()
 
     try:
@@ -836,20 +3024,26 @@ async def process_mini_cell_click(callback: CallbackQuery, game_id: str, cell_id
         await callback.answer("❌ Это не ваша игра!", show_alert=True)
         return
 
-    if cell_idx in state['opened']:
+    if not 1 <= cell_idx <= MINI_CELLS:
+        return
+
+    bit = cell_bit(cell_idx)
+    if state['opened'] & bit:
         await callback.answer("❌ Эта клетка уже открыта!", show_alert=True)
         return
 
-    state['opened'].add(cell_idx)
+    mini_games.touch(game_id)
+    state['opened'] |= bit
 
-    if cell_idx in state['bombs']:
+    if state['bombs'] & bit:
         state['lost'] = True
         state['completed'] = True
 
-        all_opened = state['opened'].copy()
-        all_opened.update(state['bombs'])
+        all_opened = state['opened'] | state['bombs']
 
-        keyboard = create_mini_keyboard(all_opened, state['bombs'], game_id)
+        keyboard = state['keyboard'].render(all_opened, state['bombs'])
+        if game_id in mini_games:
+            del mini_games[game_id]
 
         try:
             await callback.message.edit_text(
@@ -862,17 +3056,13 @@ async def process_mini_cell_click(callback: CallbackQuery, game_id: str, cell_id
             )
         except TelegramBadRequest:
             pass
-
-        if game_id in mini_games:
-            del mini_games[game_id]
-
         return
 
     state['hits'] += 1
     state['multiplier'] *= MINI_MULTIPLIER
     win_amount = int(state['bet'] * state['multiplier'])
 
-    keyboard = create_mini_keyboard(state['opened'], state['bombs'], game_id)
+    keyboard = state['keyboard'].render(state['opened'], state['bombs'])
 
     try:
         await callback.message.edit_text(
@@ -905,17 +3095,15 @@ async def process_mini_cashout(callback: CallbackQuery, game_id: str, user_id: i
 
     state['completed'] = True
 
-    win_amount = int(state['bet'] * state['multiplier'])
-
-    if not state['infinite_user']:
-        add_balance(user_id, win_amount)
-        add_xp(user_id, win_amount // 50)
+    win_amount = mini_payout(state)
 
-    all_opened = state['opened'].copy()
-    all_opened.update(state['bombs'])
+    all_opened = state['opened'] | state['bombs']
 
-    keyboard = create_mini_keyboard(all_opened, state['bombs'], game_id)
+    keyboard = state['keyboard'].render(all_opened, state['bombs'])
+    if game_id in mini_games:
+        del mini_games[game_id]
 
+    save_data(user_id)
     await callback.message.edit_text(
         f"🏆 <b>ВЫ ЗАБРАЛИ ВЫИГРЫШ!</b>\n\n"
         f"Открыто клеток: {state['hits']}\n"
@@ -926,18 +3114,14 @@ async def process_mini_cashout(callback: CallbackQuery, game_id: str, user_id: i
         parse_mode="HTML"
     )
 
-    if game_id in mini_games:
-        del mini_games[game_id]
-
-    save_data()
-
 
 # ---------------- КОМАНДЫ ДЛЯ БАНКА ----------------
 @dp.message(Command("bank"))
 @rate_limit(1)
+@user_locked("bank")
 async def cmd_bank(message: Message, command: CommandObject):
     user_id = message.from_user.id
-    ensure_user(user_id)
+    player = ensure_user(user_id)
 
     args = command.args
     if not args:
@@ -968,8 +3152,9 @@ async def cmd_bank(message: Message, command: CommandObject):
             return
 
         spend_balance(user_id, amount)
-        user_bank[user_id] = user_bank.get(user_id, 0) + amount
+        player.bank += amount
 
+        save_data(user_id)
         await message.answer(
             f"✅ <b>Вы положили {amount:,} монет в банк</b>\n\n"
             f"💰 На кармане: {format_balance(user_id)}\n"
@@ -977,7 +3162,6 @@ async def cmd_bank(message: Message, command: CommandObject):
             parse_mode="HTML",
             reply_markup=bank_keyboard()
         )
-        save_data()
 
     elif len(parts) >= 2 and parts[0].lower() in ['w', 'withdraw', 'снять']:
         if not parts[1].isdigit():
@@ -985,7 +3169,7 @@ async def cmd_bank(message: Message, command: CommandObject):
             return
 
         amount = int(parts[1])
-        bank_balance = user_bank.get(user_id, 0)
+        bank_balance = player.bank
 
         if amount <= 0:
             await message.answer("❌ Неверная сумма", reply_markup=bank_keyboard())
@@ -998,9 +3182,10 @@ async def cmd_bank(message: Message, command: CommandObject):
             )
             return
 
-        user_bank[user_id] -= amount
+        player.bank -= amount
         add_balance(user_id, amount)
 
+        save_data(user_id)
         await message.answer(
             f"✅ <b>Вы сняли {amount:,} монет из банка</b>\n\n"
             f"💰 На кармане: {format_balance(user_id)}\n"
@@ -1008,7 +3193,6 @@ async def cmd_bank(message: Message, command: CommandObject):
             parse_mode="HTML",
             reply_markup=bank_keyboard()
         )
-        save_data()
 
     else:
         await message.answer(
@@ -1023,6 +3207,7 @@ async def cmd_bank(message: Message, command: CommandObject):
 # ---------------- КОМАНДЫ ДЛЯ РУЛЕТКИ ----------------
 @dp.message(Command("roulette"))
 @rate_limit(2)
+@user_locked("roulette")
 async def cmd_roulette(message: Message, command: CommandObject, state: FSMContext):
     user_id = message.from_user.id
     ensure_user(user_id)
@@ -1066,9 +3251,14 @@ async def cmd_roulette(message: Message, command: CommandObject, state: FSMConte
 
 
 @dp.callback_query(RouletteStates.waiting_for_number, F.data.startswith("roulette_"))
+@user_locked("roulette")
 async def roulette_callback_handler(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
+    # Повторное нажатие могло дождаться блокировки уже после того, как игра завершилась
+    if await state.get_state() != RouletteStates.waiting_for_number.state:
+        return
+
     user_id = callback.from_user.id
     data = callback.data
 
@@ -1110,9 +3300,9 @@ async def roulette_callback_handler(callback: CallbackQuery, state: FSMContext):
                 f"💳 Баланс: {format_balance(user_id)}"
             )
 
+        save_data(user_id)
         await state.clear()
         await callback.message.edit_text(result_text, parse_mode="HTML")
-        save_data()
 
 
 # ---------------- ПРОСТАЯ РУЛЕТКА ----------------
@@ -1148,28 +3338,24 @@ async def cmd_roulette_simple(message: Message, command: CommandObject, state: F
 
     await state.update_data(bet=bet)
 
-    # Клавиатура с цветами
-    builder = InlineKeyboardBuilder()
-    builder.row(
-        InlineKeyboardButton(text="🔴 Красный", callback_data="simple_red"),
-        InlineKeyboardButton(text="⚫ Черный", callback_data="simple_black")
-    )
-    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="simple_cancel"))
-
     await state.set_state(SimpleRouletteStates.waiting_for_color)
     await message.answer(
         f"🎰 <b>ПРОСТАЯ РУЛЕТКА</b>\n\n"
         f"💰 Ставка: {bet:,} монет\n"
         f"🎯 Выбери цвет:",
-        reply_markup=builder.as_markup(),
+        reply_markup=simple_roulette_keyboard(),
         parse_mode="HTML"
     )
 
 
 @dp.callback_query(SimpleRouletteStates.waiting_for_color, F.data.startswith("simple_"))
+@user_locked("roulette")
 async def simple_roulette_callback(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
+    if await state.get_state() != SimpleRouletteStates.waiting_for_color.state:
+        return
+
     user_id = callback.from_user.id
     data = callback.data
 
@@ -1225,8 +3411,8 @@ async def simple_roulette_callback(callback: CallbackQuery, state: FSMContext):
             parse_mode="HTML"
         )
 
+    save_data(user_id)
     await state.clear()
-    save_data()
 
 
 # ---------------- ОСНОВНЫЕ КОМАНДЫ ----------------
@@ -1234,7 +3420,7 @@ async def simple_roulette_callback(callback: CallbackQuery, state: FSMContext):
 @rate_limit(1)
 async def cmd_start(message: Message):
     user_id = message.from_user.id
-    ensure_user(user_id)
+    player = ensure_user(user_id)
 
     daily_bonus, daily_acc = get_daily_bonus(user_id)
 
@@ -1242,7 +3428,7 @@ async def cmd_start(message: Message):
         f"<b>ДОБРО ПОЖАЛОВАТЬ В БОТ-ИГРУ!</b>\n\n"
         f"👤 Статус: {get_user_status(user_id)}\n"
         f"💰 Баланс: {format_balance(user_id)}\n"
-        f"⚡ Ускорители: {user_accelerators.get(user_id, 0)}\n\n"
+        f"⚡ Ускорители: {player.accelerators}\n\n"
         f"🎁 Ежедневный бонус: /daily (+{daily_bonus:,} монет, +{daily_acc} ускорителей)\n\n"
         f"📌 Короткие команды:\n"
         f"• <code>б</code> или <code>Баланс</code> - показать баланс\n"
@@ -1292,6 +3478,9 @@ async def cmd_help(message: Message):
         "• Введите #промокод для активации\n\n"
         "💸 <b>ПЕРЕВОД:</b>\n"
         "• /p @user сумма\n\n"
+        "🏆 <b>ТОП ИГРОКОВ:</b>\n"
+        "• /top - по монетам\n"
+        "• /top уровень, /top рудник\n\n"
         "🆔 <b>ID ПОЛЬЗОВАТЕЛЯ:</b>\n"
         "• /id - показать свой ID\n"
         "• Ответ на сообщение + /id - показать ID пользователя\n\n"
@@ -1299,7 +3488,10 @@ async def cmd_help(message: Message):
         "• б - баланс\n"
         "• я - профиль\n\n"
         "👑 <b>АДМИН КОМАНДЫ:</b>\n"
-        "• /chance <ID> <0-100> - установить сложность мини-игры"
+        "• /chance <ID> <0-100> - установить сложность мини-игры\n"
+        "• /stats - задержки обработчиков и сохранений\n"
+        "• /bulk - массовая выдача из CSV/JSON (файл с подписью /bulk)\n"
+        "• /broadcast текст - рассылка всем игрокам"
     )
     await message.answer(help_text, parse_mode="HTML", reply_markup=main_keyboard())
 
@@ -1308,7 +3500,7 @@ async def cmd_help(message: Message):
 @rate_limit(5)
 async def cmd_daily(message: Message):
     user_id = message.from_user.id
-    ensure_user(user_id)
+    player = ensure_user(user_id)
 
     now = datetime.now()
 
@@ -1336,18 +3528,17 @@ async def cmd_daily(message: Message):
 
     daily_used[user_id] = now
 
+    save_data(user_id)
     await message.answer(
         f"🎁 <b>ЕЖЕДНЕВНЫЙ БОНУС!</b>\n\n"
         f"💰 Монеты: +{daily_bonus:,}\n"
         f"⚡ Ускорители: +{daily_acc}\n"
         f"💳 Баланс: {format_balance(user_id)}\n"
-        f"⚡ Всего ускорителей: {user_accelerators.get(user_id, 0)}",
+        f"⚡ Всего ускорителей: {player.accelerators}",
         parse_mode="HTML",
         reply_markup=main_keyboard()
     )
 
-    save_data()
-
 
 @dp.message(Command("bet"))
 @rate_limit(1)
@@ -1389,14 +3580,13 @@ async def cmd_bet(message: Message, command: CommandObject):
             spend_balance(user_id, amount)
         result = f"💔 <b>ПРОИГРЫШ</b> -{amount:,} монет"
 
+    save_data(user_id)
     await message.answer(
         f"{result}\nБаланс: {format_balance(user_id)}",
         parse_mode="HTML",
         reply_markup=games_keyboard()
     )
 
-    save_data()
-
 
 @dp.message(Command("coin"))
 @rate_limit(1)
@@ -1411,6 +3601,47 @@ async def cmd_coin(message: Message):
     )
 
 
+# ---------------- ТОП ИГРОКОВ ----------------
+TOP_ALIASES = {"уровень": "level", "level": "level", "рудник": "mine", "шахта": "mine", "mine": "mine"}
+
+
+def format_top(name: str, user_id: int) -> str:
+    title, _ = LEADERBOARDS[name]
+    lines = [f"🏆 <b>{title.upper()}</b>\n"]
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    for place, (player_id, score) in enumerate(leaderboard.top(name), start=1):
+        username = username_cache.names.get(player_id)
+        who = f"@{username}" if username else f"ID {player_id}"
+        lines.append(f"{medals.get(place, f'{place}.')} {who} - {score[0]:,}")
+    if len(lines) == 1:
+        lines.append("Пока никого нет")
+
+    place = leaderboard.rank(name, user_id)
+    lines.append(f"\n📍 Ваше место: {place}" if place else "\n📍 Вы не участвуете в этом рейтинге")
+    return "\n".join(lines)
+
+
+@dp.message(Command("top"))
+@rate_limit(2)
+async def cmd_top(message: Message, command: CommandObject):
+    name = TOP_ALIASES.get((command.args or "").strip().lower(), "money")
+    await message.answer(format_top(name, message.from_user.id), parse_mode="HTML", reply_markup=top_keyboard())
+
+
+@dp.callback_query(F.data.startswith("top_"))
+async def top_callback_handler(callback: CallbackQuery):
+    await callback.answer()
+    name = callback.data[len("top_"):]
+    if name not in LEADERBOARDS:
+        return
+    try:
+        await callback.message.edit_text(
+            format_top(name, callback.from_user.id), parse_mode="HTML", reply_markup=top_keyboard()
+        )
+    except TelegramBadRequest:
+        pass  # рейтинг не изменился
+
+
 # ---------------- АДМИН КОМАНДЫ ----------------
 @dp.message(Command("money"))
 @rate_limit(1)
@@ -1440,14 +3671,11 @@ async def cmd_money(message: Message, command: CommandObject):
                 target_user = message.reply_to_message.from_user
                 target_id = target_user.id
                 amount = int(parts[0])
-                ensure_user(target_id)
-                if not has_infinite_balance(target_id):
-                    add_balance(target_id, amount)
+                committed = await credit_user(target_id, amount)
                 await message.answer(
-                    f"✅ Выдано {amount:,} монет пользователю {target_user.first_name}",
+                    f"✅ Выдано {amount:,} монет пользователю {target_user.first_name}" + transfer_note(committed),
                     reply_markup=main_keyboard()
                 )
-                save_data()
                 return
 
         if len(parts) == 1 and parts[0].isdigit():
@@ -1455,11 +3683,11 @@ async def cmd_money(message: Message, command: CommandObject):
             ensure_user(user_id)
             if not has_infinite_balance(user_id):
                 add_balance(user_id, amount)
+            save_data(user_id)
             await message.answer(
                 f"✅ Вы получили {amount:,} монет\nБаланс: {format_balance(user_id)}",
                 reply_markup=main_keyboard()
             )
-            save_data()
             return
 
         if len(parts) >= 2 and parts[1].isdigit():
@@ -1468,21 +3696,16 @@ async def cmd_money(message: Message, command: CommandObject):
 
             try:
                 if target.startswith('@'):
-                    # Получаем ID по username
-                    chat = await bot.get_chat(target)
-                    target_id = chat.id
+                    target_id = await resolve_username(target, USERNAME_VERIFY_AGE)
                 else:
                     target_id = int(target)
 
-                ensure_user(target_id)
-                if not has_infinite_balance(target_id):
-                    add_balance(target_id, amount)
+                committed = await credit_user(target_id, amount)
 
                 await message.answer(
-                    f"✅ Выдано {amount:,} монет пользователю {target}",
+                    f"✅ Выдано {amount:,} монет пользователю {target}" + transfer_note(committed),
                     reply_markup=main_keyboard()
                 )
-                save_data()
                 return
             except Exception as e:
                 logger.error(f"Ошибка в money_cmd: {e}")
@@ -1494,6 +3717,40 @@ async def cmd_money(message: Message, command: CommandObject):
         await message.answer("❌ Ошибка выполнения команды", reply_markup=main_keyboard())
 
 
+@dp.message(Command("stats"))
+@rate_limit(1)
+async def cmd_stats(message: Message):
+    user_id = message.from_user.id
+
+    if not (is_admin(user_id) or has_rank(user_id, "Admin")):
+        await message.answer("❌ Только админы могут использовать эту команду")
+        return
+
+    titles = {
+        "handler": "🧩 <b>ОБРАБОТЧИКИ</b>",
+        "route": "💬 <b>КНОПКИ И ТЕКСТЫ</b>",
+        "save": "💾 <b>СОХРАНЕНИЕ</b>",
+        "api": "📡 <b>BOT API</b>",
+    }
+    blocks = []
+    for family, title in titles.items():
+        rows = metrics.summary(family)
+        if not rows:
+            continue
+        lines = [title]
+        for name, count, p50, p99, total in rows:
+            lines.append(
+                f"<code>{name}</code>: {count:,} шт, p50 ≤{p50 * 1000:g} мс, "
+                f"p99 ≤{p99 * 1000:g} мс, всего {total:.1f} с"
+            )
+        blocks.append("\n".join(lines))
+
+    errors = sum(metrics.api_errors.values())
+    if errors:
+        blocks.append(f"❌ Ошибок Bot API: {errors:,}")
+    await message.answer("\n\n".join(blocks) or "📊 Пока нет замеров", parse_mode="HTML")
+
+
 @dp.message(Command("p"))
 @rate_limit(1)
 async def cmd_givemoney(message: Message, command: CommandObject):
@@ -1516,13 +3773,16 @@ async def cmd_givemoney(message: Message, command: CommandObject):
             if amount <= 0:
                 await message.answer("❌ Сумма должна быть больше 0")
                 return
-            if not can_spend(user_id, amount):
-                await message.answer("❌ Недостаточно монет")
-                return
-            spend_balance(user_id, amount)
-            add_balance(target_id, amount)
-            await message.answer(f"✅ Вы перевели {amount:,} монет")
-            save_data()
+            async with user_locks.hold(user_id, target_id, name="p"):
+                if not can_spend(user_id, amount):
+                    await message.answer("❌ Недостаточно монет")
+                    return
+                spend_balance(user_id, amount)
+                save_data(user_id)
+                transfer_id = begin_credit(target_id, amount, source_id=user_id)
+            # Подтверждения другого шарда ждём уже без блокировок
+            committed = await finish_credit(transfer_id)
+            await message.answer(f"✅ Вы перевели {amount:,} монет" + transfer_note(committed))
             return
 
         if len(parts) >= 2 and parts[1].isdigit():
@@ -1537,15 +3797,20 @@ async def cmd_givemoney(message: Message, command: CommandObject):
 
             try:
                 if target.startswith('@'):
-                    chat = await bot.get_chat(target)
-                    target_id = chat.id
+                    target_id = await resolve_username(target, USERNAME_VERIFY_AGE)
                 else:
                     target_id = int(target)
 
-                spend_balance(user_id, amount)
-                add_balance(target_id, amount)
-                await message.answer(f"✅ Вы перевели {amount:,} монет пользователю {target}")
-                save_data()
+                # Баланс проверяем ещё раз: пока искали получателя, монеты могли уйти другим переводом
+                async with user_locks.hold(user_id, target_id, name="p"):
+                    if not can_spend(user_id, amount):
+                        await message.answer("❌ Недостаточно монет")
+                        return
+                    spend_balance(user_id, amount)
+                    save_data(user_id)
+                    transfer_id = begin_credit(target_id, amount, source_id=user_id)
+                committed = await finish_credit(transfer_id)
+                await message.answer(f"✅ Вы перевели {amount:,} монет пользователю {target}" + transfer_note(committed))
                 return
             except:
                 await message.answer("❌ Не удалось найти пользователя")
@@ -1555,556 +3820,1666 @@ async def cmd_givemoney(message: Message, command: CommandObject):
         await message.answer("❌ Ошибка выполнения команды")
 
 
-# ---------------- ТЕКСТОВЫЙ ОБРАБОТЧИК ----------------
-@dp.message(F.text)
-@rate_limit(0.5)
-async def text_handler(message: Message):
-    text = message.text.strip()
-    user = message.from_user
-    user_id = user.id
-    ensure_user(user_id)
+# ---------------- МАССОВАЯ ВЫДАЧА ----------------
+# Файл: CSV со столбцами user_id, amount, kind (заголовок можно опустить)
+# или JSON - массив объектов {"user_id": ..., "amount": ..., "kind": ...} либо JSON Lines.
+# kind: money (по умолчанию) или accelerators
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "1000000"))
+BULK_CHUNK = 5000  # строк проверки между передачей управления другим обработчикам
+BULK_PROGRESS_INTERVAL = 2  # сек между обновлениями сообщения о ходе выдачи
+BULK_ERRORS_SHOWN = 10
+BULK_KINDS = {
+    "money": "money", "m": "money", "монеты": "money",
+    "accelerators": "accelerators", "a": "accelerators", "ускорители": "accelerators",
+}
+bulk_running = False
+
+
+def _iter_csv_rows(f):
+    first_line = f.readline()
+    f.seek(0)
+    delimiter = ";" if first_line.count(";") > first_line.count(",") else ","
+    for line_no, row in enumerate(csv.reader(f, delimiter=delimiter), 1):
+        if not any(cell.strip() for cell in row):
+            continue
+        if line_no == 1 and not row[0].strip().lstrip("-").isdigit():
+            continue  # заголовок
+        yield line_no, row[0], row[1] if len(row) > 1 else None, row[2] if len(row) > 2 else "money"
+
+
+def _iter_json_rows(f):
+    # Файл читается кусками, из буфера по одному вынимаются законченные объекты
+    decoder = json.JSONDecoder()
+    buffer = ""
+    index = 0
+    for chunk in iter(partial(f.read, 65536), ""):
+        buffer += chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,[]":
+                pos += 1
+            if pos == len(buffer):
+                break
+            try:
+                row, pos_end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break  # объект ещё не дочитан
+            pos = pos_end
+            index += 1
+            if isinstance(row, dict):
+                yield index, row.get("user_id"), row.get("amount"), row.get("kind", "money")
+            else:
+                yield index, None, None, None
+        buffer = buffer[pos:]
+    if buffer.strip(" \t\r\n,[]"):
+        yield index + 1, None, None, None  # файл обрывается посреди объекта
 
-    # 1️⃣ "я" - ПОЛНЫЙ ПРОФИЛЬ
-    if text.lower() == "я":
-        profile = user_profiles.get(user_id, {"level": 1, "xp": 0, "next_level_xp": 100})
-        status = get_user_status(user_id)
-
-        profile_text = (
-            f"👤 <b>ПРОФИЛЬ: {user.first_name}</b>\n"
-            f"🆔 ID: <code>{user_id}</code>\n"
-            f"👑 Статус: {status}\n\n"
-            f"📊 <b>СТАТИСТИКА:</b>\n"
-            f"Уровень: {profile['level']}\n"
-            f"Опыт: {profile['xp']:,}/{profile['next_level_xp']:,}\n"
-            f"💰 Баланс: {format_balance(user_id)}\n"
-            f"🏦 В банке: {format_bank_balance(user_id)}\n"
-            f"⚡ Ускорители: {user_accelerators.get(user_id, 0)}\n\n"
-            f"🏠 <b>ИМУЩЕСТВО:</b>\n"
-        )
 
-        if user_id in mine_data:
-            mine = mine_data[user_id]
-            level_info = MINE_LEVELS[mine["level"]]
-            mine_value = mine["resources"] * level_info["price_per_unit"]
-            profile_text += (
-                f"⛏️ РУДНИК:\n"
-                f"   {level_info['name']}\n"
-                f"   Ресурсы: {mine['resources']:,} {level_info['resource']}\n"
-                f"   💎 Стоимость: {mine_value:,} монет\n"
-            )
+def iter_bulk_rows(path: str, is_json: bool):
+    """(номер строки, user_id, amount, kind) в сыром виде"""
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        yield from (_iter_json_rows(f) if is_json else _iter_csv_rows(f))
 
-        if user_id in business_data and business_data[user_id]["type"]:
-            business = business_data[user_id]
-            biz_info = BUSINESS_TYPES[business["type"]]
-            profile_text += (
-                f"🏢 БИЗНЕС:\n"
-                f"   {biz_info['name']}\n"
-                f"   💰 Прибыль: {business['profit']:,} монет\n"
-            )
 
-        await message.answer(profile_text, parse_mode="HTML", reply_markup=main_keyboard())
-        return
+def parse_bulk_row(user_id, amount, kind) -> tuple:
+    try:
+        user_id = int(str(user_id).strip())
+        amount = int(str(amount).strip())
+    except ValueError:
+        raise ValueError("user_id и amount должны быть целыми числами")
+    if amount <= 0:
+        raise ValueError("сумма должна быть больше 0")
+    kind = BULK_KINDS.get(str(kind).strip().lower())
+    if kind is None:
+        raise ValueError("kind должен быть money или accelerators")
+    if is_local_user(user_id):
+        if user_id not in users:
+            raise ValueError(f"пользователь {user_id} не найден")
+    elif kind == "accelerators":
+        raise ValueError(f"ускорители пользователю {user_id} с другого шарда не выдаются")
+    return user_id, amount, kind
+
+
+class BulkProgress:
+    """Сообщение о ходе выдачи, обновляемое не чаще раза в BULK_PROGRESS_INTERVAL секунд"""
+
+    def __init__(self, status: Message):
+        self.status = status
+        self.shown_at = time.monotonic()
+
+    async def update(self, text: str, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.shown_at < BULK_PROGRESS_INTERVAL:
+            return
+        self.shown_at = now
+        try:
+            await self.status.edit_text(text, parse_mode="HTML")
+        except TelegramBadRequest:
+            pass  # текст не изменился
 
-    # 2️⃣ "б" или "баланс" - БАЛАНС
-    if text.lower() in ["б", "баланс"]:
-        balance_text = (
-            f"💰 <b>ВАШ БАЛАНС</b>\n\n"
-            f"Наличные: {format_balance(user_id)}\n"
-            f"⚡ Ускорители: {user_accelerators.get(user_id, 0)}\n"
-            f"🏦 В банке: {format_bank_balance(user_id)}\n"
-        )
-        if has_infinite_balance(user_id):
-            balance_text += "✨ Бесконечный баланс активирован!"
-        await message.answer(balance_text, parse_mode="HTML", reply_markup=main_keyboard())
-        return
 
-    # 3️⃣ Промокоды
-    if text.startswith('#'):
-        promo_code = text[1:].upper()
-        await process_promo_code(message, promo_code)
-        return
+async def check_bulk_file(path: str, is_json: bool, progress: BulkProgress) -> tuple:
+    """Первый проход: проверяет все строки, ничего не меняя"""
+    totals = Counter()
+    errors = []
+    for line_no, *raw in iter_bulk_rows(path, is_json):
+        totals["rows"] += 1
+        try:
+            user_id, amount, kind = parse_bulk_row(*raw)
+        except ValueError as e:
+            totals["errors"] += 1
+            if len(errors) < BULK_ERRORS_SHOWN:
+                errors.append(f"строка {line_no}: {e}")
+            continue
+        totals[kind] += amount
+        totals[kind + "_rows"] += 1
+        if totals["rows"] % BULK_CHUNK == 0:
+            await progress.update(f"🔎 Проверено строк: {totals['rows']:,}")
+            await asyncio.sleep(0)
+    return totals, errors
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, 1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def apply_bulk_file(path: str, is_json: bool, bulk_id: str) -> Counter:
+    """Второй проход: применяет проверенный файл целиком, без await до записи в журнал.
+
+    Снимок не может поймать файл применённым наполовину, а журнал получает одну
+    запись "bulk" с состояниями всех получателей, переводами и bulk_id - по нему
+    повторная отправка того же файла отклоняется.
+    Монеты зачисляются без опыта и наград за уровень - это выдача, а не доход игрока.
+    """
+    applied = Counter()
+    transfer_ids = []
+    recipients = set()
+    journal.sync()  # чужие изменения уходят отдельными записями, как обычно
+    for line_no, *raw in iter_bulk_rows(path, is_json):
+        user_id, amount, kind = parse_bulk_row(*raw)
+        if not is_local_user(user_id):
+            transfer_id = uuid.uuid4().hex
+            pending_transfers[transfer_id] = {
+                "user_id": user_id, "amount": amount, "source_id": None,
+                "kind": "grant" if kind == "money" else kind,
+            }
+            transfer_ids.append(transfer_id)
+            applied["transfers"] += 1
+        elif kind == "accelerators":
+            add_accelerator(user_id, amount)
+            recipients.add(user_id)
+        elif has_infinite_balance(user_id):
+            applied["infinite"] += 1
+        else:
+            grant_balance(user_id, amount)
+            recipients.add(user_id)
+        applied["rows"] += 1
+    applied_bulks.add(bulk_id)
+    for user_id in recipients:
+        journal.pending.pop(user_id, None)
+    journal.append(None, "bulk", {
+        "id": bulk_id,
+        "states": {user_id: _journal_state(user_id) for user_id in recipients},
+        "transfers": {"pending": pending_transfers, "applied": applied_transfers},
+    })
+    mark_meta_dirty("applied_bulks")
+    mark_meta_dirty("shard_transfers")
+
+    applied["saved"] = await flush_data_async()
+    # Переводы уже в журнале; если запись снимка не удалась, transfer_resender
+    # всё равно повторял бы их, поэтому отправляем сразу
+    for transfer_id in transfer_ids:
+        await send_prepare(transfer_id)
+    return applied
+
+
+@dp.message(Command("bulk"))
+@rate_limit(5)
+async def cmd_bulk(message: Message):
+    global bulk_running
+    user_id = message.from_user.id
 
-    # 4️⃣ Навигация
-    if text == "Назад в меню":
-        await message.answer("↩️ Главное меню:", reply_markup=main_keyboard())
+    if not (is_admin(user_id) or has_rank(user_id, "Admin")):
+        await message.answer("❌ Только админы могут использовать эту команду")
         return
 
-    # 5️⃣ Обработка кнопок меню
-    if text == "Баланс":
-        balance_text = (
-            f"💰 <b>ВАШ БАЛАНС</b>\n\n"
-            f"Наличные: {format_balance(user_id)}\n"
-            f"⚡ Ускорители: {user_accelerators.get(user_id, 0)}\n"
-            f"🏦 В банке: {format_bank_balance(user_id)}\n"
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if document is None:
+        await message.answer(
+            "📦 <b>МАССОВАЯ ВЫДАЧА</b>\n\n"
+            "Отправьте CSV или JSON файл с подписью <code>/bulk</code>\n"
+            "или ответьте <code>/bulk</code> на сообщение с файлом.\n\n"
+            "CSV: <code>user_id,amount,kind</code>\n"
+            "JSON: <code>[{\"user_id\": 1, \"amount\": 100, \"kind\": \"money\"}]</code>\n"
+            "kind: <code>money</code> (по умолчанию) или <code>accelerators</code>",
+            parse_mode="HTML"
         )
-        if has_infinite_balance(user_id):
-            balance_text += "✨ Бесконечный баланс активирован!"
-        await message.answer(balance_text, parse_mode="HTML", reply_markup=main_keyboard())
         return
 
-    if text == "Профиль":
-        await message.answer(
-            "👤 <b>ВАШ ПРОФИЛЬ</b>\n\nВыберите действие:",
-            parse_mode="HTML",
-            reply_markup=profile_keyboard()
-        )
+    if bulk_running:
+        await message.answer("⏳ Предыдущая массовая выдача ещё не закончилась")
         return
 
-    if text == "Статистика":
-        profile = user_profiles.get(user_id, {"level": 1, "xp": 0, "next_level_xp": 100})
-        status = get_user_status(user_id)
-
-        stats_text = (
-            f"👤 <b>ПРОФИЛЬ: {user.first_name}</b>\n"
-            f"🆔 ID: <code>{user_id}</code>\n"
-            f"👑 Статус: {status}\n\n"
-            f"📊 <b>СТАТИСТИКА:</b>\n"
-            f"Уровень: {profile['level']}\n"
-            f"Опыт: {profile['xp']:,}/{profile['next_level_xp']:,}\n"
-            f"💰 Баланс: {format_balance(user_id)}\n"
-            f"🏦 В банке: {format_bank_balance(user_id)}\n"
-            f"⚡ Ускорители: {user_accelerators.get(user_id, 0)}\n"
+    bulk_running = True
+    progress = None
+    path = None
+    try:
+        progress = BulkProgress(await message.answer("⏳ Загружаю файл..."))
+        fd, path = tempfile.mkstemp(suffix=".bulk")
+        os.close(fd)
+        await bot.download(document, destination=path)
+        is_json = (document.file_name or "").lower().endswith((".json", ".jsonl"))
+        bulk_id = await asyncio.to_thread(file_digest, path)
+        if bulk_id in applied_bulks:
+            await progress.update("❌ Этот файл уже был применён", force=True)
+            return
+
+        totals, errors = await check_bulk_file(path, is_json, progress)
+        if totals["rows"] > BULK_MAX_ROWS:
+            await progress.update(f"❌ В файле {totals['rows']:,} строк, максимум {BULK_MAX_ROWS:,}", force=True)
+            return
+        if errors:
+            await progress.update(
+                f"❌ <b>Файл не применён</b>, ошибок: {totals['errors']:,}\n\n" + "\n".join(errors),
+                force=True
+            )
+            return
+        if not totals["rows"]:
+            await progress.update("❌ В файле нет строк", force=True)
+            return
+
+        await progress.update("⚙️ Применяю файл...", force=True)
+        applied = await apply_bulk_file(path, is_json, bulk_id)
+        logger.info(
+            f"📦 Массовая выдача от {user_id}: строк {applied['rows']:,}, "
+            f"монет {totals['money']:,}, ускорителей {totals['accelerators']:,}"
         )
+        lines = [
+            "✅ <b>МАССОВАЯ ВЫДАЧА ЗАВЕРШЕНА</b>\n",
+            f"📄 Строк: {applied['rows']:,}",
+            f"💰 Монет: {totals['money']:,} ({totals['money_rows']:,} строк)",
+            f"⚡ Ускорителей: {totals['accelerators']:,} ({totals['accelerators_rows']:,} строк)",
+        ]
+        if applied["infinite"]:
+            lines.append(f"♾️ Пропущено бесконечных балансов: {applied['infinite']:,}")
+        if applied["transfers"]:
+            lines.append(f"🔀 Отправлено на другие шарды: {applied['transfers']:,}")
+        if not applied["saved"]:
+            lines.append("⚠️ Сохранение не удалось, изменения запишутся при следующем сохранении")
+        await progress.update("\n".join(lines), force=True)
+    except Exception as e:
+        logger.error(f"Ошибка массовой выдачи: {e}")
+        if progress is not None:
+            await progress.update(f"❌ Ошибка обработки файла: {e}", force=True)
+    finally:
+        bulk_running = False
+        if path is not None:
+            os.remove(path)
 
-        await message.answer(stats_text, parse_mode="HTML", reply_markup=profile_keyboard())
-        return
 
-    if text == "Имущество":
-        assets_text = "🏠 <b>ВАШЕ ИМУЩЕСТВО:</b>\n\n"
-
-        if user_id in mine_data:
-            mine = mine_data[user_id]
-            level_info = MINE_LEVELS[mine["level"]]
-            mine_value = mine["resources"] * level_info["price_per_unit"]
-            assets_text += (
-                f"⛏️ <b>РУДНИК:</b>\n"
-                f"   {level_info['name']} (Уровень {mine['level'] + 1})\n"
-                f"   Ресурсы: {mine['resources']:,} {level_info['resource']}\n"
-                f"   💎 Стоимость: {mine_value:,} монет\n"
-                f"   ⚡ Авто-сбор: {'✅ Вкл' if mine['auto_collect'] else '❌ Выкл'}\n\n"
-            )
+# ---------------- РАССЫЛКА ----------------
+broadcast_task = None
+broadcast_state = None  # прогресс текущей рассылки, он же записывается в BROADCAST_FILE
 
-        if user_id in business_data and business_data[user_id]["type"]:
-            business = business_data[user_id]
-            biz_info = BUSINESS_TYPES[business["type"]]
-            business_value = biz_info["cost"] // 2 + business["profit"]
-            assets_text += (
-                f"🏢 <b>БИЗНЕС:</b>\n"
-                f"   {biz_info['name']}\n"
-                f"   💰 Прибыль: {business['profit']:,} монет\n"
-                f"   💎 Стоимость: {business_value:,} монет\n\n"
-            )
 
-        assets_text += f"🏦 <b>БАНК:</b> {format_bank_balance(user_id)} монет"
+def _write_broadcast_state(state: dict):
+    # Ошибка записи не останавливает рассылку: после перезапуска она начнётся с прошлой отметки
+    tmp_path = BROADCAST_FILE + ".tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, BROADCAST_FILE)
+    except OSError as e:
+        logger.error(f"❌ Не удалось записать прогресс рассылки: {e}")
 
-        await message.answer(assets_text, parse_mode="HTML", reply_markup=profile_keyboard())
-        return
 
-    if text == "Работа":
-        if not can_work(user_id):
-            await message.answer(
-                "❌ У вас закончились ускорители!\nПолучите ускорители через /daily или промокоды.",
-                reply_markup=main_keyboard()
-            )
-            return
-        await message.answer("💼 Выберите работу:", reply_markup=jobs_keyboard())
-        return
+def _remove_broadcast_state():
+    try:
+        os.remove(BROADCAST_FILE)
+    except OSError:
+        pass
 
-    if text in ["Курьер", "Таксист", "Программист"]:
-        if not can_work(user_id):
-            await message.answer("❌ Нет ускорителей!", reply_markup=jobs_keyboard())
-            return
 
-        earnings = {
-            "Курьер": (10, 30),
-            "Таксист": (20, 50),
-            "Программист": (50, 120)
-        }
+def is_parse_error(error: TelegramBadRequest) -> bool:
+    # Ошибка разметки повторится у каждого получателя
+    return "parse entities" in str(error)
 
-        earn = random.randint(*earnings[text])
-        use_accelerator(user_id, 1)
 
-        if not has_infinite_balance(user_id):
-            add_balance(user_id, earn)
-            add_xp(user_id, earn // 10)
+def broadcast_summary(state: dict) -> str:
+    shard = f"🧩 Шард {SHARD_INDEX + 1} из {SHARD_COUNT}\n" if SHARD_COUNT > 1 else ""
+    return shard + (
+        f"📨 Отправлено: {state['sent']:,} из {state['total']:,}\n"
+        f"🚫 Заблокировали бота: {state['blocked']:,}\n"
+        f"⏭ Пропущено: {state['skipped']:,}\n"
+        f"❌ Ошибок: {state['failed']:,}"
+    )
 
-        await message.answer(
-            f"{text}!\n"
-            f"+{earn} монет\n"
-            f"Использован 1 ускоритель\n"
-            f"Баланс: {format_balance(user_id)}\n"
-            f"Осталось ускорителей: {user_accelerators.get(user_id, 0)}",
-            reply_markup=jobs_keyboard()
-        )
-        save_data()
-        return
 
-    if text == "Игры":
-        await message.answer("🎮 ВЫБЕРИТЕ ИГРУ:", reply_markup=games_keyboard())
-        return
+async def broadcast_one(user_id: int, state: dict) -> str:
+    try:
+        if state["copy"]:
+            await bot.copy_message(user_id, state["copy"]["chat_id"], state["copy"]["message_id"])
+        else:
+            await bot.send_message(user_id, state["text"], parse_mode="HTML")
+        return "sent"
+    except TelegramForbiddenError:
+        blocked_users.add(user_id)
+        journal.append(user_id, "blocked", True)
+        mark_meta_dirty("blocked_users")
+        return "blocked"
+    except TelegramBadRequest as e:
+        if is_parse_error(e):
+            raise
+        logger.warning(f"⚠️ Рассылка: не удалось отправить {user_id}: {e}")
+        return "failed"
+    except Exception as e:
+        logger.warning(f"⚠️ Рассылка: не удалось отправить {user_id}: {e}")
+        return "failed"
+
+
+def next_broadcast_batch(after_id: int) -> list:
+    """Следующие BROADCAST_BATCH id после after_id по возрастанию, без копии всего users"""
+    return heapq.nsmallest(BROADCAST_BATCH, filter(after_id.__lt__, users))
+
+
+async def run_broadcast(state: dict):
+    """Идёт курсором по id в порядке возрастания, выбирая из users по BROADCAST_BATCH id.
+
+    В файл пишется last_id - все, кто не больше, уже обработаны, - и completed:
+    обработанные id выше last_id, которые после перезапуска пропускаются.
+    """
+    bucket = TokenBucket(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    in_flight = {}  # user_id -> задача отправки
+    completed = set(state.get("completed", ()))
+    checkpoint_at = time.monotonic() + BROADCAST_CHECKPOINT_INTERVAL
+    passed = state["last_id"]  # последний id, который отправлен в работу или пропущен
+    failure = None  # ошибка разметки: остальным отправлять бессмысленно
+
+    def processed_up_to() -> int:
+        # Всё, что меньше самого раннего неотвеченного запроса, уже отправлено
+        return min(in_flight) - 1 if in_flight else passed
+
+    def checkpoint():
+        state["last_id"] = processed_up_to()
+        completed.difference_update([user_id for user_id in completed if user_id <= state["last_id"]])
+        state["completed"] = sorted(completed)
+
+    async def limit_completed():
+        # Пока висит самый ранний запрос, отметка стоит, а обработанные id выше неё
+        # копятся - дальше BROADCAST_COMPLETED_MAX ждём, пока он ответит
+        while len(completed) >= BROADCAST_COMPLETED_MAX:
+            checkpoint()
+            if len(completed) < BROADCAST_COMPLETED_MAX or not in_flight:
+                return
+            await asyncio.wait([in_flight[min(in_flight)]])
 
-    if text == "Казино":
-        await message.answer(
-            "🎰 <b>КАЗИНО</b>\n\nПравила:\n• 50% шанс на выигрыш\n• Выигрыш = ставка × 2\n\nКоманда: <code>/bet сумма</code>",
-            parse_mode="HTML",
-            reply_markup=games_keyboard()
-        )
-        return
+    async def send(user_id: int):
+        nonlocal failure
+        try:
+            state[await broadcast_one(user_id, state)] += 1
+        except TelegramBadRequest as e:
+            state["failed"] += 1
+            failure = e
+        finally:
+            del in_flight[user_id]
+            completed.add(user_id)
+            semaphore.release()
 
-    if text == "Монетка":
-        result = random.choice(['Орёл', 'Решка'])
-        await message.answer(
-            f"🪙 <b>{result}</b>\nБаланс: {format_balance(user_id)}",
-            parse_mode="HTML",
-            reply_markup=games_keyboard()
-        )
-        return
+    try:
+        batch = next_broadcast_batch(passed)
+        while batch and failure is None:
+            for user_id in batch:
+                if failure is not None:
+                    break
+                await limit_completed()
+                if user_id in completed:
+                    passed = user_id  # обработан до перезапуска
+                    continue
+                if user_id in blocked_users or user_id not in users:
+                    state["skipped"] += 1
+                    completed.add(user_id)
+                    passed = user_id
+                    if state["skipped"] % 1000 == 0:
+                        await asyncio.sleep(0)
+                    continue
+
+                await semaphore.acquire()
+                await asyncio.sleep(bucket.reserve(time.monotonic()))
+                in_flight[user_id] = asyncio.create_task(send(user_id))
+                passed = user_id
+
+                if time.monotonic() >= checkpoint_at:
+                    checkpoint()
+                    await asyncio.to_thread(_write_broadcast_state, dict(state))
+                    checkpoint_at = time.monotonic() + BROADCAST_CHECKPOINT_INTERVAL
+            batch = next_broadcast_batch(passed)
+
+        await asyncio.gather(*in_flight.values())
+    except asyncio.CancelledError:
+        # Отметку берём до отмены: отменённые запросы снимутся с in_flight, но не отправлены
+        checkpoint()
+        tasks = list(in_flight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if state.get("stopped"):
+            _remove_broadcast_state()
+        else:
+            # Бот останавливается - продолжим с этого места после перезапуска
+            _write_broadcast_state(state)
+        raise
+
+    state["done"] = True
+    if failure is not None:
+        state["error"] = str(failure)
+        title = f"❌ <b>РАССЫЛКА ПРЕРВАНА</b>\nОшибка разметки: {html.escape(str(failure))}"
+        logger.error(f"❌ Рассылка прервана: {failure}")
+    else:
+        state["last_id"] = passed
+        state["completed"] = []
+        title = "✅ <b>РАССЫЛКА ЗАВЕРШЕНА</b>"
+        logger.info(f"📨 Рассылка завершена: отправлено {state['sent']:,}, заблокировали {state['blocked']:,}")
+    await asyncio.to_thread(_write_broadcast_state, dict(state))
+    try:
+        await bot.send_message(state["admin_id"], title + "\n\n" + broadcast_summary(state), parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Не удалось отправить итог рассылки: {e}")
 
-    if text == "Мини-игра":
-        await message.answer(
-            "💣 <b>МИНИ-ИГРА: САПЁР</b>\n\nПравила:\n• Поле 5×5\n• Каждая пустая клетка ×1.3 к выигрышу\n\nИспользуй: <code>/mini сумма</code>\nПример: <code>/mini 100</code>",
-            parse_mode="HTML",
-            reply_markup=games_keyboard()
-        )
-        return
 
-    if text == "Рулетка":
-        await message.answer(
-            "🎰 <b>РУЛЕТКА</b>\n\nПравила:\n• Выберите число от 0 до 36\n• Выигрыш = ставка × 36\n\nКоманда: <code>/roulette сумма</code>",
-            parse_mode="HTML",
-            reply_markup=games_keyboard()
-        )
-        return
+def start_broadcast(state: dict):
+    global broadcast_task, broadcast_state
+    broadcast_state = state
+    broadcast_task = asyncio.create_task(run_broadcast(state))
+
+
+def broadcast_running() -> bool:
+    return broadcast_task is not None and not broadcast_task.done()
 
-    if text == "Донат":
-        await message.answer(
-            "⭐ <b>ДОНАТ МАГАЗИН</b>\n\n"
-            "💰 <b>Коины:</b>\n"
-            f"• 1 ⭐ = {STAR_TO_COINS:,} коинов\n"
-            "Используй: <code>/buy_coins количество_звезд</code>\n"
-            "Пример: <code>/buy_coins 10</code>\n\n"
-            "👑 <b>Привилегии:</b>\n"
-            f"• Элит - {ELITE_PRICE} ⭐\n"
-            "  - Ежедневный бонус: 2500 коинов\n"
-            "  - Ускорители: 60 в день\n\n"
-            f"• Делюкс - {DELUXE_PRICE} ⭐\n"
-            "  - Ежедневный бонус: 5000 коинов\n"
-            "  - Ускорители: 100 в день\n\n"
-            "📊 История покупок: /donate_history\n"
-            "↩️ Возврат звёзд: /refund код_транзакции",
-            parse_mode="HTML",
-            reply_markup=donate_keyboard()
-        )
-        return
 
-    if text in ["Купить Элит (50 ⭐)", "Купить Делюкс (99 ⭐)"]:
-        # Здесь будет обработка покупки через инвойсы
-        await message.answer("Эта функция временно недоступна. Используйте команду /buy_elite или /buy_deluxe")
+async def launch_broadcast(state: dict):
+    """Начинает новую рассылку по игрокам этого шарда"""
+    state["total"] = len(users) - len(blocked_users)
+    await asyncio.to_thread(_write_broadcast_state, state)
+    start_broadcast(state)
+    logger.info(f"📨 Рассылка запущена админом {state['admin_id']}: {state['total']:,} получателей")
+
+
+async def stop_broadcast() -> bool:
+    if not broadcast_running():
+        return False
+    broadcast_state["stopped"] = True
+    broadcast_task.cancel()
+    try:
+        await broadcast_task
+    except asyncio.CancelledError:
+        pass
+    return True
+
+
+async def apply_shard_broadcast(action: str, state: Optional[dict]):
+    # Рассылку, начатую или остановленную на другом шарде, повторяем у себя
+    if action == "stop":
+        await stop_broadcast()
+    elif broadcast_running():
+        logger.warning("⚠️ Рассылка с другого шарда пропущена: здесь идёт своя")
+    else:
+        await launch_broadcast(state)
+
+
+def resume_broadcast():
+    # Рассылка, прерванная остановкой бота, продолжается с сохранённого места
+    if not os.path.exists(BROADCAST_FILE):
+        return
+    try:
+        with open(BROADCAST_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ Не удалось прочитать прогресс рассылки: {e}")
         return
+    if not state.get("done"):
+        logger.info(f"📨 Продолжаем рассылку после id {state['last_id']}: отправлено {state['sent']:,}")
+        start_broadcast(state)
 
-    if text == "Купить коины":
-        await message.answer(
-            "💰 <b>ПОКУПКА КОИНОВ</b>\n\n"
-            "Используйте: <code>/buy_coins количество_звезд</code>\n"
-            f"1 ⭐ = {STAR_TO_COINS:,} коинов\n\n"
-            "Пример: <code>/buy_coins 10</code>",
-            parse_mode="HTML"
-        )
+
+@dp.message(Command("broadcast"))
+@rate_limit(2)
+async def cmd_broadcast(message: Message, command: CommandObject):
+    user_id = message.from_user.id
+
+    if not (is_admin(user_id) or has_rank(user_id, "Admin")):
+        await message.answer("❌ Только админы могут использовать эту команду")
         return
 
-    if text == "Банк":
-        await message.answer(
-            "🏦 <b>БАНК</b>\n\n"
-            f"💰 На кармане: {format_balance(user_id)}\n"
-            f"🏦 В банке: {format_bank_balance(user_id)}",
-            parse_mode="HTML",
-            reply_markup=bank_keyboard()
-        )
+    running = broadcast_running()
+    args = (command.args or "").strip()
+
+    if args == "stop":
+        if SHARD_COUNT > 1:
+            await shard_send(("broadcast", "stop", None, SHARD_INDEX))
+        if not await stop_broadcast():
+            note = "\n🧩 Остальным шардам отправлена команда остановки" if SHARD_COUNT > 1 else ""
+            await message.answer("📭 Рассылка сейчас не идёт" + note)
+            return
+        await message.answer("🛑 <b>Рассылка остановлена</b>\n\n" + broadcast_summary(broadcast_state), parse_mode="HTML")
         return
 
-    if text in ["Внести", "Снять"]:
-        action = "положить" if text == "Внести" else "снять"
-        cmd = "/bank" if text == "Внести" else "/bank w"
+    if not args and not message.reply_to_message:
+        if running:
+            await message.answer("📨 <b>ИДЁТ РАССЫЛКА</b>\n\n" + broadcast_summary(broadcast_state), parse_mode="HTML")
+            return
         await message.answer(
-            f"🏦 <b>БАНК - {action.upper()}</b>\n\nИспользуйте: <code>{cmd} сумма</code>\nПример: <code>{cmd} 1000</code>",
+            "📨 <b>РАССЫЛКА</b>\n\n"
+            "<code>/broadcast текст</code> - отправить текст всем игрокам\n"
+            "Ответ на сообщение + <code>/broadcast</code> - разослать это сообщение\n"
+            "<code>/broadcast</code> - ход текущей рассылки\n"
+            "<code>/broadcast stop</code> - остановить",
             parse_mode="HTML"
         )
         return
 
-    if text == "Бизнес":
-        if user_id not in business_data:
-            ensure_user(user_id)
+    if running:
+        await message.answer("⏳ Предыдущая рассылка ещё идёт. Остановить: <code>/broadcast stop</code>", parse_mode="HTML")
+        return
 
-        business = business_data[user_id]
-        if business["type"]:
-            biz_info = BUSINESS_TYPES[business["type"]]
-            profit_text = (
-                f"🏢 <b>ВАШ БИЗНЕС:</b>\n\n"
-                f"Название: {biz_info['name']}\n"
-                f"💰 Прибыль: {business['profit']:,} монет\n"
-                f"⚡ Активен: {'✅ Да' if business['active'] else '❌ Нет'}\n"
-                f"💵 Прибыль/период: {biz_info['base_profit']:,} монет\n"
-                f"⏱️ Период: {biz_info['profit_period']} сек"
-            )
+    copy = None
+    if not args:
+        copy = {"chat_id": message.chat.id, "message_id": message.reply_to_message.message_id}
+    else:
+        # Сначала показываем текст самому админу: битая разметка не уйдёт тысячам игроков
+        try:
+            await message.answer(args, parse_mode="HTML")
+        except TelegramBadRequest as e:
+            await message.answer(f"❌ Рассылка не запущена, ошибка разметки:\n{html.escape(str(e))}", parse_mode="HTML")
+            return
+    state = {
+        "admin_id": user_id,
+        "text": args,
+        "copy": copy,
+        "last_id": -2 ** 63,
+        "total": 0,
+        "sent": 0,
+        "blocked": 0,
+        "skipped": 0,
+        "failed": 0,
+        "started_at": datetime.now().isoformat(),
+    }
+    if SHARD_COUNT > 1:
+        # Каждый шард рассылает своим игрокам и сам присылает итог
+        await shard_send(("broadcast", "start", dict(state), SHARD_INDEX))
+    await launch_broadcast(state)
+    await message.answer(
+        f"📨 Рассылка запущена: {state['total']:,} получателей, до {BROADCAST_RATE:g} сообщений в секунду"
+        + (f"\n🧩 Это игроки шарда {SHARD_INDEX + 1}, остальные шарды пришлют свои итоги" if SHARD_COUNT > 1 else "")
+    )
+
+
+# ---------------- ТЕКСТОВЫЙ ОБРАБОТЧИК ----------------
+# Маршруты текстов и кнопок меню. Порядок проверки повторяет прежнюю цепочку if:
+# сначала алиасы без учёта регистра, затем префиксы, затем точный текст
+text_routes = {}  # точный текст -> обработчик
+text_aliases = {}  # текст в нижнем регистре -> обработчик
+text_prefix_routes = []  # (префикс, обработчик)
+
+
+def text_route(*texts: str, lower: bool = False, prefix: str = None):
+    """Регистрирует обработчик текста: async (message, text, user_id, player)"""
+    def decorator(func):
+        for route_text in texts:
+            if lower:
+                text_aliases[route_text.lower()] = func
+            else:
+                text_routes[route_text] = func
+        if prefix:
+            text_prefix_routes.append((prefix, func))
+        return func
+
+    return decorator
+
+
+def load_text_plugins():
+    # Модули из TEXT_PLUGINS (через запятую) регистрируют свои маршруты в setup(text_route)
+    for module_name in filter(None, os.getenv("TEXT_PLUGINS", "").split(",")):
+        module = importlib.import_module(module_name.strip())
+        module.setup(text_route)
+        logger.info(f"🧩 Подключён модуль маршрутов: {module_name}")
+
+
+@dp.message(F.text)
+@rate_limit(0.5)
+async def text_handler(message: Message):
+    text = message.text.strip()
+    user_id = message.from_user.id
+    player = ensure_user(user_id)
+
+    handler = text_aliases.get(text.lower())
+    if handler is None:
+        for prefix, prefix_handler in text_prefix_routes:
+            if text.startswith(prefix):
+                handler = prefix_handler
+                break
         else:
-            profit_text = "🏢 У вас нет бизнеса! Купите в меню."
+            handler = text_routes.get(text)
+
+    if handler is not None:
+        started = time.perf_counter()
+        try:
+            await handler(message, text, user_id, player)
+        finally:
+            metrics.observe("route", handler.__name__, time.perf_counter() - started)
+
+
+@text_route("я", lower=True)
+async def route_profile_full(message: Message, text: str, user_id: int, player: UserState):
+    user = message.from_user
+    profile = player.profile
+    status = get_user_status(user_id)
+
+    profile_text = (
+        f"👤 <b>ПРОФИЛЬ: {user.first_name}</b>\n"
+        f"🆔 ID: <code>{user_id}</code>\n"
+        f"👑 Статус: {status}\n\n"
+        f"📊 <b>СТАТИСТИКА:</b>\n"
+        f"Уровень: {profile.level}\n"
+        f"Опыт: {profile.xp:,}/{profile.next_level_xp:,}\n"
+        f"💰 Баланс: {format_balance(user_id)}\n"
+        f"🏦 В банке: {format_bank_balance(user_id)}\n"
+        f"⚡ Ускорители: {player.accelerators}\n\n"
+        f"🏠 <b>ИМУЩЕСТВО:</b>\n"
+    )
+
+    mine = accrue_mine(user_id)
+    level_info = MINE_LEVELS[mine.level]
+    mine_value = mine.resources * level_info["price_per_unit"]
+    profile_text += (
+        f"⛏️ РУДНИК:\n"
+        f"   {level_info['name']}\n"
+        f"   Ресурсы: {mine.resources:,} {level_info['resource']}\n"
+        f"   💎 Стоимость: {mine_value:,} монет\n"
+    )
+
+    if player.business.type:
+        business = accrue_business(user_id)
+        biz_info = BUSINESS_TYPES[business.type]
+        profile_text += (
+            f"🏢 БИЗНЕС:\n"
+            f"   {biz_info['name']}\n"
+            f"   💰 Прибыль: {business.profit:,} монет\n"
+        )
+
+    await message.answer(profile_text, parse_mode="HTML", reply_markup=main_keyboard())
+
+
+@text_route("б", "баланс", lower=True)
+async def route_balance(message: Message, text: str, user_id: int, player: UserState):
+    balance_text = (
+        f"💰 <b>ВАШ БАЛАНС</b>\n\n"
+        f"Наличные: {format_balance(user_id)}\n"
+        f"⚡ Ускорители: {player.accelerators}\n"
+        f"🏦 В банке: {format_bank_balance(user_id)}\n"
+    )
+    if has_infinite_balance(user_id):
+        balance_text += "✨ Бесконечный баланс активирован!"
+    await message.answer(balance_text, parse_mode="HTML", reply_markup=main_keyboard())
+
+
+@text_route(prefix="#")
+async def route_promo(message: Message, text: str, user_id: int, player: UserState):
+    promo_code = text[1:].upper()
+    await process_promo_code(message, promo_code)
+
+
+@text_route("Назад в меню")
+async def route_back(message: Message, text: str, user_id: int, player: UserState):
+    await message.answer("↩️ Главное меню:", reply_markup=main_keyboard())
+
+
+@text_route("Профиль")
+async def route_profile_menu(message: Message, text: str, user_id: int, player: UserState):
+    await message.answer(
+        "👤 <b>ВАШ ПРОФИЛЬ</b>\n\nВыберите действие:",
+        parse_mode="HTML",
+        reply_markup=profile_keyboard()
+    )
+
 
-        await message.answer(profit_text, parse_mode="HTML", reply_markup=business_keyboard())
+@text_route("Статистика")
+async def route_stats(message: Message, text: str, user_id: int, player: UserState):
+    user = message.from_user
+    profile = player.profile
+    status = get_user_status(user_id)
+
+    stats_text = (
+        f"👤 <b>ПРОФИЛЬ: {user.first_name}</b>\n"
+        f"🆔 ID: <code>{user_id}</code>\n"
+        f"👑 Статус: {status}\n\n"
+        f"📊 <b>СТАТИСТИКА:</b>\n"
+        f"Уровень: {profile.level}\n"
+        f"Опыт: {profile.xp:,}/{profile.next_level_xp:,}\n"
+        f"💰 Баланс: {format_balance(user_id)}\n"
+        f"🏦 В банке: {format_bank_balance(user_id)}\n"
+        f"⚡ Ускорители: {player.accelerators}\n"
+    )
+
+    await message.answer(stats_text, parse_mode="HTML", reply_markup=profile_keyboard())
+
+
+@text_route("Имущество")
+async def route_assets(message: Message, text: str, user_id: int, player: UserState):
+    assets_text = "🏠 <b>ВАШЕ ИМУЩЕСТВО:</b>\n\n"
+
+    mine = accrue_mine(user_id)
+    level_info = MINE_LEVELS[mine.level]
+    mine_value = mine.resources * level_info["price_per_unit"]
+    assets_text += (
+        f"⛏️ <b>РУДНИК:</b>\n"
+        f"   {level_info['name']} (Уровень {mine.level + 1})\n"
+        f"   Ресурсы: {mine.resources:,} {level_info['resource']}\n"
+        f"   💎 Стоимость: {mine_value:,} монет\n"
+        f"   ⚡ Авто-сбор: {'✅ Вкл' if mine.auto_collect else '❌ Выкл'}\n\n"
+    )
+
+    if player.business.type:
+        business = accrue_business(user_id)
+        biz_info = BUSINESS_TYPES[business.type]
+        business_value = biz_info["cost"] // 2 + business.profit
+        assets_text += (
+            f"🏢 <b>БИЗНЕС:</b>\n"
+            f"   {biz_info['name']}\n"
+            f"   💰 Прибыль: {business.profit:,} монет\n"
+            f"   💎 Стоимость: {business_value:,} монет\n\n"
+        )
+
+    assets_text += f"🏦 <b>БАНК:</b> {format_bank_balance(user_id)} монет"
+
+    await message.answer(assets_text, parse_mode="HTML", reply_markup=profile_keyboard())
+
+
+@text_route("Работа")
+async def route_work(message: Message, text: str, user_id: int, player: UserState):
+    if not can_work(user_id):
+        await message.answer(
+            "❌ У вас закончились ускорители!\nПолучите ускорители через /daily или промокоды.",
+            reply_markup=main_keyboard()
+        )
         return
+    await message.answer("💼 Выберите работу:", reply_markup=jobs_keyboard())
 
-    if text == "Купить бизнес":
-        biz_list = "🏢 <b>ДОСТУПНЫЕ БИЗНЕСЫ:</b>\n\n"
-        for biz_id, biz_info in BUSINESS_TYPES.items():
-            biz_list += (
-                f"• {biz_info['name']}\n"
-                f"  💰 Цена: {biz_info['cost']:,} монет\n"
-                f"  💵 Прибыль: {biz_info['base_profit']:,}/{biz_info['profit_period']}сек\n"
-                f"  🛒 Купить: <code>/buybusiness {biz_id}</code>\n\n"
-            )
-        await message.answer(biz_list, parse_mode="HTML", reply_markup=business_keyboard())
+
+@text_route("Курьер", "Таксист", "Программист")
+async def route_job(message: Message, text: str, user_id: int, player: UserState):
+    if not can_work(user_id):
+        await message.answer("❌ Нет ускорителей!", reply_markup=jobs_keyboard())
         return
 
-    if text == "Собрать прибыль":
-        if user_id not in business_data or not business_data[user_id]["type"]:
-            await message.answer("❌ У вас нет бизнеса!", reply_markup=business_keyboard())
-            return
+    earnings = {
+        "Курьер": (10, 30),
+        "Таксист": (20, 50),
+        "Программист": (50, 120)
+    }
 
-        business = business_data[user_id]
-        if not business["active"]:
-            await message.answer("❌ Бизнес не активен!", reply_markup=business_keyboard())
-            return
+    earn = random.randint(*earnings[text])
+    use_accelerator(user_id, 1)
 
-        profit = business["profit"]
-        if profit > 0:
-            add_balance(user_id, profit)
-            add_xp(user_id, profit // 100)
-            business["profit"] = 0
-            business["last_collect"] = datetime.now()
-            await message.answer(
-                f"💰 <b>Собрано прибыли: {profit:,} монет!</b>\nБаланс: {format_balance(user_id)}",
-                parse_mode="HTML",
-                reply_markup=business_keyboard()
-            )
-            save_data()
-        else:
-            await message.answer("ℹ️ Пока нет прибыли для сбора.", reply_markup=business_keyboard())
-        return
+    if not has_infinite_balance(user_id):
+        add_balance(user_id, earn)
+        add_xp(user_id, earn // 10)
+
+    save_data(user_id)
+    await message.answer(
+        f"{text}!\n"
+        f"+{earn} монет\n"
+        f"Использован 1 ускоритель\n"
+        f"Баланс: {format_balance(user_id)}\n"
+        f"Осталось ускорителей: {player.accelerators}",
+        reply_markup=jobs_keyboard()
+    )
+
+
+@text_route("Игры")
+async def route_games(message: Message, text: str, user_id: int, player: UserState):
+    await message.answer("🎮 ВЫБЕРИТЕ ИГРУ:", reply_markup=games_keyboard())
+
+
+@text_route("Казино")
+async def route_casino(message: Message, text: str, user_id: int, player: UserState):
+    await message.answer(
+        "🎰 <b>КАЗИНО</b>\n\nПравила:\n• 50% шанс на выигрыш\n• Выигрыш = ставка × 2\n\nКоманда: <code>/bet сумма</code>",
+        parse_mode="HTML",
+        reply_markup=games_keyboard()
+    )
+
+
+@text_route("Монетка")
+async def route_coin(message: Message, text: str, user_id: int, player: UserState):
+    result = random.choice(['Орёл', 'Решка'])
+    await message.answer(
+        f"🪙 <b>{result}</b>\nБаланс: {format_balance(user_id)}",
+        parse_mode="HTML",
+        reply_markup=games_keyboard()
+    )
+
+
+@text_route("Мини-игра")
+async def route_mini_info(message: Message, text: str, user_id: int, player: UserState):
+    await message.answer(
+        "💣 <b>МИНИ-ИГРА: САПЁР</b>\n\nПравила:\n• Поле 5×5\n• Каждая пустая клетка ×1.3 к выигрышу\n\nИспользуй: <code>/mini сумма</code>\nПример: <code>/mini 100</code>",
+        parse_mode="HTML",
+        reply_markup=games_keyboard()
+    )
+
+
+@text_route("Рулетка")
+async def route_roulette_info(message: Message, text: str, user_id: int, player: UserState):
+    await message.answer(
+        "🎰 <b>РУЛЕТКА</b>\n\nПравила:\n• Выберите число от 0 до 36\n• Выигрыш = ставка × 36\n\nКоманда: <code>/roulette сумма</code>",
+        parse_mode="HTML",
+        reply_markup=games_keyboard()
+    )
+
+
+@text_route("Донат")
+async def route_donate(message: Message, text: str, user_id: int, player: UserState):
+    await message.answer(
+        "⭐ <b>ДОНАТ МАГАЗИН</b>\n\n"
+        "💰 <b>Коины:</b>\n"
+        f"• 1 ⭐ = {STAR_TO_COINS:,} коинов\n"
+        "Используй: <code>/buy_coins количество_звезд</code>\n"
+        "Пример: <code>/buy_coins 10</code>\n\n"
+        "👑 <b>Привилегии:</b>\n"
+        f"• Элит - {ELITE_PRICE} ⭐\n"
+        "  - Ежедневный бонус: 2500 коинов\n"
+        "  - Ускорители: 60 в день\n\n"
+        f"• Делюкс - {DELUXE_PRICE} ⭐\n"
+        "  - Ежедневный бонус: 5000 коинов\n"
+        "  - Ускорители: 100 в день\n\n"
+        "📊 История покупок: /donate_history\n"
+        "↩️ Возврат звёзд: /refund код_транзакции",
+        parse_mode="HTML",
+        reply_markup=donate_keyboard()
+    )
+
+
+@text_route("Купить Элит (50 ⭐)", "Купить Делюкс (99 ⭐)")
+async def route_buy_premium(message: Message, text: str, user_id: int, player: UserState):
+    # Здесь будет обработка покупки через инвойсы
+    await message.answer("Эта функция временно недоступна. Используйте команду /buy_elite или /buy_deluxe")
+
+
+@text_route("Купить коины")
+async def route_buy_coins(message: Message, text: str, user_id: int, player: UserState):
+    await message.answer(
+        "💰 <b>ПОКУПКА КОИНОВ</b>\n\n"
+        "Используйте: <code>/buy_coins количество_звезд</code>\n"
+        f"1 ⭐ = {STAR_TO_COINS:,} коинов\n\n"
+        "Пример: <code>/buy_coins 10</code>",
+        parse_mode="HTML"
+    )
+
+
+@text_route("Банк")
+async def route_bank(message: Message, text: str, user_id: int, player: UserState):
+    await message.answer(
+        "🏦 <b>БАНК</b>\n\n"
+        f"💰 На кармане: {format_balance(user_id)}\n"
+        f"🏦 В банке: {format_bank_balance(user_id)}",
+        parse_mode="HTML",
+        reply_markup=bank_keyboard()
+    )
+
+
+@text_route("Внести", "Снять")
+async def route_bank_hint(message: Message, text: str, user_id: int, player: UserState):
+    action = "положить" if text == "Внести" else "снять"
+    cmd = "/bank" if text == "Внести" else "/bank w"
+    await message.answer(
+        f"🏦 <b>БАНК - {action.upper()}</b>\n\nИспользуйте: <code>{cmd} сумма</code>\nПример: <code>{cmd} 1000</code>",
+        parse_mode="HTML"
+    )
+
+
+@text_route("Бизнес")
+async def route_business(message: Message, text: str, user_id: int, player: UserState):
+    business = accrue_business(user_id)
+    if business.type:
+        biz_info = BUSINESS_TYPES[business.type]
+        profit_text = (
+            f"🏢 <b>ВАШ БИЗНЕС:</b>\n\n"
+            f"Название: {biz_info['name']}\n"
+            f"💰 Прибыль: {business.profit:,} монет\n"
+            f"⚡ Активен: {'✅ Да' if business.active else '❌ Нет'}\n"
+            f"💵 Прибыль/период: {biz_info['base_profit']:,} монет\n"
+            f"⏱️ Период: {biz_info['profit_period']} сек"
+        )
+    else:
+        profit_text = "🏢 У вас нет бизнеса! Купите в меню."
+
+    await message.answer(profit_text, parse_mode="HTML", reply_markup=business_keyboard())
+
+
+@text_route("Купить бизнес")
+async def route_business_list(message: Message, text: str, user_id: int, player: UserState):
+    biz_list = "🏢 <b>ДОСТУПНЫЕ БИЗНЕСЫ:</b>\n\n"
+    for biz_id, biz_info in BUSINESS_TYPES.items():
+        biz_list += (
+            f"• {biz_info['name']}\n"
+            f"  💰 Цена: {biz_info['cost']:,} монет\n"
+            f"  💵 Прибыль: {biz_info['base_profit']:,}/{biz_info['profit_period']}сек\n"
+            f"  🛒 Купить: <code>/buybusiness {biz_id}</code>\n\n"
+        )
+    await message.answer(biz_list, parse_mode="HTML", reply_markup=business_keyboard())
 
-    if text == "Продать бизнес":
-        if user_id not in business_data or not business_data[user_id]["type"]:
-            await message.answer("❌ У вас нет бизнеса!", reply_markup=business_keyboard())
-            return
 
-        business = business_data[user_id]
-        biz_info = BUSINESS_TYPES[business["type"]]
-        sell_price = biz_info["cost"] // 2
-        total_received = sell_price + business["profit"]
+@text_route("Собрать прибыль")
+async def route_collect_profit(message: Message, text: str, user_id: int, player: UserState):
+    if not player.business.type:
+        await message.answer("❌ У вас нет бизнеса!", reply_markup=business_keyboard())
+        return
 
-        add_balance(user_id, total_received)
-        add_xp(user_id, total_received // 50)
+    business = accrue_business(user_id)
+    if not business.active:
+        await message.answer("❌ Бизнес не активен!", reply_markup=business_keyboard())
+        return
 
+    profit = business.profit
+    if profit > 0:
+        add_balance(user_id, profit)
+        add_xp(user_id, profit // 100)
+        business.profit = 0
+        save_data(user_id)
         await message.answer(
-            f"💼 <b>Бизнес продан!</b>\n\n"
-            f"{biz_info['name']}\n"
-            f"💰 Стоимость: {sell_price:,} монет\n"
-            f"💵 Прибыль: {business['profit']:,} монет\n"
-            f"💎 Всего: {total_received:,} монет\n"
-            f"💳 Баланс: {format_balance(user_id)}",
+            f"💰 <b>Собрано прибыли: {profit:,} монет!</b>\nБаланс: {format_balance(user_id)}",
             parse_mode="HTML",
             reply_markup=business_keyboard()
         )
+    else:
+        await message.answer("ℹ️ Пока нет прибыли для сбора.", reply_markup=business_keyboard())
 
-        business_data[user_id] = {"type": None, "profit": 0, "active": False, "last_collect": None}
-        save_data()
-        return
 
-    if text == "Рудник":
-        mine_info = get_mine_info(user_id)
-        await message.answer(mine_info, parse_mode="HTML", reply_markup=mine_keyboard())
+@text_route("Продать бизнес")
+async def route_sell_business(message: Message, text: str, user_id: int, player: UserState):
+    if not player.business.type:
+        await message.answer("❌ У вас нет бизнеса!", reply_markup=business_keyboard())
         return
 
-    if text == "Собрать ресурсы":
-        if user_id not in mine_data:
-            ensure_user(user_id)
-        mine = mine_data[user_id]
-        if mine["resources"] > 0:
-            level_info = MINE_LEVELS[mine["level"]]
-            total = mine["resources"] * level_info["price_per_unit"]
-            add_balance(user_id, total)
-            add_xp(user_id, total // 20)
-            await message.answer(
-                f"💰 <b>Ресурсы собраны!</b>\n"
-                f"Добыто: {mine['resources']:,} {level_info['resource']}\n"
-                f"Получено: {total:,} монет\n"
-                f"Баланс: {format_balance(user_id)}",
-                parse_mode="HTML",
-                reply_markup=mine_keyboard()
-            )
-            mine["resources"] = 0
-            save_data()
-        else:
-            await message.answer("ℹ️ Нет ресурсов для сбора.", reply_markup=mine_keyboard())
-        return
+    business = accrue_business(user_id)
+    biz_info = BUSINESS_TYPES[business.type]
+    sell_price = biz_info["cost"] // 2
+    total_received = sell_price + business.profit
 
-    if text == "Улучшить рудник":
-        if user_id not in mine_data:
-            ensure_user(user_id)
-        mine = mine_data[user_id]
-        if mine["level"] >= 2:
-            await message.answer("🎉 Рудник максимального уровня!", reply_markup=mine_keyboard())
-            return
+    # Бизнес снимается вместе с зачислением, до первого await
+    add_balance(user_id, total_received)
+    add_xp(user_id, total_received // 50)
+    player.business = BusinessState()
+    save_data(user_id)
 
-        next_level = mine["level"] + 1
-        upgrade_cost = MINE_LEVELS[next_level]["upgrade_cost"]
+    await message.answer(
+        f"💼 <b>Бизнес продан!</b>\n\n"
+        f"{biz_info['name']}\n"
+        f"💰 Стоимость: {sell_price:,} монет\n"
+        f"💵 Прибыль: {business.profit:,} монет\n"
+        f"💎 Всего: {total_received:,} монет\n"
+        f"💳 Баланс: {format_balance(user_id)}",
+        parse_mode="HTML",
+        reply_markup=business_keyboard()
+    )
 
-        if not can_spend(user_id, upgrade_cost):
-            await message.answer(
-                f"❌ Недостаточно монет!\nНужно: {upgrade_cost:,} монет\nУ вас: {format_balance(user_id)}",
-                reply_markup=mine_keyboard()
-            )
-            return
 
-        spend_balance(user_id, upgrade_cost)
-        mine["level"] = next_level
-        add_xp(user_id, upgrade_cost // 100)
+@text_route("Рудник")
+async def route_mine(message: Message, text: str, user_id: int, player: UserState):
+    mine_info = get_mine_info(user_id)
+    await message.answer(mine_info, parse_mode="HTML", reply_markup=mine_keyboard())
+
 
-        new_level_info = MINE_LEVELS[next_level]
+@text_route("Собрать ресурсы")
+async def route_collect_resources(message: Message, text: str, user_id: int, player: UserState):
+    mine = accrue_mine(user_id)
+    if mine.resources > 0:
+        level_info = MINE_LEVELS[mine.level]
+        mined = mine.resources
+        total = mined * level_info["price_per_unit"]
+        add_balance(user_id, total)
+        add_xp(user_id, total // 20)
+        mine.resources = 0
+        save_data(user_id)
         await message.answer(
-            f"🎉 <b>Рудник улучшен!</b>\n\n"
-            f"Новый уровень: {new_level_info['name']}\n"
-            f"Ресурс: {new_level_info['resource']}\n"
-            f"💎 Цена за единицу: {new_level_info['price_per_unit']} монет\n"
-            f"💰 Баланс: {format_balance(user_id)}",
+            f"💰 <b>Ресурсы собраны!</b>\n"
+            f"Добыто: {mined:,} {level_info['resource']}\n"
+            f"Получено: {total:,} монет\n"
+            f"Баланс: {format_balance(user_id)}",
             parse_mode="HTML",
             reply_markup=mine_keyboard()
         )
-        save_data()
-        return
+    else:
+        await message.answer("ℹ️ Нет ресурсов для сбора.", reply_markup=mine_keyboard())
 
-    if text == "Авто-сбор":
-        if user_id not in mine_data:
-            ensure_user(user_id)
-        mine = mine_data[user_id]
-        mine["auto_collect"] = not mine["auto_collect"]
-        status = "включен" if mine["auto_collect"] else "выключен"
-        await message.answer(f"⚡ Авто-сбор ресурсов {status}!", reply_markup=mine_keyboard())
-        save_data()
+
+@text_route("Улучшить рудник")
+async def route_upgrade_mine(message: Message, text: str, user_id: int, player: UserState):
+    mine = accrue_mine(user_id)
+    if mine.level >= 2:
+        await message.answer("🎉 Рудник максимального уровня!", reply_markup=mine_keyboard())
         return
 
-    if text == "Админ":
-        if is_admin(user_id):
-            admin_text = (
-                "👑 <b>АДМИН ПАНЕЛЬ</b>\n\n"
-                "/money - выдать монеты\n"
-                "/setmoney - установить баланс\n"
-                "/rank - выдать ранг\n"
-                "/unrank - снять ранг\n"
-                "/inf - бесконечный баланс\n"
-                "/removeinf - снять бесконечность\n"
-                "/createpromo - создать промокод\n"
-                "/chance - установить сложность мини-игры"
-            )
-        elif has_rank(user_id, "Admin") or has_rank(user_id, "moderator"):
-            admin_text = "🛡️ <b>ПАНЕЛЬ МОДЕРАТОРА</b>\n\n/money - выдать монеты (только себе)"
-        else:
-            admin_text = "❌ У вас нет админ прав"
+    next_level = mine.level + 1
+    upgrade_cost = MINE_LEVELS[next_level]["upgrade_cost"]
 
-        await message.answer(admin_text, parse_mode="HTML", reply_markup=main_keyboard())
+    if not can_spend(user_id, upgrade_cost):
+        await message.answer(
+            f"❌ Недостаточно монет!\nНужно: {upgrade_cost:,} монет\nУ вас: {format_balance(user_id)}",
+            reply_markup=mine_keyboard()
+        )
         return
 
-    if text == "Помощь":
-        await cmd_help(message)
-        return
+    spend_balance(user_id, upgrade_cost)
+    mine.level = next_level
+    add_xp(user_id, upgrade_cost // 100)
+
+    new_level_info = MINE_LEVELS[next_level]
+    save_data(user_id)
+    await message.answer(
+        f"🎉 <b>Рудник улучшен!</b>\n\n"
+        f"Новый уровень: {new_level_info['name']}\n"
+        f"Ресурс: {new_level_info['resource']}\n"
+        f"💎 Цена за единицу: {new_level_info['price_per_unit']} монет\n"
+        f"💰 Баланс: {format_balance(user_id)}",
+        parse_mode="HTML",
+        reply_markup=mine_keyboard()
+    )
+
+
+@text_route("Авто-сбор")
+async def route_auto_collect(message: Message, text: str, user_id: int, player: UserState):
+    mine = accrue_mine(user_id)
+    mine.auto_collect = not mine.auto_collect
+    mine.last_accrual = time.time()
+    status = "включен" if mine.auto_collect else "выключен"
+    save_data(user_id)
+    await message.answer(f"⚡ Авто-сбор ресурсов {status}!", reply_markup=mine_keyboard())
+
+
+@text_route("Админ")
+async def route_admin(message: Message, text: str, user_id: int, player: UserState):
+    if is_admin(user_id):
+        admin_text = (
+            "👑 <b>АДМИН ПАНЕЛЬ</b>\n\n"
+            "/money - выдать монеты\n"
+            "/setmoney - установить баланс\n"
+            "/rank - выдать ранг\n"
+            "/unrank - снять ранг\n"
+            "/inf - бесконечный баланс\n"
+            "/removeinf - снять бесконечность\n"
+            "/createpromo - создать промокод\n"
+            "/chance - установить сложность мини-игры"
+        )
+    elif has_rank(user_id, "Admin") or has_rank(user_id, "moderator"):
+        admin_text = "🛡️ <b>ПАНЕЛЬ МОДЕРАТОРА</b>\n\n/money - выдать монеты (только себе)"
+    else:
+        admin_text = "❌ У вас нет админ прав"
+
+    await message.answer(admin_text, parse_mode="HTML", reply_markup=main_keyboard())
+
+
+@text_route("Топ")
+async def route_top(message: Message, text: str, user_id: int, player: UserState):
+    await message.answer(format_top("money", user_id), parse_mode="HTML", reply_markup=top_keyboard())
+
+
+@text_route("Помощь")
+async def route_help(message: Message, text: str, user_id: int, player: UserState):
+    await cmd_help(message)
 
 
 async def process_promo_code(message: Message, promo_code: str):
     user_id = message.from_user.id
 
-    if promo_code not in promo_codes:
+    if promo_shard(promo_code) == SHARD_INDEX:
+        result = claim_promo(promo_code, user_id)
+        if result["status"] == "ok":
+            credit_local(user_id, result["amount"], result["kind"])
+            result["committed"] = True
+    else:
+        # Активации считает шард-владелец, он же присылает награду переводом
+        result = await claim_remote_promo(promo_code, user_id)
+
+    status = result["status"]
+    if status == "missing":
         await message.answer("❌ Неверный или несуществующий промокод")
         return
-
-    promo = promo_codes[promo_code]
-
-    if isinstance(promo["used_by"], list):
-        promo["used_by"] = set(promo["used_by"])
-
-    if len(promo["used_by"]) >= promo["max_activations"]:
+    if status == "exhausted":
         await message.answer("❌ Промокод уже использовал максимальное количество раз")
         return
-
-    if user_id in promo["used_by"]:
+    if status == "used":
         await message.answer("❌ Вы уже активировали этот промокод")
         return
+    if status == "timeout":
+        await message.answer("⏳ Промокод проверяется. Если он действителен, награда придёт автоматически")
+        return
 
-    promo["used_by"].add(user_id)
-
-    if promo["type"] == 'm':
-        add_balance(user_id, promo["amount"])
-        reward_text = f"{promo['amount']:,} монет"
+    if result["kind"] == "money":
+        reward_text = f"{result['amount']:,} монет"
     else:
-        add_accelerator(user_id, promo["amount"])
-        reward_text = f"{promo['amount']:,} ускорителей"
-
-    remaining = promo["max_activations"] - len(promo["used_by"])
+        reward_text = f"{result['amount']:,} ускорителей"
 
+    save_data(user_id)
     await message.answer(
         f"✅ <b>Промокод активирован!</b>\n\n"
         f"Вы получили: {reward_text}\n"
         f"Код: {promo_code}\n"
-        f"Осталось активаций: {remaining}\n\n"
+        f"Осталось активаций: {result['remaining']}\n\n"
         f"💰 Баланс: {format_balance(user_id)}\n"
-        f"⚡ Ускорителей: {user_accelerators.get(user_id, 0)}",
+        f"⚡ Ускорителей: {ensure_user(user_id).accelerators}" + transfer_note(result["committed"]),
         parse_mode="HTML"
     )
 
-    save_data()
+
+# ---------------- ШАРДИРОВАНИЕ ----------------
+# При SHARDS > 1 главный процесс только принимает апдейты и раздаёт их воркерам
+# по user_id % SHARDS. Каждый воркер хранит своих пользователей в отдельном файле.
+# Сообщения по каналу: ("update", raw), ("prepare", id, user_id, amount, шард-отправитель, вид),
+# ("commit", id, шард-отправитель, шард-получатель), ("forget", id, шард-получатель),
+# ("promo_claim", id, код, user_id, шард-отправитель), ("promo_result", id, результат, шард-отправитель),
+# ("stop",)
+# Промокод живёт на одном шарде (promo_shard): только он считает активации.
+shard_conn = None  # канал воркера к главному процессу
+shard_sender = None  # поток, который пишет в канал: send() может ждать, пока главный процесс читает
+transfer_waiters = {}  # transfer_id -> Future, который ждёт обработчик команды
+promo_waiters = {}  # id запроса промокода -> Future с ответом шарда-владельца
+shard_tasks = set()  # апдейты и сообщения других шардов, которые ещё обрабатываются
+
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    shard_tasks.add(task)
+    task.add_done_callback(shard_tasks.discard)
+    return task
+
+
+def shard_of(user_id: int) -> int:
+    return user_id % SHARD_COUNT
+
+
+def is_local_user(user_id: int) -> bool:
+    return SHARD_COUNT <= 1 or shard_of(user_id) == SHARD_INDEX
+
+
+def promo_shard(code: str) -> int:
+    # crc32, а не hash(): у каждого процесса hash() строк свой
+    return zlib.crc32(code.encode("utf-8")) % SHARD_COUNT if SHARD_COUNT > 1 else 0
+
+
+def shard_path(path: str, index: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
 
 
-# ---------------- ФОНОВЫЕ ЗАДАЧИ ----------------
-async def background_tasks():
+def transfer_note(committed: bool) -> str:
+    return "" if committed else "\n⏳ Зачисление получателю подтвердится в течение минуты"
+
+
+async def credit_user(user_id: int, amount: int, source_id: int = None, kind: str = "money") -> bool:
+    """Зачисляет монеты (kind="accelerators" - ускорители). Пользователю с другого шарда -
+    через двухфазную передачу.
+
+    Возвращает False, если другой шард ещё не подтвердил зачисление;
+    перевод остаётся в pending_transfers и будет отправлен повторно.
+    """
+    return await finish_credit(begin_credit(user_id, amount, source_id, kind))
+
+
+def begin_credit(user_id: int, amount: int, source_id: int = None, kind: str = "money") -> Optional[str]:
+    """Часть credit_user() без await: зачисляет своему шарду или записывает перевод
+    на другой шард в pending_transfers. Возвращает id перевода или None.
+
+    Её можно вызывать под блокировкой пользователей, а finish_credit() - уже без неё.
+    """
+    if is_local_user(user_id):
+        credit_local(user_id, amount, kind)
+        return None
+
+    transfer_id = uuid.uuid4().hex
+    pending_transfers[transfer_id] = {"user_id": user_id, "amount": amount, "source_id": source_id, "kind": kind}
+    journal_transfers()
+    return transfer_id
+
+
+async def finish_credit(transfer_id: Optional[str]) -> bool:
+    """Отправляет перевод, начатый begin_credit(), и ждёт подтверждения другого шарда"""
+    if transfer_id is None:
+        return True
+    user_id = pending_transfers[transfer_id]["user_id"]
+    # Списание и запись о переводе должны быть на диске до того, как монеты уйдут
+    await flush_data_async()
+
+    waiter = transfer_waiters[transfer_id] = asyncio.get_running_loop().create_future()
+    await send_prepare(transfer_id)
+    try:
+        await asyncio.wait_for(waiter, SHARD_TRANSFER_TIMEOUT)
+        return True
+    except asyncio.TimeoutError:
+        logger.warning(f"⏳ Перевод {transfer_id} ждёт подтверждения шарда {shard_of(user_id)}")
+        return False
+    finally:
+        transfer_waiters.pop(transfer_id, None)
+
+
+def credit_local(user_id: int, amount: int, kind: str = "money"):
+    ensure_user(user_id)
+    if kind == "accelerators":
+        add_accelerator(user_id, amount)
+    elif kind == "grant":
+        grant_balance(user_id, amount)
+    else:
+        add_balance(user_id, amount)
+
+
+async def shard_send(item: tuple):
+    # Один поток на все отправки: порядок сообщений сохраняется, цикл событий не ждёт канал
+    await asyncio.get_running_loop().run_in_executor(shard_sender, shard_conn.send, item)
+
+
+async def send_prepare(transfer_id: str):
+    transfer = pending_transfers.get(transfer_id)
+    if transfer is None:
+        return  # подтверждение пришло, пока ждали очереди
+    await shard_send((
+        "prepare", transfer_id, transfer["user_id"], transfer["amount"], SHARD_INDEX,
+        transfer.get("kind", "money")
+    ))
+
+
+def apply_transfer(transfer_id: str, user_id: int, amount: int, source_shard: int, kind: str = "money"):
+    # Повторный prepare с тем же id не зачисляет монеты второй раз, только подтверждает.
+    # Проверка и зачисление идут без await: следующее сообщение из канала (в том числе
+    # forget) обработается только после них
+    if transfer_id not in applied_transfers:
+        credit_local(user_id, amount, kind)
+        applied_transfers[transfer_id] = time.time()
+        journal_transfers()
+    spawn(confirm_transfer(transfer_id, source_shard))
+
+
+async def confirm_transfer(transfer_id: str, source_shard: int):
+    # Подтверждаем только после записи на диск; без подтверждения отправитель пришлёт prepare снова
+    if await flush_data_async():
+        await shard_send(("commit", transfer_id, source_shard, SHARD_INDEX))
+
+
+def complete_transfer(transfer_id: str, target_shard: int):
+    if pending_transfers.pop(transfer_id, None) is not None:
+        journal_transfers()
+    # Получатель хранит id зачисленного перевода, пока мы не перестанем его отправлять
+    spawn(shard_send(("forget", transfer_id, target_shard)))
+    waiter = transfer_waiters.get(transfer_id)
+    if waiter and not waiter.done():
+        waiter.set_result(True)
+
+
+def forget_transfer(transfer_id: str):
+    if applied_transfers.pop(transfer_id, None) is not None:
+        journal_transfers()
+
+
+async def transfer_resender():
+    # Переводы без подтверждения (в том числе оставшиеся после перезапуска) отправляем снова
     while True:
-        try:
-            for user_id, mine in mine_data.items():
-                if mine.get("auto_collect", False):
-                    mine["resources"] = mine.get("resources", 0) + 3
-
-            now = datetime.now()
-            for user_id, business in business_data.items():
-                if business.get("type") and business.get("active"):
-                    biz_info = BUSINESS_TYPES[business["type"]]
-
-                    if business.get("last_collect"):
-                        elapsed = (now - business["last_collect"]).total_seconds()
-                        if elapsed >= biz_info["profit_period"]:
-                            cycles = int(elapsed // biz_info["profit_period"])
-                            profit_to_add = biz_info["base_profit"] * cycles
-                            business["profit"] = business.get("profit", 0) + profit_to_add
-                            business["last_collect"] = now
-                    else:
-                        business["last_collect"] = now
+        for transfer_id in list(pending_transfers):
+            await send_prepare(transfer_id)
+        await asyncio.sleep(30)
 
-            await asyncio.sleep(1)
+
+def claim_promo(promo_code: str, user_id: int) -> dict:
+    """Отмечает активацию промокода; вызывается только на шарде-владельце"""
+    load_lazy_section("promo_codes")
+    promo = promo_codes.get(promo_code)
+    if promo is None:
+        return {"status": "missing"}
+    if isinstance(promo["used_by"], list):
+        promo["used_by"] = set(promo["used_by"])
+    if len(promo["used_by"]) >= promo["max_activations"]:
+        return {"status": "exhausted"}
+    if user_id in promo["used_by"]:
+        return {"status": "used"}
+
+    promo["used_by"].add(user_id)
+    journal.append(user_id, "promo", promo_code)
+    save_requested.set()
+    return {
+        "status": "ok",
+        "kind": "money" if promo["type"] == 'm' else "accelerators",
+        "amount": promo["amount"],
+        "remaining": promo["max_activations"] - len(promo["used_by"]),
+    }
+
+
+async def claim_remote_promo(promo_code: str, user_id: int) -> dict:
+    claim_id = uuid.uuid4().hex
+    waiter = promo_waiters[claim_id] = asyncio.get_running_loop().create_future()
+    await shard_send(("promo_claim", claim_id, promo_code, user_id, SHARD_INDEX))
+    try:
+        return await asyncio.wait_for(waiter, SHARD_TRANSFER_TIMEOUT)
+    except asyncio.TimeoutError:
+        return {"status": "timeout"}
+    finally:
+        promo_waiters.pop(claim_id, None)
+
+
+async def serve_promo_claim(claim_id: str, promo_code: str, user_id: int, source_shard: int):
+    # Награду отправляем обычным переводом: он переживёт падение любого из шардов
+    result = claim_promo(promo_code, user_id)
+    if result["status"] == "ok":
+        result["committed"] = await credit_user(user_id, result["amount"], kind=result["kind"])
+    await shard_send(("promo_result", claim_id, result, source_shard))
+
+
+def finish_promo_claim(claim_id: str, result: dict):
+    waiter = promo_waiters.get(claim_id)
+    if waiter and not waiter.done():
+        waiter.set_result(result)
+
+
+def drop_foreign_users():
+    """Оставляет в памяти только пользователей и промокоды своего шарда"""
+    for store in (users, daily_used, ranks, user_mini_settings):
+        for user_id in [u for u in store if not is_local_user(u)]:
+            del store[user_id]
+    load_lazy_section("promo_codes")
+    for code in [c for c in promo_codes if promo_shard(c) != SHARD_INDEX]:
+        del promo_codes[code]
+
+
+def update_user_id(raw: dict) -> Optional[int]:
+    for key, value in raw.items():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user")
+            if sender:
+                return sender["id"]
+            chat = value.get("chat")
+            if chat:
+                return chat["id"]
+    return None
+
+
+def shard_main(index: int, count: int, conn):
+    """Точка входа процесса-воркера"""
+    global SHARD_INDEX, SHARD_COUNT
+    SHARD_INDEX, SHARD_COUNT = index, count
+    # Ротация одного файла из нескольких процессов ненадёжна, у каждого шарда свой лог
+    setup_logging(shard_path(LOG_FILE, index))
+    asyncio.run(run_shard(conn))
+
+
+async def run_shard(conn):
+    global shard_conn, shard_sender, DATA_FILE, DB_FILE, BROADCAST_FILE, sqlite_store, dirty_all
+    shard_conn = conn
+    shard_sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-send")
+    BROADCAST_FILE = shard_path(BROADCAST_FILE, SHARD_INDEX)
+
+    base_file = DATA_FILE
+    DATA_FILE = shard_path(base_file, SHARD_INDEX)
+    journal.path = shard_path(JOURNAL_FILE, SHARD_INDEX)
+    if sqlite_store:
+        # Пустая база шарда при первом запуске берёт из общего JSON-файла своих пользователей
+        DB_FILE = shard_path(DB_FILE, SHARD_INDEX)
+        sqlite_store = SQLiteStore(DB_FILE)
+        DATA_FILE = base_file
+        load_data()
+        DATA_FILE = shard_path(base_file, SHARD_INDEX)
+    elif not os.path.exists(DATA_FILE) and os.path.exists(base_file):
+        # Первый запуск шарда: берём свою часть из общего файла
+        DATA_FILE = base_file
+        load_data()
+        DATA_FILE = shard_path(base_file, SHARD_INDEX)
+        dirty_all = True
+    else:
+        load_data()
+    drop_foreign_users()
+    replay_journal()
+    leaderboard.rebuild()
+
+    build_keyboards()
+    load_text_plugins()
+
+    asyncio.create_task(persistence_worker())
+    asyncio.create_task(auto_save())
+    asyncio.create_task(rate_limit_sweeper())
+    asyncio.create_task(mini_session_reaper())
+    asyncio.create_task(fsm_sweeper())
+    asyncio.create_task(journal_compactor())
+    asyncio.create_task(leaderboard_refresher())
+    resume_broadcast()
+    asyncio.create_task(transfer_resender())
+    metrics_runner = await start_metrics_server(METRICS_PORT + 1 + SHARD_INDEX)
+
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+
+    def on_readable():
+        while conn.poll():
+            inbox.put_nowait(conn.recv())
+
+    loop.add_reader(conn.fileno(), on_readable)
+    logger.info(f"✅ Шард {SHARD_INDEX}/{SHARD_COUNT} запущен: {len(users)} пользователей")
+
+    try:
+        while True:
+            item = await inbox.get()
+            kind = item[0]
+            if kind == "update":
+                spawn(dp.feed_raw_update(bot, item[1]))
+            elif kind == "prepare":
+                apply_transfer(*item[1:])
+            elif kind == "commit":
+                complete_transfer(item[1], item[3])
+            elif kind == "forget":
+                forget_transfer(item[1])
+            elif kind == "promo_claim":
+                spawn(serve_promo_claim(*item[1:]))
+            elif kind == "promo_result":
+                finish_promo_claim(item[1], item[2])
+            elif kind == "broadcast":
+                spawn(apply_shard_broadcast(item[1], item[2]))
+            elif kind == "stop":
+                break
+    finally:
+        loop.remove_reader(conn.fileno())
+        if shard_tasks:
+            await asyncio.wait(shard_tasks, timeout=10)
+        if flush_data():
+            await journal.compact(journal.seq)
+        journal.close()
+        if sqlite_store:
+            sqlite_store.close()
+        shard_sender.shutdown()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+
+
+async def run_front():
+    """Главный процесс: принимает апдейты и раскладывает их по шардам"""
+    ctx = multiprocessing.get_context("spawn")
+    conns, processes = [], []
+    for index in range(SHARD_COUNT):
+        parent_conn, child_conn = ctx.Pipe()
+        process = ctx.Process(target=shard_main, args=(index, SHARD_COUNT, child_conn), name=f"shard-{index}")
+        process.start()
+        conns.append(parent_conn)
+        processes.append(process)
+
+    def route_update(raw: dict):
+        user_id = update_user_id(raw)
+        conns[shard_of(user_id) if user_id is not None else 0].send(("update", raw))
+
+    def relay(conn):
+        # Переводы и промокоды между шардами идут через главный процесс
+        while conn.poll():
+            item = conn.recv()
+            if item[0] == "prepare":
+                conns[shard_of(item[2])].send(item)
+            elif item[0] in ("commit", "forget"):
+                conns[item[2]].send(item)
+            elif item[0] == "promo_claim":
+                conns[promo_shard(item[2])].send(item)
+            elif item[0] == "promo_result":
+                conns[item[3]].send(item)
+            elif item[0] == "broadcast":
+                for index, target in enumerate(conns):
+                    if index != item[3]:
+                        target.send(item)
+
+    loop = asyncio.get_running_loop()
+    for conn in conns:
+        loop.add_reader(conn.fileno(), relay, conn)
+    logger.info(f"✅ Запущено шардов: {SHARD_COUNT}")
+    metrics_runner = await start_metrics_server(METRICS_PORT)
+
+    try:
+        if BOT_MODE == "webhook":
+            await run_front_webhook(route_update)
+        else:
+            await run_front_polling(route_update)
+    finally:
+        for conn in conns:
+            loop.remove_reader(conn.fileno())
+            conn.send(("stop",))
+        for process in processes:
+            process.join(30)
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+
+
+async def run_front_polling(route_update):
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
         except Exception as e:
-            logger.error(f"Ошибка в фоновых задачах: {e}")
+            logger.error(f"❌ Ошибка получения апдейтов: {e}")
             await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            route_update(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+
+
+async def run_front_webhook(route_update):
+    async def handle(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        route_update(await request.json())
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "shards": SHARD_COUNT})
+
+    app = web.Application()
+    app.router.add_get("/health", health)
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT).start()
+    logger.info(f"🌐 Webhook слушает {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}, шардов: {SHARD_COUNT}")
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# ---------------- WEBHOOK ----------------
+async def health_handler(request: web.Request) -> web.Response:
+    return web.json_response({
+        "status": "ok",
+        "users": len(users),
+        "mini_games": len(mini_games),
+        "pending_saves": len(dirty_users),
+        "locks": user_locks.stats(),
+        "send_queue": send_queue.stats(),
+        "usernames": {"size": len(username_cache.entries), "hits": username_cache.hits, "misses": username_cache.misses},
+    })
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401)
+    return web.Response(text=metrics.prometheus(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(port: int) -> Optional[web.AppRunner]:
+    """/metrics на отдельном порту, не на публичном порту webhook"""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host=METRICS_HOST, port=port).start()
+    except OSError as e:
+        logger.error(f"❌ Не удалось открыть порт метрик {METRICS_HOST}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"📈 Метрики: http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+
+def create_webhook_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/health", health_handler)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook():
+    app = create_webhook_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT)
+    await site.start()
+    logger.info(f"🌐 Webhook слушает {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+
+    # Без WEBHOOK_URL сервер просто принимает POST - удобно для локальной проверки
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 # ---------------- ЗАПУСК БОТА ----------------
 async def main():
-    # Загружаем данные
+    if SHARD_COUNT > 1:
+        await run_front()
+        return
+
+    # Загружаем данные и дописываем то, что успело попасть только в журнал
     load_data()
+    replay_journal()
+    leaderboard.rebuild()
+    build_keyboards()
+    load_text_plugins()
     
-    # Запускаем фоновые задачи
-    asyncio.create_task(background_tasks())
+    # Запускаем фоновые задачи (рудник и бизнес начисляются лениво, см. accrue_mine)
+    asyncio.create_task(persistence_worker())
     asyncio.create_task(auto_save())
+    asyncio.create_task(rate_limit_sweeper())
+    asyncio.create_task(mini_session_reaper())
+    asyncio.create_task(fsm_sweeper())
+    asyncio.create_task(journal_compactor())
+    asyncio.create_task(leaderboard_refresher())
+    resume_broadcast()
+    metrics_runner = await start_metrics_server(METRICS_PORT)
     
     # Запускаем бота
     logger.info("✅ БОТ УСПЕШНО ЗАПУЩЕН! КОМАНДА /id ДОБАВЛЕНА!")
     print("✅ БОТ УСПЕШНО ЗАПУЩЕН! КОМАНДА /id ДОБАВЛЕНА!")
     
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            # После запуска в режиме webhook Telegram не отдаёт апдейты через getUpdates
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        # Дописываем всё, что не успел сохранить persistence_worker(), журнал больше не нужен
+        if flush_data():
+            await journal.compact(journal.seq)
+        journal.close()
+        if sqlite_store:
+            sqlite_store.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":
+    setup_logging(LOG_FILE)
     asyncio.run(main())
@@ -0,0 +1,149 @@
+# Общие заглушки для тестов: бот без сети, каждый тест - в своей временной папке
+import asyncio
+import importlib
+import os
+import sys
+import time
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test-token-not-used-for-requests")
+os.environ.setdefault("ADMINS", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, GetChat, SendMessage
+from aiogram.types import ChatFullInfo, Message, Update
+
+import main as bot_module
+
+ADMIN_ID = 1
+
+
+class FakeSession(BaseSession):
+    """Запоминает запросы к Bot API и отвечает на них без сети"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.fail = {}  # chat_id -> исключение, которое вернёт отправка в этот чат
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        error = self.fail.get(getattr(method, "chat_id", None))
+        if error is not None:
+            raise error
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message.model_validate(
+                {
+                    "message_id": getattr(method, "message_id", None) or len(self.calls),
+                    "date": int(time.time()),
+                    "chat": {"id": method.chat_id or 1, "type": "private"},
+                    "text": method.text,
+                },
+                context={"bot": bot},
+            )
+        if isinstance(method, GetChat):
+            return ChatFullInfo.model_validate(
+                {"id": method.chat_id, "type": "private", "accent_color_id": 0, "max_reaction_count": 0,
+                 "accepted_gift_types": {"unlimited_gifts": True, "limited_gifts": True, "unique_gifts": True,
+                                         "premium_subscription": True, "gifts_from_channels": True}},
+                context={"bot": bot},
+            )
+        return True
+
+    def texts(self) -> list:
+        texts = [getattr(method, "text", None) for method in self.calls]
+        self.calls.clear()
+        return texts
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+
+def start(module):
+    """Свежий модуль бота, поднятый с диска так же, как при запуске"""
+    module = importlib.reload(module)
+    module.bot.session = FakeSession()
+    module.rate_limiter.hit = lambda user_id, command, seconds: True
+    module.load_data()
+    module.replay_journal()
+    return module
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    module = start(bot_module)
+    yield module
+    module.journal.close()
+
+
+@pytest.fixture
+def restart(bot):
+    """Перезапуск после падения: в памяти ничего, на диске - снимок и журнал"""
+    def restart():
+        bot.journal.close()
+        return start(bot)
+    return restart
+
+
+_update_id = [0]
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}", "username": f"user{user_id}"}
+
+
+def message(user_id: int, text: str, **extra) -> Update:
+    _update_id[0] += 1
+    data = {
+        "message_id": _update_id[0],
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        "text": text,
+        **extra,
+    }
+    if text.startswith("/"):
+        data["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.model_validate({"update_id": _update_id[0], "message": data}, context={"bot": bot_module.bot})
+
+
+def callback(user_id: int, data: str, message_id: int = 5) -> Update:
+    _update_id[0] += 1
+    return Update.model_validate(
+        {
+            "update_id": _update_id[0],
+            "callback_query": {
+                "id": str(_update_id[0]),
+                "chat_instance": "test",
+                "from": _user(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "test",
+                },
+            },
+        },
+        context={"bot": bot_module.bot},
+    )
+
+
+async def feed(bot, *updates):
+    for update in updates:
+        await bot.dp.feed_update(bot.bot, update)
+    await asyncio.sleep(0)  # отложенная запись журнала выполняется на следующем шаге цикла
+
+
+def run(coro):
+    async def wrapper():
+        result = await coro
+        await asyncio.sleep(0)
+        return result
+    return asyncio.run(wrapper())
@@ -0,0 +1,170 @@
+# Рассылка: продолжение после перезапуска, остановка, ошибка разметки, шарды
+import asyncio
+import json
+import os
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import SendMessage
+
+from conftest import ADMIN_ID, feed, message, run
+
+PLAYERS = range(200, 220)
+
+
+def sent_to(bot) -> list:
+    return [call.chat_id for call in bot.bot.session.calls if isinstance(call, SendMessage)]
+
+
+def new_state(text: str = "hi") -> dict:
+    return {"admin_id": ADMIN_ID, "text": text, "copy": None, "last_id": -2 ** 63,
+            "total": 0, "sent": 0, "blocked": 0, "skipped": 0, "failed": 0}
+
+
+def test_broadcast_resumes_after_restart(bot, restart, monkeypatch):
+    for user_id in PLAYERS:
+        bot.ensure_user(user_id)
+    monkeypatch.setattr(bot, "BROADCAST_RATE", 1000)
+
+    async def interrupted():
+        await bot.launch_broadcast(new_state())
+        while bot.broadcast_state["sent"] < 5:
+            await asyncio.sleep(0)
+        bot.broadcast_task.cancel()  # остановка бота, а не /broadcast stop
+        await asyncio.gather(bot.broadcast_task, return_exceptions=True)
+
+    run(interrupted())
+    first = sent_to(bot)
+    with open(bot.BROADCAST_FILE, encoding="utf-8") as f:
+        assert not json.load(f).get("done")
+
+    bot.flush_data()
+    bot = restart()
+    bot.BROADCAST_RATE = 1000
+
+    async def resumed():
+        bot.resume_broadcast()
+        await bot.broadcast_task
+
+    run(resumed())
+    second = [chat_id for chat_id in sent_to(bot) if chat_id != ADMIN_ID]
+    assert set(first) | set(second) == set(PLAYERS)
+    assert len(first) + len(second) < 2 * len(PLAYERS)  # повторяются только недоотправленные
+    assert "ЗАВЕРШЕНА" in bot.bot.session.texts()[-1]
+
+
+def test_stuck_send_does_not_resend_later_players(bot, restart, monkeypatch):
+    for user_id in PLAYERS:
+        bot.ensure_user(user_id)
+    monkeypatch.setattr(bot, "BROADCAST_RATE", 1000)
+    session = bot.bot.session
+    answer = session.make_request
+
+    async def make_request(bot_, method, timeout=None):
+        if method.chat_id == PLAYERS[0]:
+            await asyncio.Event().wait()  # первый получатель не отвечает
+        return await answer(bot_, method, timeout)
+
+    async def interrupted():
+        session.make_request = make_request
+        await bot.launch_broadcast(new_state())
+        while bot.broadcast_state["sent"] < 10:
+            await asyncio.sleep(0)
+        bot.broadcast_task.cancel()
+        await asyncio.gather(bot.broadcast_task, return_exceptions=True)
+
+    run(interrupted())
+    first = sent_to(bot)
+    with open(bot.BROADCAST_FILE, encoding="utf-8") as f:
+        saved = json.load(f)
+    assert saved["last_id"] == PLAYERS[0] - 1
+    assert set(saved["completed"]) == set(first)
+
+    bot.flush_data()
+    bot = restart()
+    bot.BROADCAST_RATE = 1000
+
+    async def resumed():
+        bot.resume_broadcast()
+        await bot.broadcast_task
+
+    run(resumed())
+    second = [chat_id for chat_id in sent_to(bot) if chat_id != ADMIN_ID]
+    assert sorted(second) == sorted(set(PLAYERS) - set(first))
+    assert PLAYERS[0] in second
+
+
+def test_stop_cancels_in_flight_sends(bot, monkeypatch):
+    for user_id in PLAYERS:
+        bot.ensure_user(user_id)
+    monkeypatch.setattr(bot, "BROADCAST_RATE", 1000)
+    started = []
+    session = bot.bot.session
+
+    async def hanging_request(bot_, method, timeout=None):
+        started.append(method.chat_id)
+        await asyncio.Event().wait()
+
+    async def scenario():
+        await bot.launch_broadcast(new_state())
+        session.make_request = hanging_request
+        while len(started) < bot.BROADCAST_CONCURRENCY:
+            await asyncio.sleep(0)
+        assert await bot.stop_broadcast()
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert run(scenario()) == []
+    assert not os.path.exists(bot.BROADCAST_FILE)
+
+
+def test_parse_error_aborts_broadcast(bot, monkeypatch):
+    for user_id in PLAYERS:
+        bot.ensure_user(user_id)
+        bot.bot.session.fail[user_id] = TelegramBadRequest(
+            method=SendMessage(chat_id=user_id, text="x"), message="Bad Request: can't parse entities"
+        )
+    monkeypatch.setattr(bot, "BROADCAST_RATE", 1000)
+
+    async def scenario():
+        await bot.launch_broadcast(new_state("<b>"))
+        await bot.broadcast_task
+
+    run(scenario())
+    assert bot.broadcast_state["failed"] <= bot.BROADCAST_CONCURRENCY + 1
+    assert "ПРЕРВАНА" in bot.bot.session.texts()[-1]
+
+
+def test_invalid_html_is_checked_on_admin_first(bot, monkeypatch):
+    session = bot.bot.session
+    make_request = session.make_request
+
+    async def strict_request(bot_, method, timeout=None):
+        if getattr(method, "text", None) == "<b>oops":
+            raise TelegramBadRequest(method=method, message="Bad Request: can't parse entities")
+        return await make_request(bot_, method, timeout)
+
+    monkeypatch.setattr(session, "make_request", strict_request)
+    bot.ensure_user(200)
+    run(feed(bot, message(ADMIN_ID, "/broadcast <b>oops")))
+    assert bot.broadcast_task is None
+    assert "ошибка разметки" in session.texts()[-1]
+    assert not os.path.exists(bot.BROADCAST_FILE)
+
+
+def test_broadcast_is_sent_to_other_shards(bot, monkeypatch):
+    sent = []
+
+    async def shard_send(item):
+        sent.append(item)
+
+    monkeypatch.setattr(bot, "SHARD_COUNT", 2)
+    monkeypatch.setattr(bot, "SHARD_INDEX", 0)
+    monkeypatch.setattr(bot, "shard_send", shard_send)
+
+    async def scenario():
+        await feed(bot, message(ADMIN_ID, "/broadcast hello"))
+        await bot.broadcast_task
+        await feed(bot, message(ADMIN_ID, "/broadcast stop"))
+
+    run(scenario())
+    assert [(item[0], item[1], item[3]) for item in sent] == [("broadcast", "start", 0), ("broadcast", "stop", 0)]
+    assert sent[0][2]["text"] == "hello"
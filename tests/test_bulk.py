@@ -0,0 +1,79 @@
+# Массовая выдача /bulk: начисление без опыта, переводы на другие шарды, флаг занятости
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.methods import SendMessage
+
+from conftest import ADMIN_ID, feed, message, run
+
+DOCUMENT = {"file_id": "f", "file_unique_id": "f", "file_name": "grant.csv"}
+
+
+def upload(bot, monkeypatch, content: str):
+    async def download(document, destination):
+        with open(destination, "w", encoding="utf-8") as f:
+            f.write(content)
+
+    monkeypatch.setattr(bot.bot, "download", download)
+    run(feed(bot, message(ADMIN_ID, "/bulk", document=DOCUMENT)))
+
+
+def test_bulk_grants_without_xp(bot, monkeypatch):
+    for user_id in (70, 71):
+        bot.ensure_user(user_id)
+
+    upload(bot, monkeypatch, "user_id,amount,kind\n70,1000000,money\n71,5,accelerators\n")
+
+    assert bot.users[70].balance == bot.START_BALANCE + 1_000_000
+    assert (bot.users[70].profile.level, bot.users[70].profile.xp) == (1, 0)
+    assert bot.users[71].accelerators == bot.START_ACCELERATORS + 5
+    assert "ЗАВЕРШЕНА" in bot.bot.session.texts()[-1]
+    assert not bot.bulk_running
+
+
+def test_cross_shard_rows_are_sent_even_if_save_fails(bot, monkeypatch):
+    sent = []
+
+    async def shard_send(item):
+        sent.append(item)
+
+    async def flush_data_async(snapshot=False):
+        return False
+
+    monkeypatch.setattr(bot, "SHARD_COUNT", 2)
+    monkeypatch.setattr(bot, "SHARD_INDEX", 0)
+    monkeypatch.setattr(bot, "shard_send", shard_send)
+    monkeypatch.setattr(bot, "flush_data_async", flush_data_async)
+
+    upload(bot, monkeypatch, "11,300\n13,200\n")
+
+    assert [(item[0], item[2], item[3], item[5]) for item in sent] == [
+        ("prepare", 11, 300, "grant"), ("prepare", 13, 200, "grant"),
+    ]
+    assert len(bot.pending_transfers) == 2
+    assert "Сохранение не удалось" in bot.bot.session.texts()[-1]
+
+
+def test_busy_flag_is_reset_when_status_message_fails(bot, monkeypatch):
+    bot.bot.session.fail[ADMIN_ID] = TelegramNetworkError(
+        method=SendMessage(chat_id=ADMIN_ID, text="x"), message="down"
+    )
+    upload(bot, monkeypatch, "70,1\n")
+    assert not bot.bulk_running
+
+    del bot.bot.session.fail[ADMIN_ID]
+    bot.ensure_user(70)
+    upload(bot, monkeypatch, "70,1\n")
+    assert bot.users[70].balance == bot.START_BALANCE + 1
+
+
+def test_same_file_is_not_applied_twice(bot, restart, monkeypatch):
+    bot.ensure_user(72)
+    upload(bot, monkeypatch, "72,100\n")
+    upload(bot, monkeypatch, "72,100\n")
+    assert bot.users[72].balance == bot.START_BALANCE + 100
+    assert "уже был применён" in bot.bot.session.texts()[-1]
+
+    # Выдача лежит в журнале одной записью и переживает падение без снимка
+    bot = restart()
+    assert bot.users[72].balance == bot.START_BALANCE + 100
+    upload(bot, monkeypatch, "72,100\n")
+    assert bot.users[72].balance == bot.START_BALANCE + 100
@@ -0,0 +1,159 @@
+# Восстановление из журнала: после падения без снимка каждая операция
+# поднимается целиком - начисление вместе с изменением, сделанным вместе с ним
+import asyncio
+import json
+import os
+from datetime import datetime
+
+from conftest import feed, message, run
+
+
+def saved_state(bot, user_id) -> dict:
+    # Даты в файлах хранятся строками, сравниваем в том виде, в каком они на диске
+    return json.loads(json.dumps(bot._journal_state(user_id), default=str))
+
+
+def crash_and_replay(bot, restart, user_id):
+    before = saved_state(bot, user_id)
+    bot = restart()
+    assert saved_state(bot, user_id) == before
+    return bot
+
+
+def test_sell_business_removes_business(bot, restart):
+    player = bot.ensure_user(10)
+    player.business.type = "cafe"
+    player.business.active = True
+    player.business.last_collect = datetime.now()
+    player.business.profit = 300
+    bot.save_data(10)
+
+    run(feed(bot, message(10, "Продать бизнес")))
+
+    bot = crash_and_replay(bot, restart, 10)
+    player = bot.users[10]
+    assert player.business.type is None
+    assert player.business.profit == 0
+    assert player.balance >= bot.START_BALANCE + 500 + 300
+
+
+def test_collect_profit_resets_profit(bot, restart):
+    player = bot.ensure_user(11)
+    player.business.type = "shaurma"
+    player.business.active = True
+    player.business.last_collect = datetime.now()
+    player.business.profit = 700
+    bot.save_data(11)
+
+    run(feed(bot, message(11, "Собрать прибыль")))
+
+    bot = crash_and_replay(bot, restart, 11)
+    assert bot.users[11].business.profit == 0
+    assert bot.users[11].business.type == "shaurma"
+
+
+def test_collect_resources_resets_resources(bot, restart):
+    player = bot.ensure_user(12)
+    player.mine.resources = 1000
+    bot.save_data(12)
+
+    run(feed(bot, message(12, "Собрать ресурсы")))
+
+    bot = crash_and_replay(bot, restart, 12)
+    assert bot.users[12].mine.resources == 0
+    assert bot.users[12].balance >= bot.START_BALANCE + 2000
+
+
+def test_daily_is_not_paid_twice(bot, restart):
+    run(feed(bot, message(13, "/daily")))
+    balance = bot.users[13].balance
+
+    bot = crash_and_replay(bot, restart, 13)
+    assert 13 in bot.daily_used
+
+    run(feed(bot, message(13, "/daily")))
+    assert bot.users[13].balance == balance
+
+
+def test_level_up_reward_keeps_new_level(bot, restart):
+    bot.ensure_user(14)
+    bot.add_xp(14, 150)
+    assert bot.users[14].profile.level == 2
+
+    bot = crash_and_replay(bot, restart, 14)
+    profile = bot.users[14].profile
+    assert (profile.level, profile.next_level_xp) == (2, 200)
+    assert bot.users[14].balance == bot.START_BALANCE + 2000
+
+
+def test_upgrade_mine_keeps_level(bot, restart):
+    player = bot.ensure_user(15)
+    player.balance = 6_000_000
+    bot.save_data(15)
+
+    run(feed(bot, message(15, "Улучшить рудник")))
+    assert bot.users[15].mine.level == 1
+
+    bot = crash_and_replay(bot, restart, 15)
+    assert bot.users[15].mine.level == 1
+    assert bot.users[15].balance < 6_000_000
+
+
+def test_replay_after_snapshot_only_applies_newer_records(bot, restart):
+    bot.add_balance(16, 50)
+    bot.flush_data()
+    saved_seq = bot.journal.seq
+    run(bot.journal.compact(saved_seq))
+    bot.add_balance(16, 25)
+
+    bot = crash_and_replay(bot, restart, 16)
+    assert bot.users[16].balance == bot.START_BALANCE + 75
+
+
+def test_old_field_records_are_still_replayed(bot, restart):
+    bot.journal.append(17, "balance", 12345)
+    bot.journal.append(17, "accelerators", 7)
+    bot.journal.sync()
+
+    bot = restart()
+    assert bot.users[17].balance == 12345
+    assert bot.users[17].accelerators == 7
+
+
+def test_records_written_during_compaction_survive(bot, restart):
+    bot.add_balance(18, 50)
+    bot.flush_data()
+
+    async def compact_while_playing():
+        task = asyncio.create_task(bot.journal.compact(bot.journal.seq))
+        await asyncio.sleep(0)
+        # Файл переписывается в потоке, запись идёт в path.next
+        assert bot.journal.compacting
+        bot.add_balance(18, 25)
+        bot.journal.sync()
+        await task
+
+    run(compact_while_playing())
+    assert not os.path.exists(bot.journal.next_path)
+    assert bot.journal.size() == os.path.getsize(bot.journal.path)
+
+    bot = crash_and_replay(bot, restart, 18)
+    assert bot.users[18].balance == bot.START_BALANCE + 75
+
+
+def test_interrupted_compaction_is_finished_on_start(bot, restart):
+    bot.add_balance(19, 50)
+    bot.journal.sync()
+    with open(bot.journal.path, encoding="utf-8") as f:
+        lines = f.readlines()
+    # Упали посреди переноса path.next: часть записей уже в основном файле,
+    # последняя строка оборвана
+    with open(bot.journal.next_path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+        f.write(json.dumps([bot.journal.seq + 1, 19, "balance", 999]) + "\n")
+    with open(bot.journal.path, "a", encoding="utf-8") as f:
+        f.write('[1, 19, "bal')
+
+    bot = restart()
+    assert bot.users[19].balance == 999
+    assert not os.path.exists(bot.journal.next_path)
@@ -0,0 +1,59 @@
+# Таблица лидеров: кусочный отсортированный индекс и фоновое обновление
+import random
+
+
+def test_sorted_index_matches_plain_sort(bot, monkeypatch):
+    monkeypatch.setattr(bot.SortedIndex, "LOAD", 4)  # маленькие куски, чтобы чаще делились и пустели
+    index = bot.SortedIndex()
+    rng = random.Random(7)
+    scores = {}
+    for _ in range(3000):
+        user_id = rng.randrange(200)
+        if rng.random() < 0.2:
+            index.remove(user_id)
+            scores.pop(user_id, None)
+        else:
+            score = (rng.randrange(50), rng.randrange(5))
+            index.update(user_id, score)
+            scores[user_id] = score
+
+    expected = sorted(scores, key=lambda user_id: (tuple(-part for part in scores[user_id]), user_id))
+    assert [user_id for user_id, _ in index.top(len(scores))] == expected
+    assert [index.rank(user_id) for user_id in expected] == list(range(1, len(expected) + 1))
+    assert all(len(chunk) <= 2 * index.LOAD for chunk in index.lists)
+    assert index.maxes == [chunk[-1] for chunk in index.lists]
+
+
+def test_stale_players_are_refreshed_in_batches(bot):
+    for user_id in range(100, 110):
+        bot.add_balance(user_id, user_id)
+    assert bot.leaderboard.top("money") == []
+
+    assert bot.leaderboard.refresh(4) == 4
+    assert len(bot.leaderboard.stale) == 6
+    bot.leaderboard.refresh()
+    assert bot.leaderboard.top("money", 1)[0][0] == 109
+
+
+def test_own_rank_is_current(bot):
+    bot.add_balance(120, 10)
+    bot.leaderboard.refresh()
+    bot.add_balance(121, 1000)
+
+    assert bot.leaderboard.rank("money", 121) == 1
+    assert 120 not in bot.leaderboard.stale and 121 not in bot.leaderboard.stale
+
+
+def test_mine_score_counts_auto_collect(bot):
+    collector = bot.ensure_user(130).mine
+    collector.auto_collect = True
+    collector.last_accrual = bot.time.time() - 100
+    idle = bot.ensure_user(131).mine
+    idle.resources = 100
+    broken = bot.ensure_user(132).mine
+    broken.level = 99  # уровень вне MINE_LEVELS не ломает пересчёт рейтинга
+
+    bot.leaderboard.refresh()
+    assert [user_id for user_id, _ in bot.leaderboard.top("mine", 2)] == [130, 131]
+    assert bot.leaderboard.rank("mine", 132) is not None
+    assert bot.users[130].mine.resources == 0  # сам рудник рейтинг не трогает
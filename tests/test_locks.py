@@ -0,0 +1,104 @@
+# Блокировки по пользователям: проверка и списание под одной блокировкой, встречные переводы без взаимоблокировки
+import asyncio
+import gc
+
+from conftest import callback, feed, message, run
+
+
+def test_concurrent_transfers_cannot_overspend(bot):
+    bot.ensure_user(80).balance = 150
+    bot.ensure_user(81)
+    bot.ensure_user(82)
+
+    async def scenario():
+        await asyncio.gather(
+            bot.dp.feed_update(bot.bot, message(80, "/p 81 100")),
+            bot.dp.feed_update(bot.bot, message(80, "/p 82 100")),
+        )
+
+    run(scenario())
+    assert bot.users[80].balance == 50
+    assert bot.users[81].balance + bot.users[82].balance == 2 * bot.START_BALANCE + 100
+
+
+def test_opposite_transfers_do_not_deadlock(bot):
+    bot.ensure_user(83)
+    bot.ensure_user(84)
+
+    async def scenario():
+        await asyncio.wait_for(asyncio.gather(*(
+            bot.dp.feed_update(bot.bot, message(sender, f"/p {target} 10"))
+            for _ in range(5) for sender, target in ((83, 84), (84, 83))
+        )), timeout=5)
+
+    run(scenario())
+    assert bot.users[83].balance == bot.users[84].balance == bot.START_BALANCE
+
+
+def test_cross_shard_transfer_is_awaited_without_locks(bot, monkeypatch):
+    sent = []
+
+    async def shard_send(item):
+        sent.append(item)
+
+    monkeypatch.setattr(bot, "SHARD_COUNT", 2)
+    monkeypatch.setattr(bot, "SHARD_INDEX", 0)
+    monkeypatch.setattr(bot, "shard_send", shard_send)
+    bot.ensure_user(88)
+
+    async def scenario():
+        task = asyncio.create_task(bot.dp.feed_update(bot.bot, message(88, "/p 87 100")))
+        while not sent:
+            await asyncio.sleep(0)
+        # Другой шард ещё не ответил, а отправитель уже свободен
+        async def check_balance():
+            async with bot.user_locks.hold(88, 87, name="test"):
+                assert bot.users[88].balance == bot.START_BALANCE - 100
+
+        await asyncio.wait_for(check_balance(), timeout=1)
+        bot.transfer_waiters[sent[0][1]].set_result(True)
+        await asyncio.wait_for(task, timeout=1)
+
+    run(scenario())
+    assert len(bot.pending_transfers) == 1
+
+
+def test_mini_cashout_pays_once(bot):
+    # Сапёр идёт без блокировки: ход меняет состояние до первого await,
+    # поэтому одновременные нажатия не могут выплатить выигрыш дважды
+    run(feed(bot, message(89, "/mini 10")))
+    game_id, state = next(iter(bot.mini_games.games.items()))
+    state["bombs"] = 0
+    run(feed(bot, callback(89, f"mini_open_{game_id}_1")))
+    before = bot.users[89].balance
+
+    async def scenario():
+        await asyncio.gather(
+            bot.dp.feed_update(bot.bot, callback(89, f"mini_cashout_{game_id}")),
+            bot.dp.feed_update(bot.bot, callback(89, f"mini_cashout_{game_id}")),
+            bot.dp.feed_update(bot.bot, callback(89, f"mini_open_{game_id}_2")),
+        )
+
+    run(scenario())
+    assert bot.users[89].balance == before + int(10 * bot.MINI_MULTIPLIER)
+    assert game_id not in bot.mini_games
+
+
+def test_hold_serializes_and_frees_locks(bot):
+    locks = bot.UserLocks()
+    order = []
+
+    async def worker(tag: str):
+        async with locks.hold(85, 86, 85, name="test"):
+            order.append(f"{tag}+")
+            await asyncio.sleep(0)
+            order.append(f"{tag}-")
+
+    async def scenario():
+        await asyncio.gather(worker("a"), worker("b"))
+
+    run(scenario())
+    assert order == ["a+", "a-", "b+", "b-"]
+    assert (locks.acquired["test"], locks.contended["test"]) == (2, 1)
+    gc.collect()
+    assert len(locks.locks) == 0
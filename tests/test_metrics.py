@@ -0,0 +1,28 @@
+# Метрики: long polling не попадает в гистограмму Bot API, /metrics закрывается токеном
+from aiogram.methods import GetUpdates, SendMessage
+from aiohttp.test_utils import make_mocked_request
+
+from conftest import run
+
+
+def test_get_updates_is_not_timed(bot):
+    async def make_request(bot_, method):
+        return []
+
+    async def scenario():
+        await bot.ApiMetrics()(make_request, bot.bot, GetUpdates(timeout=30))
+        await bot.ApiMetrics()(make_request, bot.bot, SendMessage(chat_id=1, text="hi"))
+
+    run(scenario())
+    assert set(bot.metrics.families["api"]) == {"SendMessage"}
+
+
+def test_metrics_token_is_required_when_set(bot, monkeypatch):
+    monkeypatch.setattr(bot, "METRICS_TOKEN", "secret")
+
+    denied = run(bot.metrics_handler(make_mocked_request("GET", "/metrics")))
+    allowed = run(bot.metrics_handler(
+        make_mocked_request("GET", "/metrics", headers={"Authorization": "Bearer secret"})
+    ))
+    assert (denied.status, allowed.status) == (401, 200)
+    assert "coingame" in allowed.text
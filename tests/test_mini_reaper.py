@@ -0,0 +1,33 @@
+# Истёкшие игры сапёра: выплата не зависит от того, удалось ли обновить сообщение
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.methods import SendMessage
+
+from conftest import feed, message, run
+
+
+def start_game(bot, user_id: int, bet: int = 100) -> dict:
+    run(feed(bot, message(user_id, f"/mini {bet}")))
+    return next(state for state in bot.mini_games.games.values() if state["user_id"] == user_id)
+
+
+def test_reaper_pays_every_game_even_if_edit_fails(bot, monkeypatch):
+    monkeypatch.setattr(bot.mini_games, "policy", "cashout")
+    first, second = start_game(bot, 40), start_game(bot, 41)
+    for state in (first, second):
+        state["multiplier"] = 2.0
+        state["deadline"] = 0
+        bot.heapq.heappush(bot.mini_games.deadlines, (0, state["game_id"]))
+    bot.bot.session.fail[40] = TelegramNetworkError(method=SendMessage(chat_id=40, text="x"), message="down")
+
+    run(bot.reap_mini_sessions())
+
+    assert len(bot.mini_games) == 0
+    assert bot.users[40].balance == bot.START_BALANCE + 100
+    assert bot.users[41].balance == bot.START_BALANCE + 100
+    assert "Выигрыш 200 монет зачислен" in bot.bot.session.calls[-1].text
+
+
+def test_stats_count_keyboard_memory(bot):
+    state = start_game(bot, 42)
+    with_keyboard = bot.mini_games.stats()["memory_bytes"]
+    assert with_keyboard > state["keyboard"].memory() > 0
@@ -0,0 +1,89 @@
+# Запись на диск: JSON-снимок переписывается только по требованию, остальное время хватает журнала
+import os
+
+from conftest import run
+
+
+def test_flush_without_snapshot_only_syncs_journal(bot, restart):
+    bot.flush_data()
+    written = os.path.getmtime(bot.DATA_FILE), os.path.getsize(bot.DATA_FILE)
+
+    bot.add_balance(20, 1000)
+    assert run(bot.flush_data_async())
+    assert (os.path.getmtime(bot.DATA_FILE), os.path.getsize(bot.DATA_FILE)) == written
+
+    bot = restart()
+    assert bot.users[20].balance == bot.START_BALANCE + 1000
+
+
+def test_snapshot_flush_rewrites_file(bot):
+    bot.add_balance(21, 1000)
+    assert run(bot.flush_data_async(snapshot=True))
+    with open(bot.DATA_FILE, encoding="utf-8") as f:
+        assert '"21": 1100' in f.read()
+
+
+def test_fsm_and_transfers_survive_without_snapshot(bot, restart):
+    key = bot.StorageKey(bot_id=1, chat_id=22, user_id=22)
+    run(bot.storage.set_state(key, bot.RouletteStates.waiting_for_number))
+    run(bot.storage.set_data(key, {"bet": 50}))
+    bot.pending_transfers["t1"] = {"user_id": 23, "amount": 5, "source_id": None}
+    bot.journal_transfers()
+    bot.blocked_users.add(24)
+    bot.journal.append(24, "blocked", True)
+
+    bot = restart()
+    key = bot.StorageKey(bot_id=1, chat_id=22, user_id=22)
+    assert run(bot.storage.get_data(key)) == {"bet": 50}
+    assert bot.pending_transfers == {"t1": {"user_id": 23, "amount": 5, "source_id": None}}
+    assert 24 in bot.blocked_users
+
+
+def test_fsm_sweep_survives_broken_record(bot):
+    good = bot.StorageKey(bot_id=1, chat_id=25, user_id=25)
+    run(bot.storage.set_state(good, bot.RouletteStates.waiting_for_number))
+    run(bot.storage.set_data(good, {"bet": 40}))
+    bot.storage.records["broken"] = {"user_id": 26, "state": "x", "data": None, "touched": 0}
+    bot.heapq.heappush(bot.storage.deadlines, (bot.storage.ttl, "broken"))
+    bot.storage.records[bot.storage.make_key(good)]["touched"] = 0
+    bot.heapq.heappush(bot.storage.deadlines, (bot.storage.ttl, bot.storage.make_key(good)))
+
+    bot.sweep_fsm_states()
+
+    assert bot.storage.records == {}
+    assert bot.users[25].balance == bot.START_BALANCE + 40
+    assert bot.users[25].profile.xp == 0  # возврат ставки не даёт опыта
+
+
+def test_meta_sections_are_encoded_only_when_changed(bot):
+    def meta_names():
+        return [name for name, _ in bot._take_changes()[-1]]
+
+    assert set(meta_names()) == set(bot.META_SECTIONS) | {"journal_seq"}
+    assert meta_names() == ["journal_seq"]
+
+    bot.blocked_users.add(27)
+    bot.mark_meta_dirty("blocked_users")
+    bot.username_cache.remember("someone", 28)
+    assert meta_names() == ["usernames", "blocked_users", "journal_seq"]
+    assert bot._meta_cache["blocked_users"] == "[27]"
+
+
+def test_binary_snapshot_round_trip(bot, restart, monkeypatch):
+    monkeypatch.setenv("SNAPSHOT_FORMAT", "binary")
+    bot = restart()
+    assert bot.DATA_FILE.endswith(".bin")
+    bot.add_balance(29, 500)
+    bot.users[29].mine.resources = 77
+    bot.ranks[29] = "VIP"
+    bot.set_infinite_balance(30)
+
+    saved_seq = bot.journal.seq
+    assert run(bot.flush_data_async(snapshot=True))
+    run(bot.journal.compact(saved_seq))
+
+    bot = restart()
+    assert bot.users[29].balance == bot.START_BALANCE + 500
+    assert bot.users[29].mine.resources == 77
+    assert bot.ranks[29] == "VIP"
+    assert bot.has_infinite_balance(30)
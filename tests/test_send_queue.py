@@ -0,0 +1,85 @@
+# Очередь отправки: лимиты только для сообщений, чистка корзин, склейка правок сапёра
+import asyncio
+
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.methods import EditMessageText, GetChat, SendMessage
+
+from conftest import callback, feed, message, run
+
+
+def test_only_message_methods_are_shaped(bot):
+    queue = bot.SendQueue()
+
+    async def make_request(bot_, method):
+        return True
+
+    async def scenario():
+        await queue(make_request, bot.bot, GetChat(chat_id="@someone"))
+        assert queue.chat_buckets == {}
+        await queue(make_request, bot.bot, SendMessage(chat_id=5, text="hi"))
+        assert set(queue.chat_buckets) == {5}
+
+    run(scenario())
+
+
+def test_idle_chat_buckets_are_evicted(bot):
+    queue = bot.SendQueue()
+    now = bot.time.monotonic()
+    for chat_id in range(100):
+        queue._send_at(chat_id)
+    assert len(queue.chat_buckets) == 100
+
+    queue.sweep(now + 10)
+    assert queue.chat_buckets == {}
+
+    queue.next_sweep = 0
+    queue._send_at(1)
+    assert set(queue.chat_buckets) == {1}
+
+
+def test_fast_mini_clicks_coalesce_edits(bot):
+    session = bot.bot.session
+    session.middleware(bot.send_queue)
+    run(feed(bot, message(30, "/mini 10")))
+    game_id, state = next(iter(bot.mini_games.games.items()))
+    state["bombs"] = 0  # без мин каждое нажатие - удачный ход
+    session.calls.clear()
+
+    async def scenario():
+        await asyncio.gather(*(
+            bot.dp.feed_update(bot.bot, callback(30, f"mini_open_{game_id}_{idx}")) for idx in range(1, 7)
+        ))
+
+    run(scenario())
+    edits = [call for call in session.calls if isinstance(call, EditMessageText)]
+    assert state["hits"] == 6
+    assert bot.send_queue.coalesced >= 1
+    assert len(edits) < 6
+    assert "Открыто клеток: 6" in edits[-1].text
+
+
+def test_network_errors_retry_only_edits(bot, monkeypatch):
+    queue = bot.SendQueue()
+    attempts = []
+    sleep = asyncio.sleep
+    monkeypatch.setattr(bot.asyncio, "sleep", lambda delay: sleep(0))
+
+    async def make_request(bot_, method):
+        attempts.append(type(method).__name__)
+        if len(attempts) == 1:
+            raise TelegramNetworkError(method=method, message="timeout")
+        return True
+
+    async def scenario():
+        # Запрос мог дойти до Telegram - повтор sendMessage продублировал бы сообщение
+        try:
+            await queue(make_request, bot.bot, SendMessage(chat_id=5, text="hi"))
+        except TelegramNetworkError:
+            pass
+        assert attempts == ["SendMessage"]
+
+        attempts.clear()
+        assert await queue(make_request, bot.bot, EditMessageText(chat_id=5, message_id=1, text="hi"))
+        assert attempts == ["EditMessageText", "EditMessageText"]
+
+    run(scenario())
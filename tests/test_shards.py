@@ -0,0 +1,113 @@
+# Двухфазные переводы и промокоды между шардами; канал к главному процессу подменён списком
+import asyncio
+
+import pytest
+
+from conftest import ADMIN_ID, feed, message, run
+
+
+@pytest.fixture
+def shard(bot, monkeypatch):
+    sent = []
+
+    async def shard_send(item):
+        sent.append(item)
+
+    monkeypatch.setattr(bot, "SHARD_COUNT", 2)
+    monkeypatch.setattr(bot, "SHARD_INDEX", 0)
+    monkeypatch.setattr(bot, "shard_send", shard_send)
+    return sent
+
+
+async def settle(bot):
+    while bot.shard_tasks:
+        await asyncio.wait(set(bot.shard_tasks))
+
+
+def test_repeated_prepare_credits_once(bot, shard):
+    async def scenario():
+        bot.apply_transfer("t1", 10, 500, 1)
+        bot.apply_transfer("t1", 10, 500, 1)
+        await settle(bot)
+
+    run(scenario())
+    assert bot.users[10].balance == bot.START_BALANCE + 500
+    assert shard == [("commit", "t1", 1, 0), ("commit", "t1", 1, 0)]
+    assert "t1" in bot.applied_transfers
+
+
+def test_applied_id_kept_until_sender_forgets(bot, shard, restart):
+    async def scenario():
+        bot.apply_transfer("t2", 10, 500, 1)
+        await settle(bot)
+
+    run(scenario())
+    bot = restart()
+    assert "t2" in bot.applied_transfers
+
+    bot.forget_transfer("t2")
+    bot = restart()
+    assert bot.applied_transfers == {}
+
+
+def test_credit_to_other_shard_waits_for_commit(bot, shard):
+    async def scenario():
+        task = asyncio.create_task(bot.credit_user(11, 300, source_id=10))
+        while not shard:
+            await asyncio.sleep(0)
+        kind, transfer_id, user_id, amount, source, credit_kind = shard[0]
+        assert (kind, user_id, amount, source, credit_kind) == ("prepare", 11, 300, 0, "money")
+        assert transfer_id in bot.pending_transfers
+        bot.complete_transfer(transfer_id, 1)
+        committed = await task
+        await settle(bot)
+        return transfer_id, committed
+
+    transfer_id, committed = run(scenario())
+    assert committed
+    assert bot.pending_transfers == {}
+    assert 11 not in bot.users
+    assert shard[-1] == ("forget", transfer_id, 1)
+
+
+def test_promo_activations_counted_by_owner(bot):
+    bot.promo_codes["GIFT"] = {"type": "m", "amount": 100, "max_activations": 1, "used_by": set()}
+
+    assert bot.claim_promo("GIFT", 10)["status"] == "ok"
+    assert bot.claim_promo("GIFT", 10)["status"] == "exhausted"
+    assert bot.claim_promo("NOPE", 10)["status"] == "missing"
+
+
+def test_foreign_promo_is_claimed_on_owner_shard(bot, shard):
+    code = next(c for c in ("A", "B", "C", "D") if bot.promo_shard(c) == 1)
+
+    async def scenario():
+        task = asyncio.create_task(bot.claim_remote_promo(code, 10))
+        while not shard:
+            await asyncio.sleep(0)
+        claim_id = shard[0][1]
+        assert shard[0] == ("promo_claim", claim_id, code, 10, 0)
+        bot.finish_promo_claim(claim_id, {"status": "used"})
+        return await task
+
+    assert run(scenario()) == {"status": "used"}
+
+
+def test_drop_foreign_users_keeps_own_promos(bot, shard):
+    for code in ("A", "B", "C", "D"):
+        bot.promo_codes[code] = {"type": "m", "amount": 1, "max_activations": 1, "used_by": set()}
+    bot.ensure_user(10)
+    bot.ensure_user(11)
+
+    bot.drop_foreign_users()
+    assert set(bot.users) == {10}
+    assert all(bot.promo_shard(code) == 0 for code in bot.promo_codes)
+
+
+def test_admin_writes_to_foreign_user_are_rejected(bot, shard):
+    run(feed(bot, message(ADMIN_ID, "/chance 11 50")))
+    assert 11 not in bot.user_mini_settings
+    assert "другим шардом" in bot.bot.session.texts()[-1]
+
+    with pytest.raises(ValueError):
+        bot.set_infinite_balance(11)
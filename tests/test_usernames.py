@@ -0,0 +1,36 @@
+# /p @username: перед переводом устаревшая запись кэша перепроверяется
+from types import SimpleNamespace
+
+from conftest import feed, message, run
+
+
+def test_transfer_rechecks_old_username(bot, monkeypatch):
+    asked = []
+
+    async def get_chat(username):
+        asked.append(username)
+        return SimpleNamespace(id=51)
+
+    monkeypatch.setattr(bot.bot, "get_chat", get_chat)
+    bot.ensure_user(51)
+    bot.username_cache.remember("seller", 50)
+    bot.username_cache.entries["seller"][1] -= bot.USERNAME_VERIFY_AGE + 1  # подтверждено давно
+
+    run(feed(bot, message(60, "/p @seller 100")))
+
+    assert asked == ["@seller"]
+    assert bot.users[51].balance == bot.START_BALANCE + 100
+    assert 50 not in bot.users or bot.users[50].balance == bot.START_BALANCE
+
+
+def test_fresh_username_is_trusted(bot, monkeypatch):
+    async def get_chat(username):
+        raise AssertionError("свежая запись не должна запрашиваться")
+
+    monkeypatch.setattr(bot.bot, "get_chat", get_chat)
+    bot.ensure_user(52)
+    bot.username_cache.remember("buyer", 52)
+
+    run(feed(bot, message(60, "/p @buyer 100")))
+
+    assert bot.users[52].balance == bot.START_BALANCE + 100